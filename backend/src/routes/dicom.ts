@@ -1,5 +1,5 @@
 import { Router, Request, Response } from 'express';
-import axios from 'axios';
+import axios, { AxiosResponse } from 'axios';
 import { logger } from '../utils/logger';
 import { DicomModel } from '../models/DicomModel';
 import PatientModel from '../models/Patient';
@@ -33,7 +33,9 @@ const handleServiceError = (err: unknown, res: Response, defaultMessage = 'Servi
     if (axios.isAxiosError(err)) {
         // Handle Axios error
         logger.error(new Error(`Imaging service error: ${err.message}`));
-        const message = err.response?.data?.message || err.message || defaultMessage;
+        // Strömmade svar har en stream som data, där finns inget meddelande att läsa
+        const data = err.response?.data;
+        const message = (data && typeof data.message === 'string' && data.message) || err.message || defaultMessage;
         res.status(err.response?.status || 500).json({ error: message });
     } else {
         // Handle other errors
@@ -44,6 +46,53 @@ const handleServiceError = (err: unknown, res: Response, defaultMessage = 'Servi
 };
 
 
+// Headers som följer med strömmade svar från imaging-service. Hop-by-hop-headers
+// (connection, transfer-encoding, keep-alive) sätts av Express för den egna anslutningen.
+const FORWARDED_RESPONSE_HEADERS = [
+  'content-type',
+  'content-encoding',
+  'etag',
+  'last-modified',
+  'cache-control',
+  'vary',
+  'accept-ranges',
+  'content-range',
+  'content-disposition'
+];
+
+// Skicka ett strömmat svar vidare. Felsvar (status >= 400) läses in och skickas
+// med sin status och body, eftersom axios annars bara ger en stream i felet.
+// Använd tillsammans med validateStatus: () => true.
+const pipeServiceResponse = async (upstream: AxiosResponse, res: Response) => {
+  if (upstream.status >= 400) {
+    const chunks: Buffer[] = [];
+    for await (const chunk of upstream.data) {
+      chunks.push(Buffer.from(chunk));
+    }
+    res.status(upstream.status)
+      .type(String(upstream.headers['content-type'] || 'application/json'))
+      .send(Buffer.concat(chunks));
+    return;
+  }
+
+  res.status(upstream.status);
+  Object.entries(upstream.headers).forEach(([key, value]) => {
+    const name = key.toLowerCase();
+    if (value && (FORWARDED_RESPONSE_HEADERS.includes(name) || name.startsWith('x-volume-'))) {
+      res.setHeader(name, value);
+    }
+  });
+  // Längden gäller bara när kroppen inte skickas chunkad
+  const length = upstream.headers['content-length'];
+  if (length && !upstream.headers['transfer-encoding']) {
+    res.setHeader('content-length', length);
+  }
+  // Avbryt hämtningen från imaging-service om klienten kopplar ner
+  res.on('close', () => upstream.data.destroy());
+  upstream.data.pipe(res);
+};
+
+
 router.get('/series/:seriesId', async (req, res) => {
     try {
         console.log('Received request for series:', req.params.seriesId);
@@ -60,6 +109,18 @@ router.get('/series/:seriesId', async (req, res) => {
 
 
 
+// Metadata för alla instanser i en serie i en förfrågan
+router.get('/series/:seriesId/metadata', async (req: Request, res: Response) => {
+    try {
+        const response = await axios.get(
+            `${IMAGING_SERVICE_URL}/api/dicom/series/${req.params.seriesId}/metadata`
+        );
+        res.json(response.data);
+    } catch (err) {
+        handleServiceError(err, res);
+    }
+});
+
 router.post('/parse/folder', async (req: Request, res: Response) => {
     try {
         const { folderPath } = req.body;
@@ -95,6 +156,45 @@ router.post('/parse/folder', async (req: Request, res: Response) => {
     }
 });
 
+// Background ingestion jobs, survive client and proxy disconnects
+router.post('/jobs', async (req: Request, res: Response) => {
+    try {
+        const response = await axios.post(`${IMAGING_SERVICE_URL}/api/dicom/jobs`, req.body);
+        res.status(response.status).json(response.data);
+    } catch (err) {
+        handleServiceError(err, res);
+    }
+});
+
+router.get('/jobs', async (req: Request, res: Response) => {
+    try {
+        const response = await axios.get(`${IMAGING_SERVICE_URL}/api/dicom/jobs`, {
+            params: req.query
+        });
+        res.json(response.data);
+    } catch (err) {
+        handleServiceError(err, res);
+    }
+});
+
+router.get('/jobs/:jobId', async (req: Request, res: Response) => {
+    try {
+        const response = await axios.get(`${IMAGING_SERVICE_URL}/api/dicom/jobs/${req.params.jobId}`);
+        res.json(response.data);
+    } catch (err) {
+        handleServiceError(err, res);
+    }
+});
+
+router.post('/jobs/:jobId/cancel', async (req: Request, res: Response) => {
+    try {
+        const response = await axios.post(`${IMAGING_SERVICE_URL}/api/dicom/jobs/${req.params.jobId}/cancel`);
+        res.json(response.data);
+    } catch (err) {
+        handleServiceError(err, res);
+    }
+});
+
 
 
 
@@ -191,9 +291,43 @@ router.post('/config', async (req: Request, res: Response) => {
 
 // Add volume endpoint
 router.get('/volume/:seriesId', async (req: Request, res: Response) => {
+  try {
+    // Binära format (format=raw|npy) skickas vidare som de är, även komprimerade
+    const response = await axios.get(
+      `${IMAGING_SERVICE_URL}/api/dicom/volume/${req.params.seriesId}`,
+      { params: req.query, responseType: 'stream', decompress: false, validateStatus: () => true }
+    );
+
+    await pipeServiceResponse(response, res);
+  } catch (err) {
+    handleServiceError(err, res);
+  }
+});
+
+// DICOMweb (QIDO-RS/WADO-RS), multipart-svar strömmas igenom utan buffring
+router.get('/web/*', async (req: Request, res: Response) => {
   try {
     const response = await axios.get(
-      `${IMAGING_SERVICE_URL}/api/dicom/volume/${req.params.seriesId}`
+      `${IMAGING_SERVICE_URL}/api/dicom/web/${req.params[0]}`,
+      {
+        params: req.query,
+        headers: req.headers.accept ? { accept: req.headers.accept } : {},
+        responseType: 'stream',
+        validateStatus: () => true
+      }
+    );
+
+    await pipeServiceResponse(response, res);
+  } catch (err) {
+    handleServiceError(err, res);
+  }
+});
+
+// Pyramidnivåer för progressiv volymladdning
+router.get('/volume/:seriesId/levels', async (req: Request, res: Response) => {
+  try {
+    const response = await axios.get(
+      `${IMAGING_SERVICE_URL}/api/dicom/volume/${req.params.seriesId}/levels`
     );
     res.json(response.data);
   } catch (err) {
@@ -360,18 +494,42 @@ router.get('/imageIds', async (req: Request, res: Response) => {
 router.get('/instance/:sopInstanceUid', async (req: Request, res: Response) => {
   try {
     console.log('[Backend] Fetching DICOM instance:', req.params.sopInstanceUid);
+    // Range och villkorliga headers skickas vidare så att 206 och 304 fungerar genom proxyn
+    const forwarded: Record<string, string> = {};
+    ['range', 'if-range', 'if-none-match', 'if-modified-since'].forEach((name) => {
+      const value = req.headers[name];
+      if (typeof value === 'string') forwarded[name] = value;
+    });
     const response = await axios.get(
       `${IMAGING_SERVICE_URL}/api/dicom/instance/${req.params.sopInstanceUid}`,
-      { responseType: 'arraybuffer' } // Viktigt: Hämta som binärdata
+      {
+        headers: forwarded,
+        responseType: 'stream', // Viktigt: Hämta som binärdata utan att buffra hela filen
+        validateStatus: () => true
+      }
     );
     
-    // Kopiera headers från imaging-service
-    Object.entries(response.headers).forEach(([key, value]) => {
-      if (value) res.setHeader(key, value);
-    });
-    
-    // Skicka binärdata direkt till klienten
-    res.send(response.data);
+    // Skicka binärdata direkt till klienten, med ETag, Cache-Control och Content-Range
+    await pipeServiceResponse(response, res);
+  } catch (err) {
+    handleServiceError(err, res);
+  }
+});
+
+// Renderad bildruta (PNG/JPEG/WebP) med fönster, storlek och format som query-parametrar
+router.get('/instance/:sopInstanceUid/rendered', async (req: Request, res: Response) => {
+  try {
+    const response = await axios.get(
+      `${IMAGING_SERVICE_URL}/api/dicom/instance/${req.params.sopInstanceUid}/rendered`,
+      {
+        params: req.query,
+        headers: req.headers['if-none-match'] ? { 'if-none-match': req.headers['if-none-match'] } : {},
+        responseType: 'stream',
+        validateStatus: () => true
+      }
+    );
+
+    await pipeServiceResponse(response, res);
   } catch (err) {
     handleServiceError(err, res);
   }
@@ -65,6 +65,11 @@ export interface DicomMetadata {
   bitsStored?: number;
   highBit?: number;
   pixelRepresentation?: number;
+  imagePositionPatient?: number[];
+  imageOrientationPatient?: number[];
+  numberOfFrames?: number;
+  rescaleSlope?: number;
+  rescaleIntercept?: number;
 }
 
 interface CustomLoaderOptions {
@@ -452,6 +457,38 @@ export class DicomService {
     }
   }
 
+  /**
+   * URL till en serverrenderad bildruta, för miniatyrer och tunna klienter
+   */
+  getRenderedFrameUrl(
+    sopInstanceUid: string,
+    options: { frame?: number; preset?: string; wc?: number; ww?: number; size?: number; format?: 'png' | 'jpeg' | 'webp' } = {}
+  ): string {
+    const params = new URLSearchParams();
+    Object.entries(options).forEach(([key, value]) => {
+      if (value !== undefined) params.set(key, String(value));
+    });
+    const query = params.toString();
+    return `${this.baseUrl}/instance/${sopInstanceUid}/rendered${query ? `?${query}` : ''}`;
+  }
+
+  /**
+   * Hämtar metadata för alla instanser i en serie i en förfrågan och fyller metadatacachen
+   */
+  async getSeriesMetadata(seriesId: string): Promise<DicomMetadata[]> {
+    try {
+      const response = await axios.get(`${this.baseUrl}/series/${seriesId}/metadata`);
+      const metadataList: DicomMetadata[] = response.data;
+      metadataList.forEach((metadata) => {
+        this.metadataCache[metadata.sopInstanceUid] = metadata;
+      });
+      return metadataList;
+    } catch (error) {
+      console.error('Error getting series metadata:', error);
+      throw this.handleError(error, 'Failed to get series metadata');
+    }
+  }
+
   /**
    * Hämtar metadata för en DICOM-instans
    */
@@ -605,24 +642,32 @@ export class DicomService {
   }
 
   // Get volume data for MPR
-  async getVolumeData(seriesId: string): Promise<{
+  // level 4 eller 2 ger en nedsamplad volym att visa direkt medan finare nivåer laddas
+  async getVolumeData(seriesId: string, level: 1 | 2 | 4 = 1): Promise<{
     buffer: ArrayBuffer;
     dimensions: {
       width: number;
       height: number;
       depth: number;
     };
+    spacing: number[];
+    level: number;
   }> {
     try {
-      const response = await axios.get(`${this.baseUrl}/volume/${seriesId}`);
-      
-      // Konvertera JSON-data till Float32Array
-      const data = response.data;
-      const volumeArray = new Float32Array(data.volume);
-      
+      // Hämta volymen som rå Float32-data, layouten kommer i headers
+      const response = await axios.get(`${this.baseUrl}/volume/${seriesId}`, {
+        params: { format: 'raw', level },
+        responseType: 'arraybuffer'
+      });
+      const [width, height, depth] = String(response.headers['x-volume-dimensions'])
+        .split(',')
+        .map(Number);
+
       return {
-        buffer: volumeArray.buffer,
-        dimensions: data.dimensions
+        buffer: response.data,
+        dimensions: { width, height, depth },
+        spacing: String(response.headers['x-volume-spacing']).split(',').map(Number),
+        level
       };
     } catch (error) {
       console.error('Error fetching volume data:', error);
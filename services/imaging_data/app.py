@@ -1,11 +1,36 @@
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, send_file
 from pymongo import MongoClient
 from pymongo.errors import ServerSelectionTimeoutError
 from parsers.folder_parser import FolderParser
 from utils.mongo_utils import init_mongo_indexes
+from utils.ingestion_jobs import IngestionJobManager
+from utils.manifest import FileManifest
+from utils.watch_folder import FolderWatcher
+from utils.store_scp import StoreSCP
+from utils.instance_index import InstanceIndex
+from utils.volume import (
+    assemble_volume, encode_volume, downsample_volume, level_instances, level_spacing, volume_spacing,
+    read_header, volume_headers, iter_volume_slices, stream_volume,
+    VOLUME_FORMATS, VOLUME_COMPRESSIONS, VOLUME_HEADERS, VOLUME_DTYPE, PYRAMID_LEVELS
+)
+from utils.volume_cache import VolumeCache, series_fingerprint
+from utils.viewer_metadata import extract_viewer_metadata, viewer_response
+from utils.frame_index import FrameReader, frame_media_type, parse_frame
+from utils.rendering import (
+    RenderCache, native_frame_pixels, decode_frame, render_pixels, encode_image,
+    RENDER_FORMATS, RENDER_MIMETYPES, DEFAULT_RENDER_QUALITY, MAX_RENDER_SIZE, WINDOW_PRESETS
+)
+from utils.dicomweb import (
+    query_keyword, match_value, value_matches, match_date, study_attributes, series_attributes,
+    instance_attributes, multipart_boundary, multipart_related, instance_parts, query_int, match_numbers, InvalidQuery,
+    DICOM_JSON, QIDO_DEFAULT_LIMIT
+)
+from utils.archives import locator_exists, open_locator, read_locator, locator_size, split_locator
 import pydicom
 from flask_cors import CORS
+import io
 import os
+import hashlib
 import logging
 import json
 from flask import Response
@@ -20,7 +45,7 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=VOLUME_HEADERS)
 
 # Disable reloader when processing files
 app.config['USE_RELOADER'] = False
@@ -91,6 +116,59 @@ def internal_error(error):
 # Initialize indexes on startup
 init_mongo_indexes(db)
 
+def parser_options(data):
+    """Map request fields to FolderParser keyword arguments"""
+    return {
+        'workers': data.get('workers'),
+        'incremental': data.get('incremental', True),
+        'hash_files': data.get('hashFiles', False),
+        'chunk_size': data.get('chunkSize')
+    }
+
+# SOP UID -> file location, shared by the per-instance routes
+instance_index = InstanceIndex(db) if db is not None else None
+
+# Decoded volumes, memory-mapped from local disk on repeat opens
+volume_cache = VolumeCache()
+
+# Memory-mapped instance files for the frames endpoint
+frame_reader = FrameReader()
+
+# Rendered frames, keyed by file identity, frame, window, size and format
+render_cache = RenderCache()
+
+# DICOMweb (QIDO-RS / WADO-RS) endpoints are served below this path
+DICOMWEB_ROOT = '/api/dicom/web'
+
+# An instance never changes under its SOP UID, so clients may cache it for a year
+INSTANCE_MAX_AGE = int(os.getenv('INSTANCE_MAX_AGE', str(365 * 24 * 3600)))
+
+# Background ingestion jobs, interrupted jobs are resumed on startup
+job_manager = None
+if db is not None:
+    job_manager = IngestionJobManager(db, lambda **options: FolderParser(db, **options))
+    job_manager.resume_interrupted()
+
+# Watch mode: ingest files dropped into a spool directory continuously
+folder_watcher = None
+WATCH_DIR = os.getenv('DICOM_WATCH_DIR')
+if db is not None and WATCH_DIR:
+    watch_parser = FolderParser(db)
+    watch_manifest = FileManifest(db.file_manifest, WATCH_DIR, preload=False)
+    folder_watcher = FolderWatcher(
+        WATCH_DIR,
+        lambda file_paths: watch_parser.ingest_files(file_paths, watch_manifest),
+        use_polling=os.getenv('DICOM_WATCH_POLLING', '').lower() in ('1', 'true')
+    )
+    folder_watcher.start()
+
+# C-STORE receiver: modalities push straight into the store and the index
+store_scp = None
+SCP_PORT = os.getenv('DICOM_SCP_PORT')
+if db is not None and SCP_PORT:
+    store_scp = StoreSCP(db, SCP_PORT)
+    store_scp.start()
+
 @app.route('/api/dicom/parse/folder', methods=['POST'])
 def parse_folder():
     try:
@@ -105,11 +183,26 @@ def parse_folder():
             
         logger.info(f"Parsing DICOM folder: {folder_path}")
         
-        parser = FolderParser(db)
+        parser = FolderParser(db, **parser_options(data))
         
         def generate_response():
             for progress in parser.parse(folder_path):
-                percentage = (progress['current'] / progress['total']) * 100
+                if 'error' in progress:
+                    yield f"data: {json.dumps({'error': progress['error']})}\n\n"
+                    continue
+                if progress.get('complete'):
+                    # Slutsammanfattning inklusive manifest-diff
+                    summary = {
+                        'percentage': 100,
+                        'complete': True,
+                        'total_processed': progress['total_processed'],
+                        'total_succeeded': progress['total_succeeded'],
+                        'skipped': progress.get('skipped'),
+                        'manifest': progress.get('manifest')
+                    }
+                    yield f"data: {json.dumps(summary)}\n\n"
+                    continue
+                percentage = (progress['current'] / progress['total']) * 100 if progress['total'] else 0
                 logger.info(f"Progress: {percentage:.1f}%")
                 # Skicka bara percentage
                 yield f"data: {json.dumps({'percentage': percentage})}\n\n"
@@ -130,6 +223,72 @@ def parse_folder():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/dicom/jobs', methods=['POST'])
+def submit_ingestion_job():
+    """Starta en import i bakgrunden och returnera jobb-ID"""
+    try:
+        data = request.get_json()
+        folder_path = data.get('folderPath')
+
+        if not folder_path:
+            return jsonify({'error': 'Missing folderPath'}), 400
+
+        if not os.path.exists(folder_path):
+            return jsonify({'error': f'Directory not found: {folder_path}'}), 404
+
+        job_id = job_manager.submit(folder_path, parser_options(data))
+        logger.info(f"Submitted ingestion job {job_id} for {folder_path}")
+        return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+    except Exception as e:
+        logger.error(f"Error submitting ingestion job: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/dicom/jobs', methods=['GET'])
+def list_ingestion_jobs():
+    try:
+        return jsonify(job_manager.list_jobs(int(request.args.get('limit', 50))))
+    except Exception as e:
+        logger.error(f"Error listing ingestion jobs: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/dicom/jobs/<job_id>', methods=['GET'])
+def get_ingestion_job(job_id):
+    """Status, files/sec och ETA för ett importjobb"""
+    try:
+        job = job_manager.get(job_id)
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job)
+    except Exception as e:
+        logger.error(f"Error getting ingestion job: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/dicom/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_ingestion_job(job_id):
+    try:
+        if not job_manager.get(job_id):
+            return jsonify({'error': 'Job not found'}), 404
+        if not job_manager.cancel(job_id):
+            return jsonify({'error': 'Job is not running'}), 409
+        return jsonify({'job_id': job_id, 'status': 'cancelling'})
+    except Exception as e:
+        logger.error(f"Error cancelling ingestion job: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/dicom/watch', methods=['GET'])
+def get_watch_status():
+    """Status för bevakad spool-katalog"""
+    if folder_watcher is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **folder_watcher.status()})
+
+@app.route('/api/dicom/scp', methods=['GET'])
+def get_scp_status():
+    """Status för C-STORE-mottagaren"""
+    if store_scp is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **store_scp.status()})
+
 @app.route('/api/dicom/test', methods=['GET'])
 def test_connection():
     if db is None:
@@ -200,12 +359,16 @@ def get_series_by_series_id(series_id):
     try:
         logger.info(f"Hämtar serie med ID: {series_id}")
         
-        # Sök i studies-collection först
-        for study in db.studies.find({}, {'_id': 0}):
-            for series in study.get('series', []):
-                if series.get('series_uid') == series_id:
-                    logger.info(f"Hittade serie i studies-collection")
-                    return jsonify(series)
+        # Sök i studies-collection först, via indexet på series.series_uid
+        study = db.studies.find_one(
+            {'series.series_uid': series_id},
+            {'_id': 0, 'series': {'$elemMatch': {'series_uid': series_id}}}
+        )
+        if study:
+            logger.info(f"Hittade serie i studies-collection")
+            series = study['series'][0]
+            series['instances'] = instance_index.series_instances(series_id)
+            return jsonify(series)
         
         # Om serien inte hittades i studies-collection, sök i series-collection
         series = db.series.find_one({'series_uid': series_id})
@@ -233,59 +396,132 @@ def get_series_by_study_id():
         study = db.studies.find_one({'study_instance_uid': study_id})
         if not study:
             return jsonify({'error': 'Study not found'}), 404
-            
-        return jsonify(study.get('series', []))
+
+        # Instanserna ligger i instances-collection
+        instances_by_series = instance_index.study_instances(study_id)
+        series_list = study_series(study)
+        for series in series_list:
+            series['instances'] = instances_by_series.get(series.get('series_uid'), [])
+        return jsonify(series_list)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def load_series_volume(series_id, instances, level=1):
+    """Volym för en pyramidnivå, från diskcachen, den cachade fulla volymen eller avkodade snitt"""
+    # Avkodade volymer återanvänds från diskcachen så länge serien är oförändrad
+    fingerprint = series_fingerprint(instances)
+    cached = volume_cache.get(series_id, fingerprint, level)
+    if cached:
+        return cached
+
+    full = volume_cache.get(series_id, fingerprint) if level != 1 else None
+    if full:
+        # Grova nivåer räknas fram ur den fulla volymen utan ny avkodning
+        volume, spacing = downsample_volume(full[0], level), level_spacing(full[1], level)
+    else:
+        # Bara vart level:e snitt avkodas, så grova nivåer går snabbt även första gången
+        volume, spacing = assemble_volume(level_instances(instances, level))
+        volume = downsample_volume(volume, level, slices_selected=True)
+        spacing = level_spacing(spacing, level)
+    volume_cache.put(series_id, fingerprint, volume, spacing, level)
+
+    if level == 1:
+        # Full upplösning finns redan i minnet, så resten av pyramiden är billig att cacha nu
+        for lower in PYRAMID_LEVELS:
+            if lower != 1 and not volume_cache.get(series_id, fingerprint, lower):
+                volume_cache.put(series_id, fingerprint, downsample_volume(volume, lower),
+                                 level_spacing(spacing, lower), lower)
+    return volume, spacing
+
+def stream_series_volume(series_id, instances, level=1):
+    """Strömmar volymen snitt för snitt, från diskcachen eller medan snitten avkodas"""
+    cached = volume_cache.get(series_id, series_fingerprint(instances), level)
+    if cached:
+        volume, spacing = cached
+        shape, slices = volume.shape, iter(volume)
+    else:
+        # Hela volymen hålls aldrig i minnet, så den cachas inte heller här
+        header = read_header(instances[0]['file_path'])
+        rows, columns = int(header.Rows), int(header.Columns)
+        selected = level_instances(instances, level)
+        shape = (len(selected), rows // level, columns // level)
+        spacing = level_spacing(volume_spacing(header), level)
+        slices = iter_volume_slices(selected, (rows, columns), level)
+
+    headers = volume_headers(shape, VOLUME_DTYPE, spacing)
+    headers['X-Volume-Level'] = str(level)
+    return Response(stream_volume(slices, shape, spacing, level), mimetype='application/octet-stream', headers=headers)
+
 @app.route('/api/dicom/volume/<series_id>', methods=['GET'])
 def get_volume_by_series_id(series_id):
+    """Volym för en serie, som JSON eller binärt (format=raw|npy, compression=gzip|zstd).
+
+    level=4|2 ger en nedsamplad pyramidnivå som visas direkt och sedan
+    ersätts med finare nivåer. format=stream skickar en geometriheader och
+    sedan varje snitt så snart det är avkodat.
+    """
     try:
-        series = db.series.find_one({'series_uid': series_id})
-        if not series:
-            return jsonify({'error': 'Series not found'}), 404
-              
+        fmt = request.args.get('format', 'json')
+        compression = request.args.get('compression')
+        level = request.args.get('level', '1')
+        if fmt not in VOLUME_FORMATS:
+            return jsonify({'error': f'format must be one of {", ".join(VOLUME_FORMATS)}'}), 400
+        if compression and (fmt not in ('raw', 'npy') or compression not in VOLUME_COMPRESSIONS):
+            return jsonify({'error': f'compression must be one of {", ".join(VOLUME_COMPRESSIONS)} with a binary format'}), 400
+        if level not in [str(l) for l in PYRAMID_LEVELS]:
+            return jsonify({'error': f'level must be one of {", ".join(str(l) for l in PYRAMID_LEVELS)}'}), 400
+        level = int(level)
+
         # Hämta alla instanser för denna serie
-        instances = list(db.instances.find({'series_uid': series_id}).sort('instance_number', 1))
-        
+        instances = instance_index.series_instances(series_id)
         if not instances:
-            return jsonify({'error': 'No instances found for series'}), 404
-        
-        # Skapa en tom volym med rätt dimensioner
-        width = instances[0]['columns']
-        height = instances[0]['rows']
-        depth = len(instances)
-        
-        # Läs in pixeldata från varje instans
-        volume_data = []
-        for instance in instances:
-            try:
-                # Läs DICOM-filen
-                file_path = instance['file_path']
-                dataset = pydicom.dcmread(file_path)
-                
-                # Extrahera pixeldata och konvertera till float
-                pixel_array = dataset.pixel_array.astype(float)
-                
-                # Normalisera till 0-255
-                if pixel_array.max() > 0:
-                    pixel_array = ((pixel_array / pixel_array.max()) * 255.0).astype(float)
-                
-                # Lägg till i volymdata
-                volume_data.extend(pixel_array.flatten().tolist())
-            except Exception as e:
-                app.logger.error(f"Error reading instance {instance['instance_number']}: {str(e)}")
-        
+            return jsonify({'error': 'Series not found'}), 404
+
+        if fmt == 'stream':
+            return stream_series_volume(series_id, instances, level)
+
+        volume, spacing = load_series_volume(series_id, instances, level)
+
+        if fmt != 'json':
+            body, mimetype, headers = encode_volume(volume, spacing, fmt, compression)
+            headers['X-Volume-Level'] = str(level)
+            return Response(body, mimetype=mimetype, headers=headers)
+
         # Returnera volymdata i rätt format för Cornerstone3D
+        depth, height, width = volume.shape
         return jsonify({
-            'volume': volume_data,
+            'volume': volume.ravel().tolist(),
             'dimensions': [width, height, depth],
-            'spacing': [1, 1, 1]  # Standard spacing om inte tillgängligt i DICOM
+            'spacing': spacing,
+            'level': level
         })
     except Exception as e:
         app.logger.error(f"Error getting volume: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/dicom/volume/<series_id>/levels', methods=['GET'])
+def get_volume_levels(series_id):
+    """Pyramidnivåer för en serie, grövsta först, med dimensioner och om de redan är cachade"""
+    try:
+        instances = instance_index.series_instances(series_id)
+        if not instances:
+            return jsonify({'error': 'Series not found'}), 404
+
+        first = read_header(instances[0]['file_path'])
+        rows, columns = int(first.Rows), int(first.Columns)
+        spacing = volume_spacing(first)
+        fingerprint = series_fingerprint(instances)
+
+        return jsonify([{
+            'level': level,
+            'dimensions': [columns // level, rows // level, len(level_instances(instances, level))],
+            'spacing': level_spacing(spacing, level),
+            'cached': volume_cache.get(series_id, fingerprint, level) is not None
+        } for level in PYRAMID_LEVELS])
+    except Exception as e:
+        app.logger.error(f"Error getting volume levels: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/dicom/study/<study_id>', methods=['GET'])
 def get_study_by_study_id(study_id):
     try:
@@ -302,6 +538,7 @@ def get_study_by_study_id(study_id):
         else:
             formatted_date = None
             
+        instances_by_series = instance_index.study_instances(study_id)
         formatted_study = {
             'study_instance_uid': study['study_instance_uid'],
             'patient_id': study['patient_id'],
@@ -309,15 +546,15 @@ def get_study_by_study_id(study_id):
             'series': [{
                 'series_uid': series.get('series_uid', series.get('series_uid')),  # Säkerställ att series_uid alltid finns
                 'series_uid': series.get('series_uid', series.get('series_uid')),  # Säkerställ att series_uid alltid finns
-                'series_number': series['series_number'],
-                'description': series['description'],
-                'modality': series['modality'],
+                'series_number': series.get('series_number', 0),
+                'description': series.get('description') or series.get('series_description'),
+                'modality': series.get('modality'),
                 'instances': [{
                     'sop_instance_uid': instance['sop_instance_uid'],
                     'instance_number': instance['instance_number'],
                     'file_path': instance['file_path'].replace('\\', '/')
-                } for instance in series['instances']]
-            } for series in study['series']]
+                } for instance in instances_by_series.get(series.get('series_uid'), [])]
+            } for series in study_series(study)]  # Studier från C-STORE kan sakna inbäddade serier
         }
         
         return jsonify(formatted_study)
@@ -362,315 +599,285 @@ def get_image_ids():
         if not study_id and not series_id:
             return jsonify({'error': 'studyId eller seriesId krävs'}), 400
             
-        # Hitta studier som matchar kriterierna
+        # Hämta instanserna direkt från instances-collection, sorterade på instansnummer
         query = {}
         if study_id:
-            # Sök på både study_instance_uid och study_uid
-            query['$or'] = [
-                {'study_instance_uid': study_id},
-                {'study_uid': study_id}
-            ]
-            
+            query['study_instance_uid'] = study_id
+        if series_id:
+            query['series_uid'] = series_id
+
         logger.info(f"get_image_ids: query={query}")
-        studies = list(db.studies.find(query, {'_id': 0}))
-        logger.info(f"get_image_ids: found {len(studies)} studies")
-        
-        image_ids = []
-        
+        instances = list(db.instances.find(query, {'_id': 0}).sort('instance_number', 1))
+        if not instances:
+            # Äldre studier har instanserna inbäddade, de flyttas till instances-collection och läses igen
+            study_query = {'study_instance_uid': study_id} if study_id else {'series.series_uid': series_id}
+            if instance_index.normalize_embedded(study_query):
+                instances = list(db.instances.find(query, {'_id': 0}).sort('instance_number', 1))
+
         # Basurl för wadouri
         base_url = request.host_url.rstrip('/')
-        
-        # Gå igenom alla studier
-        for study in studies:
-            logger.info(f"get_image_ids: processing study {study.get('study_instance_uid', study.get('study_uid', 'unknown'))}")
-            
-            # Gå igenom alla serier i studien
-            for series in study.get('series', []):
-                logger.info(f"get_image_ids: processing series {series.get('series_uid', 'unknown')}")
-                
-                # Om series_id är specificerat, filtrera på det
-                if series_id and series.get('series_uid') != series_id:
-                    continue
-                    
-                # Gå igenom alla instanser i serien
-                instances = series.get('instances', [])
-                logger.info(f"get_image_ids: found {len(instances)} instances in series")
-                
-                for instance in instances:
-                    # Logga instanstyp
-                    logger.info(f"get_image_ids: instance type: {type(instance)}")
-                    
-                    # Konvertera instance till ett objekt om det är en sträng
-                    if isinstance(instance, str):
-                        # Parsa strängen till ett objekt
-                        instance_str = instance.strip('@{}')
-                        instance_parts = instance_str.split('; ')
-                        instance = {}
-                        for part in instance_parts:
-                            key, value = part.split('=', 1)
-                            instance[key] = value
-                    
-                    # Skapa image_id
-                    sop_instance_uid = instance.get('sop_instance_uid')
-                    if sop_instance_uid:
-                        image_path = instance.get('file_path', '').replace('\\', '/')
-                        image_id = f"wadouri:{base_url}/api/dicom/instance/{sop_instance_uid}"
-                        
-                        image_ids.append({
-                            'imageId': image_id,
-                            'sopInstanceUid': sop_instance_uid,
-                            'seriesInstanceUid': series.get('series_uid', ''),
-                            'studyInstanceUid': study.get('study_instance_uid', study.get('study_uid', '')),
-                            'instanceNumber': int(instance.get('instance_number', 0)),
-                            'filePath': image_path
-                        })
-        
-        # Sortera efter instanceNumber
-        image_ids.sort(key=lambda x: x['instanceNumber'])
-        
+
+        image_ids = []
+        for instance in instances:
+            sop_instance_uid = instance['sop_instance_uid']
+            image_ids.append({
+                'imageId': f"wadouri:{base_url}/api/dicom/instance/{sop_instance_uid}",
+                'sopInstanceUid': sop_instance_uid,
+                'seriesInstanceUid': instance.get('series_uid', ''),
+                'studyInstanceUid': instance.get('study_instance_uid', ''),
+                'instanceNumber': int(instance.get('instance_number', 0)),
+                'filePath': instance.get('file_path', '').replace('\\', '/')
+            })
+
         logger.info(f"get_image_ids: returning {len(image_ids)} image IDs")
         return jsonify(image_ids)
     except Exception as e:
         logger.error(f"Error getting image IDs: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def locate_instance_file(sop_instance_uid):
+    """Slå upp instansens plats via SOP UID-indexet, None om filen saknas"""
+    location = instance_index.locate(sop_instance_uid)
+    if not location:
+        return None
+    if not location.get('file_path') or not locator_exists(location['file_path']):
+        # Filen kan ha flyttats sedan den cachades
+        instance_index.invalidate(sop_instance_uid)
+        return None
+    return location
+
+def instance_etag(sop_instance_uid, file_path):
+    """Stark ETag från SOP UID, sökväg, storlek och ändringstid för den lagrade filen"""
+    archive_path, _ = split_locator(file_path)
+    stat = os.stat(archive_path)
+    identity = f"{sop_instance_uid}|{file_path}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.blake2b(identity.encode(), digest_size=16).hexdigest()
+
 @app.route('/api/dicom/instance/<sop_instance_uid>', methods=['GET'])
 def get_instance(sop_instance_uid):
     try:
-        # Sök genom alla studier för att hitta instansen
-        for study in db.studies.find({}, {'_id': 0}):
-            for series in study.get('series', []):
-                for instance in series.get('instances', []):
-                    # Konvertera instance till ett objekt om det är en sträng
-                    if isinstance(instance, str):
-                        instance_str = instance.strip('@{}')
-                        instance_parts = instance_str.split('; ')
-                        instance_obj = {}
-                        for part in instance_parts:
-                            key, value = part.split('=', 1)
-                            instance_obj[key] = value
-                        
-                        if instance_obj.get('sop_instance_uid') == sop_instance_uid:
-                            file_path = instance_obj.get('file_path')
-                            if file_path and os.path.exists(file_path):
-                                headers = {
-                                    'Content-Type': 'application/dicom',
-                                    'Content-Disposition': f'attachment; filename={sop_instance_uid}.dcm'
-                                }
-                                return Response(open(file_path, 'rb').read(), headers=headers)
-                    else:
-                        # Om instance är ett objekt
-                        if instance.get('sop_instance_uid') == sop_instance_uid:
-                            file_path = instance.get('file_path')
-                            if file_path and os.path.exists(file_path):
-                                headers = {
-                                    'Content-Type': 'application/dicom',
-                                    'Content-Disposition': f'attachment; filename={sop_instance_uid}.dcm'
-                                }
-                                return Response(open(file_path, 'rb').read(), headers=headers)
-        
-        # Om vi kommer hit har vi inte hittat instansen
-        return jsonify({'error': f'Instance with SOP UID {sop_instance_uid} not found'}), 404
+        location = locate_instance_file(sop_instance_uid)
+        if not location:
+            return jsonify({'error': f'Instance with SOP UID {sop_instance_uid} not found'}), 404
+
+        file_path = location['file_path']
+        etag = instance_etag(sop_instance_uid, file_path)
+        _, member = split_locator(file_path)
+        if member is None:
+            # Filen skickas direkt från disk, med Range och If-None-Match via send_file
+            source = os.path.abspath(file_path)
+        elif request.if_none_match.contains(etag):
+            # Arkivmedlemmar packas bara upp när klienten inte redan har dem
+            source = None
+        else:
+            source = io.BytesIO(read_locator(file_path))
+
+        if source is None:
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.cache_control.public = True
+            response.cache_control.max_age = INSTANCE_MAX_AGE
+        else:
+            response = send_file(
+                source,
+                mimetype='application/dicom',
+                as_attachment=True,
+                download_name=f'{sop_instance_uid}.dcm',
+                conditional=True,
+                etag=etag,
+                max_age=INSTANCE_MAX_AGE
+            )
+        response.cache_control.immutable = True
+        return response
     except Exception as e:
         logger.error(f"Error getting instance: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/dicom/instance/<sop_instance_uid>/frames/<int:frame_number>', methods=['GET'])
+def get_instance_frame(sop_instance_uid, frame_number):
+    """Pixeldata för en bildruta (1-baserad), läst direkt ur den minnesmappade filen.
+
+    Okomprimerade rutor skickas som råa bytes, komprimerade som sin
+    kodade bitström med motsvarande mediatyp.
+    """
+    try:
+        location = locate_instance_file(sop_instance_uid)
+        if not location:
+            return jsonify({'error': f'Instance with SOP UID {sop_instance_uid} not found'}), 404
+
+        file_path = location['file_path']
+        etag = f"{instance_etag(sop_instance_uid, file_path)}-{frame_number}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            frame_index = location.get('frame_index')
+            if frame_index:
+                if not 1 <= frame_number <= len(frame_index['frames']):
+                    return jsonify({'error': f'Frame {frame_number} not found'}), 404
+                body = frame_reader.read(file_path, frame_index['frames'][frame_number - 1])
+                mimetype = frame_media_type(frame_index)
+            else:
+                # Instanser utan index (t.ex. arkivmedlemmar) läses via pydicom
+                try:
+                    body, mimetype = parse_frame(file_path, frame_number)
+                except IndexError:
+                    return jsonify({'error': f'Frame {frame_number} not found'}), 404
+            response = Response(body, mimetype=mimetype)
+
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = INSTANCE_MAX_AGE
+        response.cache_control.immutable = True
+        return response
+    except Exception as e:
+        logger.error(f"Error getting frame: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/dicom/window-presets', methods=['GET'])
+def get_window_presets():
+    """Fönsterinställningar som kan anges med preset= vid rendering"""
+    return jsonify({name: {'center': center, 'width': width} for name, (center, width) in WINDOW_PRESETS.items()})
+
+@app.route('/api/dicom/instance/<sop_instance_uid>/rendered', methods=['GET'])
+def get_rendered_frame(sop_instance_uid):
+    """Fönstrad bildruta som PNG, JPEG eller WebP för tunna klienter.
+
+    Parametrar: frame (1-baserad), wc/ww eller preset, size (längsta
+    sidan i pixlar), format och quality. Utan fönster används värdena
+    från instansens metadata, annars bildrutans eget värdeintervall.
+    """
+    try:
+        fmt = request.args.get('format', 'png')
+        if fmt not in RENDER_FORMATS:
+            return jsonify({'error': f'format must be one of {", ".join(RENDER_FORMATS) or "(requires Pillow)"}'}), 400
+        try:
+            frame_number = int(request.args.get('frame', 1))
+            size = min(int(request.args['size']), MAX_RENDER_SIZE) if 'size' in request.args else None
+            quality = int(request.args.get('quality', DEFAULT_RENDER_QUALITY))
+            center = float(request.args['wc']) if 'wc' in request.args else None
+            width = float(request.args['ww']) if 'ww' in request.args else None
+        except ValueError:
+            return jsonify({'error': 'frame, size, quality, wc and ww must be numbers'}), 400
+        if size is not None and size <= 0:
+            return jsonify({'error': 'size must be a positive number of pixels'}), 400
+        if not 1 <= quality <= 100:
+            return jsonify({'error': 'quality must be between 1 and 100'}), 400
+        preset = request.args.get('preset')
+        if preset:
+            if preset not in WINDOW_PRESETS:
+                return jsonify({'error': f'preset must be one of {", ".join(WINDOW_PRESETS)}'}), 400
+            center, width = WINDOW_PRESETS[preset]
+
+        location = locate_instance_file(sop_instance_uid)
+        if not location:
+            return jsonify({'error': f'Instance with SOP UID {sop_instance_uid} not found'}), 404
+
+        key = (instance_etag(sop_instance_uid, location['file_path']), frame_number, center, width, size, fmt, quality)
+        etag = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        if request.if_none_match.contains(etag):
+            body = None
+        else:
+            body = render_cache.get(key)
+            if body is None:
+                try:
+                    body = render_frame(location, frame_number, center, width, fmt, size, quality)
+                except IndexError:
+                    return jsonify({'error': f'Frame {frame_number} not found'}), 404
+                render_cache.put(key, body)
+
+        response = Response(body, mimetype=RENDER_MIMETYPES[fmt]) if body is not None else Response(status=304)
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = INSTANCE_MAX_AGE
+        response.cache_control.immutable = True
+        return response
+    except Exception as e:
+        logger.error(f"Error rendering frame: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def render_frame(location, frame_number, center, width, fmt, size, quality):
+    """Avkoda, fönstra och koda en bildruta; okomprimerade rutor läses direkt ur minnesmappen"""
+    metadata = ensure_viewer_metadata(location) or {}
+    frame_index = location.get('frame_index')
+    pixels = None
+    data = None
+    if frame_index:
+        if not 1 <= frame_number <= len(frame_index['frames']):
+            raise IndexError(frame_number)
+        data = frame_reader.read(location['file_path'], frame_index['frames'][frame_number - 1])
+        if not frame_index['encapsulated']:
+            pixels = native_frame_pixels(data, metadata)
+            photometric = metadata.get('photometricInterpretation', 'MONOCHROME2')
+    if pixels is None:
+        # Med rutindex avkodas bara den begärda rutan, inte hela pixeldatan
+        pixels, photometric = decode_frame(
+            location['file_path'], frame_number, data, bool(frame_index and frame_index['encapsulated'])
+        )
+    return encode_image(render_pixels(pixels, photometric, metadata, center, width), fmt, size, quality)
+
+def ensure_viewer_metadata(instance):
+    """Visningsmetadata för en instans; äldre instanser läses en gång från fil och sparas"""
+    metadata = instance.get('viewer_metadata')
+    if metadata is not None:
+        return metadata
+    file_path = instance.get('file_path')
+    if not file_path or not locator_exists(file_path):
+        return None
+    metadata = extract_viewer_metadata(read_header(file_path))
+    db.instances.update_one({'sop_instance_uid': instance['sop_instance_uid']}, {'$set': {'viewer_metadata': metadata}})
+    instance_index.invalidate(instance['sop_instance_uid'])
+    return metadata
+
 @app.route('/api/dicom/metadata/<sop_instance_uid>', methods=['GET'])
 def get_metadata(sop_instance_uid):
-    """Hämtar metadata för en specifik DICOM-instans"""
+    """Hämtar metadata för en specifik DICOM-instans från instansindexet"""
     try:
-        logger.info(f"[get_metadata] Hämtar metadata för SOP UID: {sop_instance_uid}")
-        
-        # Sök genom studies-kollektionen för att hitta instansen med detta SOP UID
-        for study in db.studies.find():
-            logger.info(f"[get_metadata] Kontrollerar studie: {study.get('study_instance_uid', 'okänt')}")
-            
-            for series in study.get('series', []):
-                logger.info(f"[get_metadata] Kontrollerar serie: {series.get('series_uid', 'okänt')}")
-                
-                instances = series.get('instances', [])
-                for instance in instances:
-                    # Förbättrad loggning för att spåra instanstyper
-                    logger.info(f"[get_metadata] Instanstyp: {type(instance)}")
-                    
-                    if isinstance(instance, str):
-                        # Hantera strängbaserad instans
-                        instance_str = instance.strip('@{}')
-                        instance_parts = instance_str.split('; ')
-                        instance_obj = {}
-                        for part in instance_parts:
-                            key, value = part.split('=', 1)
-                            instance_obj[key] = value
-                        
-                        if instance_obj.get('sop_instance_uid') == sop_instance_uid:
-                            file_path = instance_obj.get('file_path')
-                            logger.info(f"[get_metadata] Hittade fil (från sträng) för SOP UID: {file_path}")
-                            
-                            # Fortsätt med att hantera filen på samma sätt som för dict-instances
-                            if file_path and os.path.exists(file_path):
-                                # Samma kod som används för dict-instances nedan
-                                # För att undvika duplicering, lägg till loggmeddelande
-                                logger.info(f"[get_metadata] Hanterar strängbaserad instans, filen finns")
-                    else:
-                        # Om instance är ett objekt
-                        logger.info(f"[get_metadata] Kontrollerar instansobjekt: {instance.get('sop_instance_uid', 'okänt')}")
-                        
-                        if instance.get('sop_instance_uid') == sop_instance_uid:
-                            file_path = instance.get('file_path')
-                            logger.info(f"[get_metadata] Hittade fil för SOP UID: {file_path}")
-                            
-                            if file_path and os.path.exists(file_path):
-                                logger.info(f"[get_metadata] Filen finns: {os.path.exists(file_path)}")
-                                logger.info(f"[get_metadata] Filstorlek: {os.path.getsize(file_path)} bytes")
-                                
-                                try:
-                                    # Läs DICOM-filen
-                                    ds = pydicom.dcmread(file_path)
-                                    logger.info(f"[get_metadata] Läste DICOM-fil: {file_path}")
-                                    
-                                    # Logga grundläggande DICOM-attribut
-                                    logger.info(f"[get_metadata] DICOM Transfer Syntax: {ds.file_meta.TransferSyntaxUID if hasattr(ds, 'file_meta') else 'Okänd'}")
-                                    logger.info(f"[get_metadata] DICOM Rows: {getattr(ds, 'Rows', 'Saknas')}")
-                                    logger.info(f"[get_metadata] DICOM Columns: {getattr(ds, 'Columns', 'Saknas')}")
-                                    logger.info(f"[get_metadata] DICOM SamplesPerPixel: {getattr(ds, 'SamplesPerPixel', 'Saknas')}")
-                                    logger.info(f"[get_metadata] DICOM PhotometricInterpretation: {getattr(ds, 'PhotometricInterpretation', 'Saknas')}")
-                                    logger.info(f"[get_metadata] DICOM BitsAllocated: {getattr(ds, 'BitsAllocated', 'Saknas')}")
-                                    logger.info(f"[get_metadata] DICOM BitsStored: {getattr(ds, 'BitsStored', 'Saknas')}")
-                                    logger.info(f"[get_metadata] DICOM HighBit: {getattr(ds, 'HighBit', 'Saknas')}")
-                                    logger.info(f"[get_metadata] DICOM PixelRepresentation: {getattr(ds, 'PixelRepresentation', 'Saknas')}")
-                                    
-                                    # Extrahera metadata
-                                    metadata = {
-                                        'studyInstanceUid': study.get('study_instance_uid', study.get('study_uid', '')),
-                                        'seriesInstanceUid': series.get('series_uid', ''),
-                                        'sopInstanceUid': sop_instance_uid,
-                                        'rows': int(ds.get('Rows', 0)),
-                                        'columns': int(ds.get('Columns', 0)),
-                                    }
-                                    
-                                    # Hantera pixel spacing (kan vara MultiValue)
-                                    if hasattr(ds, 'PixelSpacing'):
-                                        try:
-                                            pixel_spacing = [float(x) for x in ds.PixelSpacing]
-                                            metadata['pixelSpacing'] = pixel_spacing
-                                        except Exception as e:
-                                            logger.warning(f"[get_metadata] Kunde inte konvertera PixelSpacing: {e}")
-                                    
-                                    # Hantera slice thickness
-                                    if hasattr(ds, 'SliceThickness'):
-                                        try:
-                                            metadata['sliceThickness'] = float(ds.SliceThickness)
-                                        except Exception as e:
-                                            logger.warning(f"[get_metadata] Kunde inte konvertera SliceThickness: {e}")
-                                    
-                                    # Hantera slice location
-                                    if hasattr(ds, 'SliceLocation'):
-                                        try:
-                                            metadata['sliceLocation'] = float(ds.SliceLocation)
-                                        except Exception as e:
-                                            logger.warning(f"[get_metadata] Kunde inte konvertera SliceLocation: {e}")
-                                    
-                                    # Hantera instance number
-                                    if hasattr(ds, 'InstanceNumber'):
-                                        try:
-                                            metadata['instanceNumber'] = int(ds.InstanceNumber)
-                                        except Exception as e:
-                                            logger.warning(f"[get_metadata] Kunde inte konvertera InstanceNumber: {e}")
-                                            metadata['instanceNumber'] = int(instance.get('instance_number', 0))
-                                    
-                                    # Hantera window center
-                                    if hasattr(ds, 'WindowCenter'):
-                                        try:
-                                            if isinstance(ds.WindowCenter, list) or hasattr(ds.WindowCenter, '__iter__'):
-                                                metadata['windowCenter'] = float(ds.WindowCenter[0])
-                                            else:
-                                                metadata['windowCenter'] = float(ds.WindowCenter)
-                                        except Exception as e:
-                                            logger.warning(f"[get_metadata] Kunde inte konvertera WindowCenter: {e}")
-                                    
-                                    # Hantera window width
-                                    if hasattr(ds, 'WindowWidth'):
-                                        try:
-                                            if isinstance(ds.WindowWidth, list) or hasattr(ds.WindowWidth, '__iter__'):
-                                                metadata['windowWidth'] = float(ds.WindowWidth[0])
-                                            else:
-                                                metadata['windowWidth'] = float(ds.WindowWidth)
-                                        except Exception as e:
-                                            logger.warning(f"[get_metadata] Kunde inte konvertera WindowWidth: {e}")
-                                    
-                                    # Hantera samplesPerPixel (kritiskt för bildvisning)
-                                    if hasattr(ds, 'SamplesPerPixel'):
-                                        try:
-                                            metadata['samplesPerPixel'] = int(ds.SamplesPerPixel)
-                                        except Exception as e:
-                                            logger.warning(f"[get_metadata] Kunde inte konvertera SamplesPerPixel: {e}")
-                                            # Använd 1 som standardvärde (monokrom bild) om det saknas
-                                            metadata['samplesPerPixel'] = 1
-                                    else:
-                                        # För de flesta medicinska bilder är detta 1 (gråskala)
-                                        logger.warning("[get_metadata] SamplesPerPixel saknas, använder standardvärde 1")
-                                        metadata['samplesPerPixel'] = 1
-                                    
-                                    # Hantera photometricInterpretation (viktigt för korrekt bildrendering)
-                                    if hasattr(ds, 'PhotometricInterpretation'):
-                                        metadata['photometricInterpretation'] = str(ds.PhotometricInterpretation).strip()
-                                    
-                                    # Lägg till dessa rader precis innan "return jsonify(metadata)"
-                                    logger.info("\n====== DICOM METADATA DUMP ======")
-                                    for key, value in metadata.items():
-                                        logger.info(f"{key}: {value}")
-                                    logger.info("=================================\n")
-                                    
-                                    return jsonify(metadata)
-                                except Exception as e:
-                                    logger.error(f"[get_metadata] Error reading DICOM file: {e}", exc_info=True)
-                                    return jsonify({'error': f'Error reading DICOM file: {str(e)}'}), 500
-                            else:
-                                logger.error(f"[get_metadata] Fil hittades i DB men finns inte på disk: {file_path}")
-        
-        # Om vi kommer hit har vi inte hittat instansen
-        logger.warning(f"[get_metadata] Instance with SOP UID {sop_instance_uid} not found")
-        return jsonify({'error': f'Instance with SOP UID {sop_instance_uid} not found'}), 404
+        location = instance_index.locate(sop_instance_uid)
+        metadata = ensure_viewer_metadata(location) if location else None
+        if metadata is None:
+            logger.warning(f"[get_metadata] Instance with SOP UID {sop_instance_uid} not found")
+            return jsonify({'error': f'Instance with SOP UID {sop_instance_uid} not found'}), 404
+        return jsonify(viewer_response(location, metadata))
     except Exception as e:
         logger.error(f"[get_metadata] Error getting metadata: {str(e)}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/dicom/series/<series_id>/metadata', methods=['GET'])
+def get_series_metadata(series_id):
+    """Metadata för alla instanser i en serie i instansordning, i en enda förfrågan"""
+    try:
+        instances = instance_index.series_metadata(series_id)
+        if not instances:
+            return jsonify({'error': 'Series not found'}), 404
+
+        metadata = []
+        for instance in instances:
+            viewer = ensure_viewer_metadata(instance)
+            if viewer is not None:
+                metadata.append(viewer_response(instance, viewer))
+        return jsonify(metadata)
+    except Exception as e:
+        logger.error(f"[get_series_metadata] Error getting series metadata: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/dicom/debug/format/<sop_instance_uid>', methods=['GET'])
 def check_dicom_format(sop_instance_uid):
     """Kontrollerar formatet på en DICOM-fil"""
     try:
         # Hitta filen
-        file_path = None
-        for study in db.studies.find({}, {'_id': 0}):
-            for series in study.get('series', []):
-                for instance in series.get('instances', []):
-                    instance_uid = None
-                    if isinstance(instance, str):
-                        instance_str = instance.strip('@{}')
-                        instance_parts = instance_str.split('; ')
-                        instance_obj = {}
-                        for part in instance_parts:
-                            key, value = part.split('=', 1)
-                            instance_obj[key] = value
-                        instance_uid = instance_obj.get('sop_instance_uid')
-                        if instance_uid == sop_instance_uid:
-                            file_path = instance_obj.get('file_path')
-                            break
-                    else:
-                        if instance.get('sop_instance_uid') == sop_instance_uid:
-                            file_path = instance.get('file_path')
-                            break
-        
-        if not file_path or not os.path.exists(file_path):
+        location = locate_instance_file(sop_instance_uid)
+        if not location:
             return jsonify({"error": "File not found"}), 404
-            
+        file_path = location['file_path']
+
         # Läs DICOM-filen
-        ds = pydicom.dcmread(file_path)
+        with open_locator(file_path) as f:
+            ds = pydicom.dcmread(f)
         
         # Samla grundläggande information
         info = {
             "file_exists": True,
-            "file_size_bytes": os.path.getsize(file_path),
+            "file_size_bytes": locator_size(file_path),
             "rows": int(ds.get('Rows', 0)),
             "columns": int(ds.get('Columns', 0)),
             "pixel_data_exists": 'PixelData' in ds,
@@ -689,27 +896,22 @@ def debug_dicom_file(sop_instance_uid):
         logger.info(f"[debug_dicom_file] Debugging SOP UID: {sop_instance_uid}")
         
         # Hitta filen i databasen
-        file_path = None
-        for study in db.studies.find():
-            for series in study.get('series', []):
-                for instance in series.get('instances', []):
-                    if isinstance(instance, dict) and instance.get('sop_instance_uid') == sop_instance_uid:
-                        file_path = instance.get('file_path')
-                        break
-        
-        if not file_path or not os.path.exists(file_path):
+        location = locate_instance_file(sop_instance_uid)
+        if not location:
             return jsonify({"error": "File not found"}), 404
+        file_path = location['file_path']
             
         # Öppna och analysera DICOM-filen
-        ds = pydicom.dcmread(file_path)
+        with open_locator(file_path) as f:
+            ds = pydicom.dcmread(f)
         
         # Samla in detaljerad information
         debug_info = {
             "file_info": {
                 "path": file_path,
-                "exists": os.path.exists(file_path),
-                "size_bytes": os.path.getsize(file_path),
-                "last_modified": datetime.fromtimestamp(os.path.getmtime(file_path)).isoformat()
+                "exists": locator_exists(file_path),
+                "size_bytes": locator_size(file_path),
+                "last_modified": datetime.fromtimestamp(os.path.getmtime(split_locator(file_path)[0])).isoformat()
             },
             "dicom_general": {
                 "sop_instance_uid": sop_instance_uid,
@@ -746,6 +948,292 @@ def debug_dicom_file(sop_instance_uid):
         logger.error(f"Error debugging DICOM file: {str(e)}", exc_info=True)
         return jsonify({"error": str(e)}), 500
 
+# DICOMweb: QIDO-RS-sökning och WADO-RS-hämtning ovanpå instansindexet
+
+# QIDO-attribut -> dokumentfält i studies, flera fält för äldre och SCP-inlästa studier
+STUDY_QUERY_FIELDS = {
+    'StudyInstanceUID': ('study_instance_uid',),
+    'PatientID': ('patient_id',),
+    'AccessionNumber': ('accession_number',),
+    'ModalitiesInStudy': ('modalities',),
+    'StudyDescription': ('description', 'study_description')
+}
+SERIES_QUERY_FIELDS = {
+    'SeriesInstanceUID': ('series_uid',),
+    'Modality': ('modality',),
+    'SeriesNumber': ('series_number',),
+    'SeriesDescription': ('description', 'series_description')
+}
+INSTANCE_QUERY_FIELDS = {
+    'SOPInstanceUID': 'sop_instance_uid',
+    'SOPClassUID': 'sop_class_uid',
+    'InstanceNumber': 'instance_number'
+}
+# Fragmentlistan behövs inte i metadata och kan vara stor för multiframe
+DICOMWEB_INSTANCE_PROJECTION = {'_id': 0, 'frame_index.frames': 0}
+
+def qido_params():
+    """QIDO-filter som {keyword: värde} samt limit och offset"""
+    filters = {
+        query_keyword(name): value for name, value in request.args.items()
+        if name not in ('limit', 'offset', 'includefield', 'fuzzymatching') and value
+    }
+    limit = min(query_int('limit', request.args.get('limit', QIDO_DEFAULT_LIMIT), minimum=1), QIDO_DEFAULT_LIMIT)
+    return filters, limit, query_int('offset', request.args.get('offset', 0))
+
+def dicomweb_url(*parts):
+    return '/'.join([request.host_url.rstrip('/') + DICOMWEB_ROOT, *parts])
+
+def dicom_json_response(items):
+    return Response(json.dumps(items), mimetype=DICOM_JSON)
+
+def study_query(filters):
+    """Mongo-fråga för studienivåns QIDO-filter"""
+    conditions = []
+    for keyword, fields in STUDY_QUERY_FIELDS.items():
+        if keyword in filters:
+            condition = match_value(filters[keyword], uid=keyword.endswith('UID'))
+            conditions.append({'$or': [{field: condition} for field in fields]})
+    if 'StudyDate' in filters:
+        conditions.append(match_date('study_date', filters['StudyDate']))
+    if 'PatientName' in filters:
+        condition = match_value(filters['PatientName'])
+        patient_ids = db.patients.distinct('patient_id', {'$or': [{'name': condition}, {'patient_name': condition}]})
+        conditions.append({'patient_id': {'$in': patient_ids}})
+    return {'$and': conditions} if conditions else {}
+
+def study_series(study):
+    """Serierna i en studie, både inbäddade och de som bara finns i series-collection"""
+    series_list = list(study.get('series', []))
+    known = {series.get('series_uid') for series in series_list}
+    for series in db.series.find({'study_instance_uid': study['study_instance_uid']}, {'_id': 0}):
+        if series['series_uid'] not in known:
+            series_list.append(series)
+    return series_list
+
+def series_condition(filters):
+    """Mongo-villkor för ett serieelement, gäller både studiens series-array och series-collection"""
+    condition = {}
+    for keyword, fields in SERIES_QUERY_FIELDS.items():
+        if keyword not in filters:
+            continue
+        if keyword == 'SeriesNumber':
+            # Serienummer är heltal i studier och text i series-collection
+            numbers = match_numbers(keyword, filters[keyword])
+            value = {'$in': numbers + [str(number) for number in numbers]}
+        else:
+            value = match_value(filters[keyword], uid=keyword.endswith('UID'))
+        if len(fields) == 1:
+            condition[fields[0]] = value
+        else:
+            condition.setdefault('$and', []).append({'$or': [{field: value} for field in fields]})
+    return condition
+
+def series_study_query(filters):
+    """Studier med minst en serie som matchar, så att inte alla studier behöver läsas"""
+    query = study_query(filters)
+    condition = series_condition(filters)
+    if not condition:
+        return query
+    # Serier som bara finns i series-collection hittas via deras studie-UID
+    series_filter = {'series': {'$elemMatch': condition}}
+    study_uids = db.series.distinct('study_instance_uid', condition)
+    if study_uids:
+        series_filter = {'$or': [series_filter, {'study_instance_uid': {'$in': study_uids}}]}
+    return {'$and': [query, series_filter]} if query else series_filter
+
+def series_match(series, filters):
+    for keyword, fields in SERIES_QUERY_FIELDS.items():
+        if keyword not in filters:
+            continue
+        if keyword == 'SeriesNumber':
+            try:
+                matched = int(series.get('series_number') or 0) in match_numbers(keyword, filters[keyword])
+            except ValueError:
+                matched = False
+        else:
+            matched = any(
+                value_matches(filters[keyword], series.get(field), uid=keyword.endswith('UID')) for field in fields
+            )
+        if not matched:
+            return False
+    return True
+
+@app.route(f'{DICOMWEB_ROOT}/studies', methods=['GET'])
+def qido_studies():
+    """QIDO-RS: sök studier"""
+    try:
+        filters, limit, offset = qido_params()
+        studies = list(db.studies.find(study_query(filters), {'_id': 0, 'series': 0}).skip(offset).limit(limit))
+        patients = {
+            patient['patient_id']: patient
+            for patient in db.patients.find({'patient_id': {'$in': [s.get('patient_id') for s in studies]}}, {'_id': 0})
+        }
+        return dicom_json_response([
+            study_attributes(study, patients.get(study.get('patient_id')), dicomweb_url('studies', study['study_instance_uid']))
+            for study in studies
+        ])
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"QIDO studies error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route(f'{DICOMWEB_ROOT}/series', methods=['GET'])
+@app.route(f'{DICOMWEB_ROOT}/studies/<study_uid>/series', methods=['GET'])
+def qido_series(study_uid=None):
+    """QIDO-RS: sök serier, i en studie eller i alla"""
+    try:
+        filters, limit, offset = qido_params()
+        if study_uid:
+            filters['StudyInstanceUID'] = study_uid
+        results = []
+        for study in db.studies.find(series_study_query(filters), {'_id': 0}):
+            for series in study_series(study):
+                if not series_match(series, filters):
+                    continue
+                if offset:
+                    offset -= 1
+                    continue
+                url = dicomweb_url('studies', study['study_instance_uid'], 'series', series['series_uid'])
+                results.append(series_attributes(study['study_instance_uid'], series, url))
+                if len(results) >= limit:
+                    return dicom_json_response(results)
+        return dicom_json_response(results)
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"QIDO series error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route(f'{DICOMWEB_ROOT}/instances', methods=['GET'])
+@app.route(f'{DICOMWEB_ROOT}/studies/<study_uid>/instances', methods=['GET'])
+@app.route(f'{DICOMWEB_ROOT}/studies/<study_uid>/series/<series_uid>/instances', methods=['GET'])
+def qido_instances(study_uid=None, series_uid=None):
+    """QIDO-RS: sök instanser direkt i instances-collection"""
+    try:
+        filters, limit, offset = qido_params()
+        query = {}
+        study_uid = study_uid or filters.get('StudyInstanceUID')
+        series_uid = series_uid or filters.get('SeriesInstanceUID')
+        if study_uid:
+            query['study_instance_uid'] = match_value(study_uid, uid=True)
+        if series_uid:
+            query['series_uid'] = match_value(series_uid, uid=True)
+        for keyword, field in INSTANCE_QUERY_FIELDS.items():
+            if keyword not in filters:
+                continue
+            if field == 'instance_number':
+                # Instansnummer lagras som heltal, jokertecken stöds inte
+                query[field] = {'$in': match_numbers(keyword, filters[keyword])}
+            else:
+                query[field] = match_value(filters[keyword], uid=keyword.endswith('UID'))
+
+        instances = db.instances.find(query, DICOMWEB_INSTANCE_PROJECTION) \
+            .sort([('series_uid', 1), ('instance_number', 1)]).skip(offset).limit(limit)
+        return dicom_json_response([
+            instance_attributes(instance, dicomweb_url(
+                'studies', instance.get('study_instance_uid', ''), 'series', instance.get('series_uid', ''),
+                'instances', instance['sop_instance_uid']
+            ))
+            for instance in instances
+        ])
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"QIDO instances error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def wado_query(study_uid, series_uid=None, sop_uid=None):
+    query = {'study_instance_uid': study_uid}
+    if series_uid:
+        query['series_uid'] = series_uid
+    if sop_uid:
+        query['sop_instance_uid'] = sop_uid
+    return query
+
+@app.route(f'{DICOMWEB_ROOT}/studies/<study_uid>', methods=['GET'])
+@app.route(f'{DICOMWEB_ROOT}/studies/<study_uid>/series/<series_uid>', methods=['GET'])
+@app.route(f'{DICOMWEB_ROOT}/studies/<study_uid>/series/<series_uid>/instances/<sop_uid>', methods=['GET'])
+def wado_retrieve(study_uid, series_uid=None, sop_uid=None):
+    """WADO-RS: hela studier, serier eller instanser i ett strömmat multipart/related-svar"""
+    try:
+        instances = list(db.instances.find(
+            wado_query(study_uid, series_uid, sop_uid),
+            {'_id': 0, 'sop_instance_uid': 1, 'file_path': 1}
+        ).sort([('series_uid', 1), ('instance_number', 1)]))
+        if not instances:
+            return jsonify({'error': 'Not found'}), 404
+
+        # Filerna läses i bitar först när respektive del skickas
+        boundary = multipart_boundary()
+        return Response(
+            multipart_related(instance_parts(instances), boundary),
+            content_type=f'multipart/related; type="application/dicom"; boundary={boundary}'
+        )
+    except Exception as e:
+        logger.error(f"WADO-RS retrieve error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route(f'{DICOMWEB_ROOT}/studies/<study_uid>/metadata', methods=['GET'])
+@app.route(f'{DICOMWEB_ROOT}/studies/<study_uid>/series/<series_uid>/metadata', methods=['GET'])
+@app.route(f'{DICOMWEB_ROOT}/studies/<study_uid>/series/<series_uid>/instances/<sop_uid>/metadata', methods=['GET'])
+def wado_metadata(study_uid, series_uid=None, sop_uid=None):
+    """WADO-RS metadata från indexet, utan att öppna några filer"""
+    try:
+        instances = list(db.instances.find(
+            wado_query(study_uid, series_uid, sop_uid), DICOMWEB_INSTANCE_PROJECTION
+        ).sort([('series_uid', 1), ('instance_number', 1)]))
+        if not instances:
+            return jsonify({'error': 'Not found'}), 404
+        return dicom_json_response([instance_attributes(instance) for instance in instances])
+    except Exception as e:
+        logger.error(f"WADO-RS metadata error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def frame_part(location, frame_number):
+    """(content type, chunks) för en bildruta, från minnesmappen eller via pydicom"""
+    frame_index = location.get('frame_index')
+    if frame_index:
+        media_type = frame_media_type(frame_index)
+        if media_type == 'application/octet-stream':
+            media_type = f"{media_type}; transfer-syntax={frame_index['transfer_syntax_uid']}"
+        fragments = frame_index['frames'][frame_number - 1]
+        return media_type, iter([frame_reader.read(location['file_path'], fragments)])
+    body, media_type = parse_frame(location['file_path'], frame_number)
+    return media_type, iter([body])
+
+@app.route(f'{DICOMWEB_ROOT}/studies/<study_uid>/series/<series_uid>/instances/<sop_uid>/frames/<frame_list>', methods=['GET'])
+def wado_frames(study_uid, series_uid, sop_uid, frame_list):
+    """WADO-RS: en eller flera bildrutor (1-baserade, kommaseparerade) som multipart/related"""
+    try:
+        location = locate_instance_file(sop_uid)
+        if not location or location.get('series_uid') != series_uid:
+            return jsonify({'error': 'Not found'}), 404
+        try:
+            frame_numbers = [int(number) for number in frame_list.split(',')]
+        except ValueError:
+            return jsonify({'error': 'frame numbers must be integers'}), 400
+
+        if location.get('frame_index'):
+            if not all(1 <= number <= len(location['frame_index']['frames']) for number in frame_numbers):
+                return jsonify({'error': 'Frame not found'}), 404
+            parts = (frame_part(location, number) for number in frame_numbers)
+        else:
+            # Utan index parsas rutorna direkt, så ogiltiga nummer ger 404 innan svaret börjar
+            parts = [frame_part(location, number) for number in frame_numbers]
+
+        boundary = multipart_boundary()
+        return Response(
+            multipart_related(parts, boundary),
+            content_type=f'multipart/related; type="application/octet-stream"; boundary={boundary}'
+        )
+    except IndexError:
+        return jsonify({'error': 'Frame not found'}), 404
+    except Exception as e:
+        logger.error(f"WADO-RS frames error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 if __name__ == '__main__':
     print("\nStarting Flask server...")
     print("\nRegistered Routes:")
@@ -0,0 +1,85 @@
+"""
+Benchmark full reads against the header-only scan used during ingestion.
+
+Usage (from services/imaging_data):
+    python -m benchmarks.header_scan /data/dicom/some_study
+
+Reports files/sec and bytes actually read from disk for both modes.
+"""
+import os
+import sys
+import time
+import pydicom
+from parsers.base_parser import BaseParser
+
+
+class CountingFile:
+    """File wrapper that counts the bytes pydicom reads"""
+
+    def __init__(self, path):
+        self._fp = open(path, 'rb')
+        self.name = path
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._fp.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        return self._fp.seek(offset, whence)
+
+    def tell(self):
+        return self._fp.tell()
+
+    def close(self):
+        self._fp.close()
+
+
+def run(file_paths, read):
+    bytes_read = 0
+    start = time.perf_counter()
+    for file_path in file_paths:
+        fp = CountingFile(file_path)
+        try:
+            read(fp)
+        except Exception:
+            pass
+        finally:
+            bytes_read += fp.bytes_read
+            fp.close()
+    return time.perf_counter() - start, bytes_read
+
+
+def main(folder_path):
+    file_paths = [
+        os.path.join(root, file)
+        for root, _, files in os.walk(folder_path)
+        for file in files
+    ]
+    if not file_paths:
+        print(f"No files found in {folder_path}")
+        return
+
+    parser = BaseParser(None)
+    modes = {
+        'full': lambda fp: pydicom.dcmread(fp, force=True),
+        'header_only': parser._read_header
+    }
+
+    total_bytes = sum(os.path.getsize(p) for p in file_paths)
+    print(f"{len(file_paths)} files, {total_bytes / 1e6:.1f} MB on disk")
+    for name, read in modes.items():
+        elapsed, bytes_read = run(file_paths, read)
+        print(
+            f"{name:>12}: {len(file_paths) / elapsed:10.1f} files/sec  "
+            f"{bytes_read / 1e6:10.1f} MB read "
+            f"({100 * bytes_read / max(total_bytes, 1):.1f}% of disk size)"
+        )
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+    main(sys.argv[1])
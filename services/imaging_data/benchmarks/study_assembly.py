@@ -0,0 +1,69 @@
+"""
+Micro-benchmark for grouping parsed results into study documents.
+
+Usage (from services/imaging_data):
+    python -m benchmarks.study_assembly
+
+Builds synthetic single-series studies and compares the previous list scan
+dedupe with the indexed FolderParser._group_results.
+"""
+import time
+from parsers.folder_parser import FolderParser
+
+SERIES_SIZES = [1000, 2500, 5000, 10000]
+
+
+def synthetic_results(num_instances):
+    return [
+        {
+            'patient': {'patient_id': 'PID_BENCH', 'studies': []},
+            'study': {
+                'study_instance_uid': '1.2.3',
+                'series': [],
+                'modalities': set(),
+                'num_series': 0,
+                'num_instances': 0
+            },
+            'series': {'series_uid': '1.2.3.4', 'modality': 'MR', 'instances': []},
+            'instance': {'sop_instance_uid': f'1.2.3.4.{i}', 'instance_number': i}
+        }
+        for i in range(num_instances)
+    ]
+
+
+def group_with_list_scan(results):
+    """The grouping loop as it was before the indexes were introduced"""
+    studies = {}
+    for result in results:
+        study, series, instance = result['study'], result['series'], result['instance']
+        current_study = studies.setdefault(study['study_instance_uid'], study)
+        existing_series = next(
+            (s for s in current_study['series'] if s['series_uid'] == series['series_uid']),
+            None
+        )
+        if not existing_series:
+            current_study['series'].append(series)
+            existing_series = series
+        if not any(i['sop_instance_uid'] == instance['sop_instance_uid'] for i in existing_series['instances']):
+            existing_series['instances'].append(instance)
+    return studies
+
+
+def timed(group, num_instances):
+    results = synthetic_results(num_instances)
+    start = time.perf_counter()
+    group(results)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = FolderParser(None)
+    print(f"{'instances':>10} {'list scan (s)':>14} {'indexed (s)':>12} {'indexed us/inst':>16}")
+    for size in SERIES_SIZES:
+        legacy = timed(group_with_list_scan, size)
+        indexed = timed(parser._group_results, size)
+        print(f"{size:>10} {legacy:>14.3f} {indexed:>12.4f} {1e6 * indexed / size:>16.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark volume assembly across transfer syntaxes and decode modes.
+
+Usage (from services/imaging_data):
+    python -m benchmarks.volume_decode [slices] [size] [workers]
+
+Writes a synthetic series per transfer syntax to a temporary directory and
+times assemble_volume serially, with a thread pool and with a process
+pool. JPEG-LS and JPEG 2000 need their encoders (pyjpegls,
+pylibjpeg-openjpeg) and decoders (pylibjpeg-libjpeg, pylibjpeg-openjpeg)
+installed and are skipped otherwise.
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.uid import (
+    ExplicitVRLittleEndian, RLELossless, JPEGLSLossless, JPEG2000Lossless, generate_uid
+)
+from utils.volume import assemble_volume
+
+DEFAULT_SLICES = 200
+DEFAULT_SIZE = 512
+
+
+def synthetic_slice(size, index):
+    """Smooth gradient plus noise, compresses roughly like real MR/CT"""
+    y, x = np.mgrid[0:size, 0:size]
+    image = 1000 + 800 * np.sin(x / 40.0 + index / 10.0) * np.cos(y / 55.0)
+    image += np.random.normal(0, 20, (size, size))
+    return np.clip(image, 0, 4095).astype(np.uint16)
+
+
+def encode_jpegls(pixels):
+    import jpeg_ls
+    return encapsulate([bytes(jpeg_ls.encode(pixels))])
+
+
+def encode_j2k(pixels):
+    import openjpeg
+    return encapsulate([openjpeg.encode(pixels, bits_stored=12)])
+
+
+def write_series(folder, transfer_syntax, slices, size):
+    series_uid = generate_uid()
+    file_paths = []
+    for index in range(slices):
+        pixels = synthetic_slice(size, index)
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = FileDataset(None, {}, file_meta=meta, preamble=b'\0' * 128)
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.SOPClassUID = meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.SeriesInstanceUID = series_uid
+        ds.InstanceNumber = index + 1
+        ds.Rows = ds.Columns = size
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 12
+        ds.HighBit = 11
+        ds.PixelRepresentation = 0
+        ds.PixelData = pixels.tobytes()
+
+        if transfer_syntax == RLELossless:
+            ds.compress(RLELossless)
+        elif transfer_syntax in (JPEGLSLossless, JPEG2000Lossless):
+            encode = encode_jpegls if transfer_syntax == JPEGLSLossless else encode_j2k
+            ds.PixelData = encode(pixels)
+            ds['PixelData'].is_undefined_length = True
+            ds['PixelData'].VR = 'OB'
+            ds.file_meta.TransferSyntaxUID = transfer_syntax
+
+        file_path = os.path.join(folder, f"{index:04d}.dcm")
+        ds.save_as(file_path, write_like_original=False)
+        file_paths.append(file_path)
+    return [{'file_path': path, 'instance_number': i + 1} for i, path in enumerate(file_paths)]
+
+
+def timed(instances, workers, mode, repeats=2):
+    """Best of a few runs, so pool start-up and cold caches are not counted"""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        volume, _ = assemble_volume(instances, workers=workers, mode=mode)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, volume
+
+
+def main(slices, size, workers):
+    syntaxes = [
+        ('Explicit VR LE', ExplicitVRLittleEndian),
+        ('RLE Lossless', RLELossless),
+        ('JPEG-LS Lossless', JPEGLSLossless),
+        ('JPEG 2000 Lossless', JPEG2000Lossless),
+    ]
+    print(f"{slices} slices of {size}x{size}, {workers} workers, {os.cpu_count()} CPUs")
+    print(f"{'transfer syntax':>20} {'serial (sl/s)':>14} {'threads (sl/s)':>15} {'processes (sl/s)':>17}")
+    with tempfile.TemporaryDirectory() as root:
+        for name, transfer_syntax in syntaxes:
+            folder = os.path.join(root, name.replace(' ', '_'))
+            os.makedirs(folder)
+            try:
+                instances = write_series(folder, transfer_syntax, slices, size)
+                serial, reference = timed(instances, 1, 'thread')
+            except Exception as e:
+                print(f"{name:>20} skipped: {e}")
+                continue
+            threads, volume = timed(instances, workers, 'thread')
+            assert np.array_equal(volume, reference)
+            processes, volume = timed(instances, workers, 'process')
+            assert np.array_equal(volume, reference)
+            print(f"{name:>20} {slices / serial:>14.0f} {slices / threads:>15.0f} {slices / processes:>17.0f}")
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SLICES,
+        int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_SIZE,
+        int(sys.argv[3]) if len(sys.argv) > 3 else min(8, os.cpu_count() or 1)
+    )
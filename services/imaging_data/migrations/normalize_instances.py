@@ -0,0 +1,71 @@
+"""
+Move instances embedded in study documents to the instances collection.
+
+Usage (from services/imaging_data):
+    python -m migrations.normalize_instances [--dry-run] [--batch-size 200]
+
+Both dict instances and legacy "@{key=value; ...}" strings are converted.
+Each batch of studies is written in two steps: the instance upserts first,
+then the studies with their embedded instances removed and per-series
+counts set, so an interrupted run can simply be started again. Studies
+with an instance upsert that failed keep their embedded instances and are
+retried on the next run.
+"""
+import os
+import argparse
+import logging
+from pymongo import MongoClient
+from utils.mongo_utils import BulkWriter, init_mongo_indexes
+from utils.legacy_instances import normalize_studies
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 200
+
+
+def migrate(db, batch_size=DEFAULT_BATCH_SIZE, dry_run=False):
+    """Normalize every study that still has embedded instances, returns counters"""
+    stats = {'studies': 0, 'instances': 0, 'legacy_strings': 0, 'failed_studies': 0}
+    bulk = BulkWriter()
+    batch = []
+
+    for study in db.studies.find({'series.instances.0': {'$exists': True}}):
+        stats['legacy_strings'] += sum(
+            isinstance(i, str) for s in study.get('series', []) for i in s.get('instances', [])
+        )
+        batch.append(study)
+        if len(batch) >= batch_size:
+            _migrate_batch(db, bulk, batch, stats, dry_run)
+            batch = []
+    if batch:
+        _migrate_batch(db, bulk, batch, stats, dry_run)
+    return stats
+
+
+def _migrate_batch(db, bulk, studies, stats, dry_run):
+    for key, value in normalize_studies(db, bulk, studies, dry_run).items():
+        stats[key] += value
+    if not dry_run:
+        logger.info(f"Migrated {stats['studies']} studies, {stats['instances']} instances so far")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uri', default=os.environ.get('MONGODB_URI', 'mongodb://127.0.0.1:27017'))
+    parser.add_argument('--database', default='neuro_platform')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--dry-run', action='store_true', help='count what would be migrated without writing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db = MongoClient(args.uri)[args.database]
+    init_mongo_indexes(db)
+    stats = migrate(db, batch_size=args.batch_size, dry_run=args.dry_run)
+    print(f"{'Would migrate' if args.dry_run else 'Migrated'} {stats['studies']} studies, "
+          f"{stats['instances']} instances ({stats['legacy_strings']} legacy strings)")
+    if stats['failed_studies']:
+        print(f"{stats['failed_studies']} studies kept their embedded instances after failed writes, run again to retry")
+
+
+if __name__ == '__main__':
+    main()
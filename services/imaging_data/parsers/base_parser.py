@@ -1,7 +1,12 @@
 import os
 import logging
+import pydicom
+from pydicom.tag import Tag
 from utils.dicom_config import DicomConfig
-from utils.mongo_utils import get_or_create_document
+from utils.mongo_utils import BulkWriter
+from utils.viewer_metadata import extract_viewer_metadata, viewer_keywords
+from utils.frame_index import build_frame_index
+from utils.archives import locator_identity
 
 logger = logging.getLogger(__name__)
 
@@ -9,6 +14,23 @@ class BaseParser:
     def __init__(self, db):
         self.db = db
         self.config = DicomConfig()
+        # Resolved once, pydicom would otherwise look up each keyword per file
+        keywords = dict.fromkeys(self.config.get_keywords() + viewer_keywords())
+        self.header_tags = [Tag(keyword) for keyword in keywords]
+        self.bulk = BulkWriter()
+
+    def _read_header(self, file_path):
+        """Read only the configured tags, stopping before PixelData.
+
+        Elements that are not configured are skipped by seeking past their
+        value, so pixel payload is never read from disk during indexing.
+        """
+        return pydicom.dcmread(
+            file_path,
+            force=True,
+            stop_before_pixels=True,
+            specific_tags=self.header_tags
+        )
     
     def _get_tag_value(self, dataset, tag_config):
         """Get DICOM tag value with proper error handling"""
@@ -31,86 +53,54 @@ class BaseParser:
             logger.error(f"Error getting tag {tag_config.name}: {str(e)}")
             return None
 
-    def _get_or_create_patient(self, dataset):
-        """Create or update patient document"""
-        patient_data = {
-            'patient_id': self._get_tag_value(dataset, self.config.get_tag('patient', 'id')),
-            'patient_name': self._get_tag_value(dataset, self.config.get_tag('patient', 'name')),
-            'birth_date': self._get_tag_value(dataset, self.config.get_tag('patient', 'birth_date')),
-            'sex': self._get_tag_value(dataset, self.config.get_tag('patient', 'sex')),
-            'weight': self._get_tag_value(dataset, self.config.get_tag('patient', 'weight')),
-            'age': self._get_tag_value(dataset, self.config.get_tag('patient', 'age'))
-        }
-        
-        logger.debug(f"[_get_or_create_patient] Creating/updating patient with data: {patient_data}")
-        
-        # Validate required fields
-        required_tags = self.config.get_required_tags('patient')
-        for tag in required_tags:
-            if not patient_data[tag.name.lower()]:
-                raise ValueError(f"Required patient tag {tag.name} is missing")
-        
-        patient_doc = get_or_create_document(
-            self.db.patients,
-            {'patient_id': patient_data['patient_id']},
-            patient_data
-        )
-        logger.debug(f"[_get_or_create_patient] Patient document returned: {patient_doc}")
-        return patient_doc
-
-    def _get_or_create_study(self, dataset, patient_id):
-        """Create or update study document"""
-        study_data = {
-            'study_instance_uid': self._get_tag_value(dataset, self.config.get_tag('study', 'uid')),
-            'patient_id': patient_id,
-            'study_date': self._get_tag_value(dataset, self.config.get_tag('study', 'date')),
-            'study_time': self._get_tag_value(dataset, self.config.get_tag('study', 'time')),
-            'study_description': self._get_tag_value(dataset, self.config.get_tag('study', 'description'))
-        }
-
-        logger.debug(f"[_get_or_create_study] Creating/updating study with data: {study_data}")
-
-        # Validate required fields
-        required_tags = self.config.get_required_tags('study')
-        for tag in required_tags:
-            if not study_data[tag.name.lower()]:
-                raise ValueError(f"Required study tag {tag.name} is missing")
+    # Document field -> DicomConfig tag key, per level
+    PATIENT_FIELDS = {
+        'patient_id': 'id',
+        'patient_name': 'name',
+        'birth_date': 'birth_date',
+        'sex': 'sex',
+        'weight': 'weight',
+        'age': 'age'
+    }
+    STUDY_FIELDS = {
+        'study_instance_uid': 'uid',
+        'study_date': 'date',
+        'study_time': 'time',
+        'study_description': 'description'
+    }
+    SERIES_FIELDS = {
+        'series_uid': 'uid',
+        'series_number': 'number',
+        'series_description': 'description',
+        'modality': 'modality',
+        'body_part': 'body_part',
+        'protocol_name': 'protocol_name'
+    }
 
-        study_doc = get_or_create_document(
-            self.db.studies,
-            {'study_instance_uid': study_data['study_instance_uid']},
-            study_data
-        )
-        logger.debug(f"[_get_or_create_study] Study document returned: {study_doc}")
-        return study_doc
-
-    def _get_or_create_series(self, dataset, study_instance_uid):
-        """Create or update series document"""
-        series_data = {
-            'series_uid': self._get_tag_value(dataset, self.config.get_tag('series', 'uid')),
-            'study_instance_uid': study_instance_uid,
-            'series_number': self._get_tag_value(dataset, self.config.get_tag('series', 'number')),
-            'series_description': self._get_tag_value(dataset, self.config.get_tag('series', 'description')),
-            'modality': self._get_tag_value(dataset, self.config.get_tag('series', 'modality')),
-            'body_part': self._get_tag_value(dataset, self.config.get_tag('series', 'body_part')),
-            'protocol_name': self._get_tag_value(dataset, self.config.get_tag('series', 'protocol_name'))
+    def _extract_fields(self, dataset, level, fields):
+        """Extract document fields for a level and validate required tags"""
+        data = {
+            field: self._get_tag_value(dataset, self.config.get_tag(level, key))
+            for field, key in fields.items()
         }
+        for field, key in fields.items():
+            tag = self.config.get_tag(level, key)
+            if tag.required and not data[field]:
+                raise ValueError(f"Required {level} tag {tag.name} is missing")
+        return data
 
-        logger.debug(f"[_get_or_create_series] Creating/updating series with data: {series_data}")
+    def _patient_data(self, dataset):
+        return self._extract_fields(dataset, 'patient', self.PATIENT_FIELDS)
 
-        # Validate required fields
-        required_tags = self.config.get_required_tags('series')
-        for tag in required_tags:
-            if not series_data[tag.name.lower()]:
-                raise ValueError(f"Required series tag {tag.name} is missing")
+    def _study_data(self, dataset, patient_id):
+        data = self._extract_fields(dataset, 'study', self.STUDY_FIELDS)
+        data['patient_id'] = patient_id
+        return data
 
-        series_doc = get_or_create_document(
-            self.db.series,
-            {'series_uid': series_data['series_uid']},
-            series_data
-        )
-        logger.debug(f"[_get_or_create_series] Series document returned: {series_doc}")
-        return series_doc
+    def _series_data(self, dataset, study_instance_uid):
+        data = self._extract_fields(dataset, 'series', self.SERIES_FIELDS)
+        data['study_instance_uid'] = study_instance_uid
+        return data
 
     def _get_relative_path(self, full_path: str) -> str:
         """Convert absolute path to relative path from DICOM_BASE_DIR"""
@@ -137,32 +127,67 @@ class BaseParser:
             logger.error(f"Error converting path {full_path}: {str(e)}")
             return full_path
 
-    def _get_or_create_instance(self, dataset, series_uid, file_path):
-        """Create or update instance document with both paths"""
-        try:
-            # Store both absolute and relative paths
-            absolute_path = os.path.abspath(file_path)
-            relative_path = os.path.relpath(
-                absolute_path, 
-                os.environ.get('DICOM_BASE_DIR', '/data/dicom')
-            )
-
-            instance_data = {
-                'sop_instance_uid': self._get_tag_value(dataset, self.config.get_tag('instance', 'uid')),
-                'series_uid': series_uid,
-                'instance_number': int(self._get_tag_value(dataset, self.config.get_tag('instance', 'number')) or 0),
-                'file_path': absolute_path,  # Store absolute path
-                'relative_path': relative_path,  # Store relative path
-                'rows': int(self._get_tag_value(dataset, self.config.get_tag('instance', 'rows')) or 0),
-                'columns': int(self._get_tag_value(dataset, self.config.get_tag('instance', 'columns')) or 0),
-                'pixel_spacing': self._get_tag_value(dataset, self.config.get_tag('instance', 'pixel_spacing'))
-            }
-
-            return get_or_create_document(
-                self.db.instances,
-                {'sop_instance_uid': instance_data['sop_instance_uid']},
-                instance_data
-            )
-        except Exception as e:
-            logger.error(f"Error creating instance document: {str(e)}")
-            raise 
\ No newline at end of file
+    def _instance_data(self, dataset, series_uid, file_path):
+        """Build the instance document with both absolute and relative paths"""
+        absolute_path = os.path.abspath(file_path)
+        relative_path = os.path.relpath(
+            absolute_path,
+            os.environ.get('DICOM_BASE_DIR', '/data/dicom')
+        )
+
+        return {
+            'sop_instance_uid': self._get_tag_value(dataset, self.config.get_tag('instance', 'uid')),
+            'series_uid': series_uid,
+            'sop_class_uid': self._get_tag_value(dataset, self.config.get_tag('instance', 'class_uid')),
+            'instance_number': int(self._get_tag_value(dataset, self.config.get_tag('instance', 'number')) or 0),
+            'file_path': absolute_path,  # Store absolute path
+            'relative_path': relative_path,  # Store relative path
+            'rows': int(self._get_tag_value(dataset, self.config.get_tag('instance', 'rows')) or 0),
+            'columns': int(self._get_tag_value(dataset, self.config.get_tag('instance', 'columns')) or 0),
+            'pixel_spacing': self._get_tag_value(dataset, self.config.get_tag('instance', 'pixel_spacing')),
+            # Size and mtime the cached locations are checked against
+            'file_identity': locator_identity(file_path),
+            'viewer_metadata': extract_viewer_metadata(dataset)
+        }
+
+    def index_dataset(self, dataset, file_path):
+        """Queue patient, study, series and instance upserts for one dataset.
+
+        This is the parsers' single persistence path: writes are buffered in
+        self.bulk and sent in unordered batches; call flush() once the
+        datasets have been queued. Patients, studies
+        and series use $setOnInsert to keep get-or-create semantics, the
+        instance record is refreshed so moved files get their new path.
+        The study also lists a summary of each series, in the same shape
+        folder imports store, since the study routes read study['series'].
+        """
+        patient = self._patient_data(dataset)
+        study = self._study_data(dataset, patient['patient_id'])
+        series = self._series_data(dataset, study['study_instance_uid'])
+        instance = self._instance_data(dataset, series['series_uid'], file_path)
+        instance['study_instance_uid'] = study['study_instance_uid']
+        instance['frame_index'] = build_frame_index(file_path)
+
+        self.bulk.upsert(self.db.patients, {'patient_id': patient['patient_id']}, {'$setOnInsert': patient})
+        self.bulk.upsert(
+            self.db.studies,
+            {'study_instance_uid': study['study_instance_uid']},
+            {'$setOnInsert': study, '$addToSet': {'series': self._series_summary(series)}}
+        )
+        self.bulk.upsert(self.db.series, {'series_uid': series['series_uid']}, {'$setOnInsert': series})
+        self.bulk.upsert(self.db.instances, {'sop_instance_uid': instance['sop_instance_uid']}, {'$set': instance})
+        return instance
+
+    def _series_summary(self, series):
+        """Series entry embedded in the study; identical for every instance so $addToSet keeps one"""
+        number = series.get('series_number')
+        return {
+            'series_uid': series['series_uid'],
+            'series_number': int(number) if number and str(number).isdigit() else 0,
+            'description': series.get('series_description') or 'No Series Description',
+            'modality': series.get('modality') or 'Unknown'
+        }
+
+    def flush(self):
+        """Write all buffered upserts"""
+        self.bulk.flush()
@@ -1,6 +1,17 @@
 import os
 import pydicom
+from collections import deque
+from pymongo import UpdateOne, DeleteOne, DeleteMany
+from concurrent.futures import ProcessPoolExecutor
 from parsers.base_parser import BaseParser
+from utils.manifest import FileManifest
+from utils.discovery import DirectoryScanner
+from utils.dicom_sniff import sniff_dicom
+from utils.archives import is_archive, iter_archive_members, split_locator, locator_identity, remove_spool
+from utils.legacy_instances import extract_embedded_instances
+from utils.volume_cache import VolumeCache
+from utils.viewer_metadata import extract_viewer_metadata
+from utils.frame_index import read_frame_index, build_frame_index
 import logging
 import requests
 from flask import current_app
@@ -10,94 +21,343 @@ logger = logging.getLogger(__name__)
 # Add this constant at the top of the file
 PATIENT_SERVICE_URL = 'http://localhost:5008/api'
 
+# Number of worker processes used to read files (1 = parse in the request thread)
+DEFAULT_PARSE_WORKERS = int(os.environ.get('DICOM_PARSE_WORKERS', '1'))
+# Files handed to a worker per task, keeps IPC overhead low for small files
+PARSE_CHUNK_SIZE = 32
+# Parsed instances buffered before they are flushed to the database (0 = save at the end)
+DEFAULT_PERSIST_CHUNK_SIZE = int(os.environ.get('DICOM_PERSIST_CHUNK_SIZE', '500'))
+
+# Parser instance reused by each pool worker process
+_worker_parser = None
+
+def _parse_chunk(file_paths, header_only=True):
+    """Parse a chunk of files inside a pool worker process"""
+    global _worker_parser
+    if _worker_parser is None:
+        _worker_parser = FolderParser(None)
+    _worker_parser.header_only = header_only
+    return [(file_path, *_worker_parser._parse_file(file_path)) for file_path in file_paths]
+
 class FolderParser(BaseParser):
-    def __init__(self, db, analyze_only=False):
+    def __init__(self, db, analyze_only=False, workers=None, header_only=True,
+                 incremental=True, hash_files=False, chunk_size=None, prefilter=True):
         super().__init__(db)
         self.progress_callback = None
         self.analyze_only = analyze_only
+        self.workers = max(1, int(workers or DEFAULT_PARSE_WORKERS))
+        # Index from header tags only; full reads are kept for troubleshooting
+        self.header_only = header_only
+        # Skip files whose size/mtime (and optionally fast hash) match the manifest.
+        # The manifest is still recorded on full scans so they can be resumed.
+        self.incremental = incremental
+        self.use_manifest = not analyze_only and db is not None
+        self.hash_files = hash_files
+        self.chunk_size = DEFAULT_PERSIST_CHUNK_SIZE if chunk_size is None else int(chunk_size)
+        # Reject non-DICOM files from their name and first bytes before dcmread
+        self.prefilter = prefilter
+        # Archive members beyond the archive file itself, added to the progress total
+        self.archive_members = 0
+        self.volume_cache = VolumeCache()
+        # threading.Event set to stop a running parse, e.g. by a cancelled ingestion job
+        self.cancel_event = None
 
     def set_progress_callback(self, callback):
         """Set callback for progress updates"""
         self.progress_callback = callback
 
+    def set_cancel_event(self, event):
+        """Stop parse() once the event is set, checked per file including skipped ones"""
+        self.cancel_event = event
+
+    def _cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
     def parse(self, folder_path):
-        """Parse all DICOM files in a folder recursively."""
-        results = []
-        total_files = 0
-        processed_files = 0
+        """Parse all DICOM files in a folder recursively.
+
+        Unless analyze_only is set, parsed instances are flushed to the
+        database every chunk_size results so memory stays bounded and
+        studies become queryable while the import is still running.
+        """
+        summary = self._new_summary()
+        manifest = None
 
         logger.info(f"Starting folder parse at: {folder_path}")
 
         try:
-            # Count total files
-            for root, _, files in os.walk(folder_path):
-                total_files += len(files)
+            if self.use_manifest:
+                manifest = FileManifest(
+                    self.db.file_manifest,
+                    folder_path,
+                    use_hash=self.hash_files,
+                    skip_unchanged=self.incremental
+                )
+
+            # Walk the tree once, parsing starts while discovery is still running
+            scanner = DirectoryScanner(folder_path)
 
-            logger.info(f"Found {total_files} total files to process")
-            
             # Initial progress
             yield {
                 'current': 0,
-                'total': total_files,
+                'total': 0,
                 'percentage': 0,
                 'file': ''
             }
 
-            # Process files
-            for root, _, files in os.walk(folder_path):
-                for file in files:
-                    try:
-                        file_path = os.path.join(root, file)
-                        processed_files += 1
-
-                        try:
-                            dataset = pydicom.dcmread(file_path, force=True)
-                            if hasattr(dataset, 'SOPClassUID'):
-                                result = self._process_dataset(dataset, file_path)
-                                if result:
-                                    results.append(result)
-                                    logger.debug(f"Successfully processed: {file_path}")
-
-                        except Exception as e:
-                            logger.debug(f"Skipping non-DICOM file {file_path}: {str(e)}")
-                            continue
-                        finally:
-                            if processed_files % 10 == 0:
-                                yield {
-                                    'current': processed_files,
-                                    'total': total_files,
-                                    'percentage': (processed_files / total_files) * 100,
-                                    'file': file_path
-                                }
-                    except Exception as e:
-                        logger.error(f"Error processing file {file}: {str(e)}")
-                        continue
+            if manifest:
+                file_paths = (p for p, stat in scanner if not manifest.is_unchanged(p, stat))
+            else:
+                file_paths = (p for p, _ in scanner)
+            file_paths = self._until_cancelled(file_paths)
+
+            for file_path in self._ingest(file_paths, manifest, summary):
+                if summary['processed'] % 10 == 0:
+                    # Total is a running estimate until discovery has finished
+                    current = summary['processed'] + (manifest.stats['unchanged'] if manifest else 0)
+                    total_files = scanner.discovered + self.archive_members
+                    yield {
+                        'current': current,
+                        'total': total_files,
+                        'percentage': (current / total_files) * 100,
+                        'file': file_path,
+                        'estimated': not scanner.done
+                    }
+
+            if self._cancelled():
+                # Files not yet flushed stay pending in the manifest, and unseen files must not count as deleted
+                scanner.close()
+                yield {'cancelled': True, 'total_processed': summary['processed']}
+                return
+
+            logger.info(f"Found {scanner.discovered} total files to process")
+            if summary['skipped']:
+                logger.info(f"Skipped files by reason: {summary['skipped']}")
 
             # Save results and return final response
             if self.analyze_only:
                 # Returnera bara resultaten utan att spara till databasen
                 yield {
                     'complete': True,
-                    'studies': results,
-                    'total_processed': processed_files,
-                    'total_succeeded': len(results),
+                    'studies': summary['results'],
+                    'total_processed': summary['processed'],
+                    'total_succeeded': summary['succeeded'],
+                    'skipped': summary['skipped'],
                     'analyze_only': True
                 }
             else:
-                # Spara till databasen som vanligt
-                studies = self._save_to_database(results)
-                
+                if manifest:
+                    deleted = manifest.deleted_entries(scanner.unreadable)
+                    if scanner.unreadable:
+                        logger.warning(f"Keeping instances under {len(scanner.unreadable)} unreadable paths in {folder_path}")
+                    self._remove_deleted_instances(deleted)
+                    for entry in deleted:
+                        if is_archive(entry['path']):
+                            remove_spool(entry['path'])
+                    manifest.commit(deleted)
+                    logger.info(f"Manifest diff for {folder_path}: {manifest.stats}")
+
                 yield {
                     'complete': True,
-                    'studies': studies,
-                    'total_processed': processed_files,
-                    'total_succeeded': len(results)
+                    'studies': sorted(summary['studies']),
+                    'total_processed': summary['processed'],
+                    'total_succeeded': summary['succeeded'],
+                    'skipped': summary['skipped'],
+                    'manifest': manifest.stats if manifest else None
                 }
 
         except Exception as e:
             logger.error(f"Error parsing folder: {str(e)}", exc_info=True)
             yield {'error': str(e)}
 
+    def _until_cancelled(self, file_paths):
+        """Pass file paths through until the cancel event is set"""
+        for file_path in file_paths:
+            if self._cancelled():
+                return
+            yield file_path
+
+    def ingest_files(self, file_paths, manifest=None):
+        """Parse and persist an explicit list of files.
+
+        Used by watch mode for files that have settled in the spool
+        directory. Unchanged files are skipped when a manifest is given;
+        their entries are loaded for the batch and dropped from memory
+        afterwards. Deleted-file cleanup is left to full folder scans.
+        """
+        summary = self._new_summary()
+        batch = list(file_paths)
+        if manifest:
+            manifest.load(batch)
+            file_paths = [p for p in batch if not manifest.is_unchanged(p)]
+        try:
+            for _ in self._ingest(file_paths, manifest, summary):
+                pass
+        finally:
+            if manifest:
+                # The manifest lives as long as the watcher, keep only what the next batch needs
+                manifest.forget(batch)
+        summary['studies'] = sorted(summary['studies'])
+        return summary
+
+    def _new_summary(self):
+        return {'processed': 0, 'succeeded': 0, 'skipped': {}, 'studies': set(), 'results': []}
+
+    def _ingest(self, file_paths, manifest, summary):
+        """Parse files and persist them in chunks, yielding each processed path.
+
+        Counts, skip reasons and saved study UIDs are collected in summary.
+        With analyze_only nothing is saved and the results are kept in
+        summary['results'] instead.
+        """
+        results = []
+        # Files processed since the last flush, their manifest entries are written with it
+        chunk_paths = []
+        for file_path, result, skip_reason in self._parse_files(file_paths):
+            summary['processed'] += 1
+            if result:
+                results.append(result)
+                summary['succeeded'] += 1
+            else:
+                summary['skipped'][skip_reason] = summary['skipped'].get(skip_reason, 0) + 1
+            if manifest:
+                manifest.record(file_path, result)
+                chunk_paths.append(file_path)
+
+            if not self.analyze_only and self.chunk_size and len(results) >= self.chunk_size:
+                self._flush_results(results, manifest, summary['studies'], chunk_paths)
+                results = []
+                chunk_paths = []
+
+            yield file_path
+
+        if self.analyze_only:
+            summary['results'] = results
+        else:
+            # Spara återstående resultat till databasen
+            self._flush_results(results, manifest, summary['studies'])
+
+    def _flush_results(self, results, manifest, saved_studies, paths=None):
+        """Save a chunk of results, then record their files in the manifest.
+
+        Only the files in paths are committed (all pending files when None),
+        since with a worker pool later files are already pending while their
+        results are still being parsed. When the save fails nothing is
+        committed and the files are left for the next scan. Only study UIDs
+        are kept afterwards, the documents themselves are released so peak
+        memory does not grow with the archive size.
+        """
+        if results:
+            studies = self._save_to_database(results)
+            if studies is None:
+                if manifest:
+                    # Archive members are committed through their archive's entry
+                    manifest.discard([split_locator(p)[0] for p in (paths if paths is not None else manifest.pending)])
+                    manifest.take_replaced()
+                return
+            saved_studies.update(study['study_instance_uid'] for study in studies)
+            logger.info(f"Flushed {len(results)} instances across {len(studies)} studies")
+        if manifest:
+            # Rewritten files that now hold another SOP instance leave the old one behind
+            self._remove_deleted_instances(manifest.take_replaced())
+            manifest.commit(paths=paths)
+
+    def _parse_files(self, file_paths):
+        """Yield (file_path, result, skip_reason) for each file, in input order.
+
+        With more than one worker the files are read in a process pool. A
+        bounded window of in-flight chunks keeps memory flat and results
+        are yielded in submission order so progress stays monotonic.
+        Archives are streamed member by member in this process; their
+        results are yielded where the archive was encountered.
+        """
+        if self.workers == 1:
+            for file_path in file_paths:
+                if is_archive(file_path):
+                    yield from self._parse_archive(file_path)
+                    continue
+                yield (file_path, *self._parse_file(file_path))
+            return
+
+        logger.info(f"Parsing files with {self.workers} worker processes")
+        max_pending = self.workers * 2
+        pending = deque()
+        chunk = []
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for file_path in file_paths:
+                if is_archive(file_path):
+                    yield from self._parse_archive(file_path)
+                    continue
+                chunk.append(file_path)
+                if len(chunk) < PARSE_CHUNK_SIZE:
+                    continue
+                pending.append(executor.submit(_parse_chunk, chunk, self.header_only))
+                chunk = []
+                # Drain the oldest chunk once the window is full
+                if len(pending) >= max_pending:
+                    yield from pending.popleft().result()
+
+            if chunk:
+                pending.append(executor.submit(_parse_chunk, chunk, self.header_only))
+            while pending:
+                yield from pending.popleft().result()
+
+    def _parse_archive(self, archive_path):
+        """Yield (locator, result, skip_reason) for each member of a zip/tar archive.
+
+        Nothing is extracted to disk; instances store an archive::member
+        locator as their file_path. Members spooled from an earlier version
+        of the archive are dropped.
+        """
+        logger.info(f"Streaming members from archive {archive_path}")
+        remove_spool(archive_path)
+        try:
+            for index, (locator, member) in enumerate(iter_archive_members(archive_path)):
+                # Discovery counted the archive as one file
+                if index:
+                    self.archive_members += 1
+                yield (locator, *self._parse_file(locator, member))
+        except Exception as e:
+            logger.error(f"Error reading archive {archive_path}: {e}")
+            yield archive_path, None, 'bad_archive'
+
+    def _parse_file(self, file_path, fileobj=None):
+        """Read a single file, or an already opened archive member.
+
+        Returns (result, skip_reason); result is None when the file was
+        skipped. Obvious non-DICOM files are rejected by sniff_dicom from a
+        few bytes before pydicom is involved.
+        """
+        skip_reason = sniff_dicom(file_path, fileobj) if self.prefilter else None
+        if skip_reason:
+            return None, skip_reason
+
+        try:
+            frame_index = None
+            if fileobj is not None:
+                # Archive members cannot be memory-mapped, so their frames are not indexed
+                dataset = self._read_header(fileobj) if self.header_only else pydicom.dcmread(fileobj, force=True)
+            elif self.header_only:
+                # The header read stops at PixelData, where the frame offsets are read from the same handle
+                with open(file_path, 'rb') as f:
+                    dataset = self._read_header(f)
+                    frame_index = read_frame_index(f, dataset)
+            else:
+                dataset = pydicom.dcmread(file_path, force=True)
+                frame_index = build_frame_index(file_path)
+            if not hasattr(dataset, 'SOPClassUID'):
+                return None, 'not_dicom'
+            result = self._process_dataset(dataset, file_path)
+            if not result:
+                return None, 'missing_uids'
+            result['instance']['frame_index'] = frame_index
+            logger.debug(f"Successfully processed: {file_path}")
+            return result, None
+        except Exception as e:
+            logger.debug(f"Skipping non-DICOM file {file_path}: {str(e)}")
+            return None, 'not_dicom'
+
     def _get_tag_value(self, dataset, tag_name):
         """Safely get a DICOM tag value"""
         try:
@@ -199,8 +459,13 @@ class FolderParser(BaseParser):
             # Create instance document
             instance_doc = {
                 'sop_instance_uid': sop_instance_uid,
+                'sop_class_uid': self._get_tag_value(dataset, 'SOPClassUID'),
                 'instance_number': int(instance_number) if instance_number and instance_number.isdigit() else 0,
-                'file_path': file_path
+                'file_path': file_path,
+                # Size and mtime the cached locations are checked against
+                'file_identity': locator_identity(file_path),
+                # Served by /api/dicom/metadata without opening the file again
+                'viewer_metadata': extract_viewer_metadata(dataset)
             }
 
             return {
@@ -259,98 +524,246 @@ class FolderParser(BaseParser):
         except Exception as e:
             logger.error(f"Failed to update patient service: {e}")
 
+    def _group_results(self, results):
+        """Group parsed results into patient and study documents.
+
+        Series and instances are deduplicated through dict/set indexes keyed
+        by series UID and SOP UID, so assembly stays linear in the number of
+        instances even for series with thousands of slices.
+        """
+        patients = {}
+        studies = {}
+        patient_studies = {}
+        series_index = {}
+        sop_index = {}
+
+        for result in results:
+            if not result:
+                continue
+
+            patient = result['patient']
+            study = result['study']
+            series = result['series']
+            instance = result['instance']
+
+            # Skip if missing required fields
+            study_uid = study.get('study_instance_uid')
+            if not study_uid:
+                logger.warning(f"Skipping study with missing study_instance_uid for patient {patient['patient_id']}")
+                continue
+
+            # Update patient document
+            if patient['patient_id'] not in patients:
+                patients[patient['patient_id']] = patient
+                patient_studies[patient['patient_id']] = set(patient['studies'])
+
+            # Update study document
+            if study_uid not in studies:
+                studies[study_uid] = study
+                if study_uid not in patient_studies[patient['patient_id']]:
+                    patient_studies[patient['patient_id']].add(study_uid)
+                    patients[patient['patient_id']]['studies'].append(study_uid)
+
+            current_study = studies[study_uid]
+
+            # Update study modalities
+            if isinstance(current_study['modalities'], set):
+                current_study['modalities'].add(series['modality'])
+            else:
+                current_study['modalities'] = {series['modality']}
+
+            # Update series
+            series_key = (study_uid, series['series_uid'])
+            existing_series = series_index.get(series_key)
+            if existing_series is None:
+                current_study['series'].append(series)
+                existing_series = series_index[series_key] = series
+                sop_index[series_key] = set()
+                current_study['num_series'] = len(current_study['series'])
+
+            # Add instance to series if not already present
+            sop_uids = sop_index[series_key]
+            if instance['sop_instance_uid'] not in sop_uids:
+                sop_uids.add(instance['sop_instance_uid'])
+                existing_series['instances'].append(instance)
+                current_study['num_instances'] += 1
+
+        return patients, studies
+
     def _save_to_database(self, results):
         """Save parsed results to database"""
         try:
             # Group results by patient and study
-            patients = {}
-            studies = {}
-            
-            for result in results:
-                if not result:
-                    continue
-                    
-                patient = result['patient']
-                study = result['study']
-                series = result['series']
-                instance = result['instance']
-                
-                # Skip if missing required fields
-                if not study.get('study_instance_uid'):
-                    logger.warning(f"Skipping study with missing study_instance_uid for patient {patient['patient_id']}")
-                    continue
-                
-                # Update patient document
-                if patient['patient_id'] not in patients:
-                    patients[patient['patient_id']] = patient
-                
-                # Update study document
-                if study['study_instance_uid'] not in studies:
-                    studies[study['study_instance_uid']] = study
-                    if study['study_instance_uid'] not in patients[patient['patient_id']]['studies']:
-                        patients[patient['patient_id']]['studies'].append(study['study_instance_uid'])
-                
-                current_study = studies[study['study_instance_uid']]
-                
-                # Update study modalities
-                if isinstance(current_study['modalities'], set):
-                    current_study['modalities'].add(series['modality'])
-                else:
-                    current_study['modalities'] = {series['modality']}
-                
-                # Update series
-                series_list = current_study['series']
-                existing_series = next(
-                    (s for s in series_list if s['series_uid'] == series['series_uid']), 
-                    None
-                )
-                
-                if not existing_series:
-                    series_list.append(series)
-                    existing_series = series
-                    current_study['num_series'] = len(series_list)
-                
-                # Add instance to series if not already present
-                instance_exists = any(
-                    i['sop_instance_uid'] == instance['sop_instance_uid'] 
-                    for i in existing_series['instances']
-                )
-                if not instance_exists:
-                    existing_series['instances'].append(instance)
-                    current_study['num_instances'] += 1
+            patients, studies = self._group_results(results)
 
             # Convert sets to lists before saving
             for study in studies.values():
                 study['modalities'] = list(study['modalities'])
 
-            # Update database
+            # Update database, one bulk_write per batch instead of one call per entity
             for patient in patients.values():
-                try:
-                    # Update patient management service
-                    self._update_patient_service(patient)
-                    
-                    # Update local database
-                    self.db.patients.update_one(
-                        {'patient_id': patient['patient_id']},
-                        {'$set': patient},
-                        upsert=True
-                    )
-                except Exception as e:
-                    logger.error(f"Error updating patient {patient['patient_id']}: {e}")
-            
+                # Update patient management service
+                self._update_patient_service(patient)
+
+                # Update local database, keeping studies from earlier scans
+                patient_fields = {k: v for k, v in patient.items() if k != 'studies'}
+                self.bulk.upsert(
+                    self.db.patients,
+                    {'patient_id': patient['patient_id']},
+                    {
+                        '$set': patient_fields,
+                        '$addToSet': {'studies': {'$each': patient['studies']}}
+                    }
+                )
+
+            # Instances live in their own collection, written before the studies that count them
+            existing_studies = self._find_studies(studies.keys())
+            scanned = {
+                instance['sop_instance_uid']
+                for study in studies.values() for series in study['series'] for instance in series['instances']
+            }
+            self._queue_embedded_instances(existing_studies.values(), skip=scanned)
+            self._queue_instances(studies.values())
+            self.bulk.flush()
+            # Re-parsed files may have new pixel data under the same SOP UID
+            self.volume_cache.invalidate({s['series_uid'] for study in studies.values() for s in study['series']})
+
+            counts = self._count_instances(studies.keys())
+            saved_studies = []
             for study in studies.values():
-                try:
-                    self.db.studies.update_one(
-                        {'study_instance_uid': study['study_instance_uid']},
-                        {'$set': study},
-                        upsert=True
-                    )
-                except Exception as e:
-                    logger.error(f"Error updating study {study['study_instance_uid']}: {e}")
-                
+                study = self._merge_existing_study(study, existing_studies.get(study['study_instance_uid']))
+                self._apply_instance_counts(study, counts)
+                self.bulk.upsert(
+                    self.db.studies,
+                    {'study_instance_uid': study['study_instance_uid']},
+                    {'$set': study}
+                )
+                saved_studies.append(study)
+            self.bulk.flush()
+
             logger.info(f"Saved {len(patients)} patients and {len(studies)} studies to database")
-            return list(studies.values())
+            return saved_studies
             
         except Exception as e:
             logger.error(f"Error saving to database: {str(e)}")
-            return [] 
\ No newline at end of file
+            # None tells the caller not to record the files as indexed
+            return None
+
+    def _queue_instances(self, studies):
+        """Upsert one document per instance into the instances collection"""
+        for study in studies:
+            for series in study['series']:
+                for instance in series['instances']:
+                    self.bulk.upsert(
+                        self.db.instances,
+                        {'sop_instance_uid': instance['sop_instance_uid']},
+                        {'$set': {
+                            **instance,
+                            'series_uid': series['series_uid'],
+                            'study_instance_uid': study['study_instance_uid']
+                        }}
+                    )
+
+    def _queue_embedded_instances(self, studies, skip=()):
+        """Move instances still embedded in stored studies to the instances collection.
+
+        Studies saved before instances were normalized are converted the
+        first time a scan touches them, the same way the migration does.
+        """
+        for study in studies:
+            for instance in extract_embedded_instances(study):
+                if instance['sop_instance_uid'] in skip:
+                    continue
+                self.bulk.upsert(
+                    self.db.instances,
+                    {'sop_instance_uid': instance['sop_instance_uid']},
+                    {'$set': instance}
+                )
+
+    def _count_instances(self, study_uids):
+        """Instance counts per (study UID, series UID) from the instances collection"""
+        pipeline = [
+            {'$match': {'study_instance_uid': {'$in': list(study_uids)}}},
+            {'$group': {
+                '_id': {'study': '$study_instance_uid', 'series': '$series_uid'},
+                'count': {'$sum': 1}
+            }}
+        ]
+        return {
+            (row['_id']['study'], row['_id']['series']): row['count']
+            for row in self.db.instances.aggregate(pipeline)
+        }
+
+    def _apply_instance_counts(self, study, counts):
+        """Set per-series and study counts, dropping series without instances"""
+        study_uid = study['study_instance_uid']
+        for series in study['series']:
+            series['num_instances'] = counts.get((study_uid, series['series_uid']), 0)
+        study['series'] = [s for s in study['series'] if s['num_instances']]
+        study['num_series'] = len(study['series'])
+        study['num_instances'] = sum(s['num_instances'] for s in study['series'])
+
+    def _find_studies(self, study_uids):
+        """Fetch stored studies in one query, keyed by study UID"""
+        return {
+            study['study_instance_uid']: study
+            for study in self.db.studies.find(
+                {'study_instance_uid': {'$in': list(study_uids)}},
+                {'_id': 0}
+            )
+        }
+
+    def _merge_existing_study(self, study, existing):
+        """Merge a study assembled from this scan into its stored version.
+
+        Incremental scans only see new or modified files, so series already
+        in the database must be kept rather than replaced. Series documents
+        carry metadata and counts only, their instances are stored in the
+        instances collection.
+        """
+        for series in study['series']:
+            series.pop('instances', None)
+        if not existing:
+            return study
+
+        series_by_uid = {s['series_uid']: s for s in existing.get('series', [])}
+        for series in study['series']:
+            series_by_uid[series['series_uid']] = {**series_by_uid.get(series['series_uid'], {}), **series}
+
+        merged = {**existing, **study}
+        merged['series'] = list(series_by_uid.values())
+        merged['modalities'] = sorted(set(existing.get('modalities', [])) | set(study['modalities']))
+        return merged
+
+    def _remove_deleted_instances(self, entries):
+        """Remove instances whose files disappeared since the last scan"""
+        deleted_by_study = {}
+        for entry in entries:
+            if entry.get('sop_instance_uid'):
+                deleted_by_study.setdefault(entry['study_instance_uid'], set()).add(entry['sop_instance_uid'])
+        if not deleted_by_study:
+            return
+
+        existing_studies = self._find_studies(deleted_by_study.keys())
+        deleted = set().union(*deleted_by_study.values())
+        self._queue_embedded_instances(existing_studies.values(), skip=deleted)
+        for study_uid, sop_uids in deleted_by_study.items():
+            self.bulk.add(self.db.instances, DeleteMany({'sop_instance_uid': {'$in': list(sop_uids)}}))
+            logger.info(f"Removing {len(sop_uids)} deleted instances from study {study_uid}")
+        self.bulk.flush()
+
+        counts = self._count_instances(deleted_by_study.keys())
+        for study_uid, study in existing_studies.items():
+            self._apply_instance_counts(study, counts)
+            if not study['series']:
+                self.bulk.add(self.db.studies, DeleteOne({'study_instance_uid': study_uid}))
+                self.bulk.add(self.db.patients, UpdateOne(
+                    {'patient_id': study.get('patient_id')},
+                    {'$pull': {'studies': study_uid}}
+                ))
+            else:
+                self.bulk.add(self.db.studies, UpdateOne(
+                    {'study_instance_uid': study_uid},
+                    {'$set': study}
+                ))
+        self.bulk.flush()
@@ -0,0 +1,253 @@
+import io
+import os
+import shutil
+import logging
+import hashlib
+import tarfile
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+
+# Separates the archive path from the member name in stored file paths
+LOCATOR_SEPARATOR = '::'
+ZIP_EXTENSIONS = ('.zip',)
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+# Members of compressed tars are decompressed here the first time one is read,
+# reading one back from the archive would decompress everything before it
+ARCHIVE_SPOOL_DIR = os.environ.get(
+    'DICOM_ARCHIVE_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'dicom_archive_spool')
+)
+# Size budget of the spool in MB, least recently read members are evicted beyond it;
+# 0 disables the spool and members are read by decompressing up to them
+DEFAULT_ARCHIVE_SPOOL_MB = float(os.environ.get('DICOM_ARCHIVE_SPOOL_MB', '2048'))
+# Plain tar archives whose member offsets are kept per process
+TAR_INDEX_CACHE_SIZE = 64
+
+logger = logging.getLogger(__name__)
+
+_tar_indexes = OrderedDict()
+_tar_indexes_lock = threading.Lock()
+_spool_lock = threading.Lock()
+
+def is_archive(path):
+    """Check by extension whether a path is a supported zip/tar archive"""
+    name = path.lower()
+    return name.endswith(ZIP_EXTENSIONS) or name.endswith(TAR_EXTENSIONS)
+
+def make_locator(archive_path, member):
+    return f"{os.path.abspath(archive_path)}{LOCATOR_SEPARATOR}{member}"
+
+def is_compressed_tar(path):
+    name = path.lower()
+    return name.endswith(TAR_EXTENSIONS) and not name.endswith('.tar')
+
+def split_locator(file_path):
+    """Return (archive_path, member) for a locator, or (file_path, None) for a plain file.
+
+    Only splits where the part before the separator is an archive, so
+    plain paths that happen to contain '::' are left alone.
+    """
+    start = 0
+    while True:
+        index = file_path.find(LOCATOR_SEPARATOR, start)
+        if index < 0:
+            return file_path, None
+        if is_archive(file_path[:index]):
+            return file_path[:index], file_path[index + len(LOCATOR_SEPARATOR):]
+        start = index + 1
+
+def _archive_identity(archive_path):
+    """Path, size and mtime, so a replaced archive never serves old members"""
+    stat = os.stat(archive_path)
+    return f"{os.path.abspath(archive_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+def _hash(text):
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+def _spool_archive_dir(archive_path):
+    """Spool directory of an archive path, holding one subdirectory per archive version"""
+    return os.path.join(ARCHIVE_SPOOL_DIR, _hash(os.path.abspath(archive_path)))
+
+def spool_path(archive_path, member):
+    """Where a compressed tar member is kept decompressed"""
+    version = _hash(_archive_identity(archive_path))
+    return os.path.join(_spool_archive_dir(archive_path), version, _hash(member))
+
+def spool_member(archive_path, member, data):
+    path = spool_path(archive_path, member)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def remove_spool(archive_path):
+    """Drop every spooled version of an archive, e.g. when it was re-ingested or deleted"""
+    shutil.rmtree(_spool_archive_dir(archive_path), ignore_errors=True)
+
+def _evict_spool(max_bytes):
+    """Remove the least recently read spooled members until the spool fits its budget"""
+    entries = []
+    for directory, _, names in os.walk(ARCHIVE_SPOOL_DIR):
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(directory, name)))
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted += 1
+    if evicted:
+        logger.info(f"Evicted {evicted} spooled archive members")
+
+def _spool_archive(archive_path):
+    """Decompress a compressed tar into the spool in one pass, replacing older versions of it"""
+    version_dir = os.path.dirname(spool_path(archive_path, ''))
+    archive_dir = os.path.dirname(version_dir)
+    if os.path.isdir(archive_dir):
+        for name in os.listdir(archive_dir):
+            if os.path.join(archive_dir, name) != version_dir:
+                shutil.rmtree(os.path.join(archive_dir, name), ignore_errors=True)
+    with tarfile.open(archive_path, 'r:*') as archive:
+        for info in archive:
+            if info.isfile():
+                spool_member(archive_path, info.name, archive.extractfile(info).read())
+
+def _read_compressed_member(archive_path, member, max_mb=None):
+    """Bytes of a compressed tar member, from the spool when it is enabled"""
+    max_bytes = (DEFAULT_ARCHIVE_SPOOL_MB if max_mb is None else max_mb) * 1024 ** 2
+    if max_bytes <= 0:
+        with tarfile.open(archive_path, 'r:*') as archive:
+            for info in archive:
+                if info.isfile() and info.name == member:
+                    return archive.extractfile(info).read()
+        raise KeyError(f"{member} not found in {archive_path}")
+    path = spool_path(archive_path, member)
+    data = _read_spooled(path)
+    if data is not None:
+        return data
+    with _spool_lock:
+        data = _read_spooled(path)
+        if data is None:
+            _spool_archive(archive_path)
+            data = _read_spooled(path)
+            if data is None:
+                raise KeyError(f"{member} not found in {archive_path}")
+            # The member just read is the newest, so eviction keeps it
+            _evict_spool(max_bytes)
+    return data
+
+def _read_spooled(path):
+    """Bytes of a spooled member, None if it is not spooled; mtime tracks reads for eviction"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return data
+
+def _tar_offsets(archive_path):
+    """{member: (data offset, size)} of a plain tar, read once per archive version"""
+    identity = _archive_identity(archive_path)
+    with _tar_indexes_lock:
+        offsets = _tar_indexes.get(identity)
+        if offsets is not None:
+            _tar_indexes.move_to_end(identity)
+            return offsets
+    # Headers only, tarfile seeks over the member data of an uncompressed archive
+    with tarfile.open(archive_path, 'r:') as archive:
+        offsets = {info.name: (info.offset_data, info.size) for info in archive if info.isfile()}
+    with _tar_indexes_lock:
+        _tar_indexes[identity] = offsets
+        while len(_tar_indexes) > TAR_INDEX_CACHE_SIZE:
+            _tar_indexes.popitem(last=False)
+    return offsets
+
+def iter_archive_members(archive_path):
+    """Yield (locator, file object) for every regular file in an archive.
+
+    Members are streamed in archive order without extracting anything to
+    disk. Zip members are opened directly (seekable); tar members are read
+    into memory one at a time because seeking backwards in a compressed
+    tar stream restarts decompression.
+    """
+    if archive_path.lower().endswith(ZIP_EXTENSIONS):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with archive.open(info) as member:
+                    yield make_locator(archive_path, info.filename), member
+    else:
+        with tarfile.open(archive_path, 'r:*') as archive:
+            for info in archive:
+                if not info.isfile():
+                    continue
+                yield make_locator(archive_path, info.name), io.BytesIO(archive.extractfile(info).read())
+
+def locator_exists(file_path):
+    """os.path.exists that also understands archive locators"""
+    archive_path, member = split_locator(file_path)
+    if member is None:
+        return os.path.exists(file_path)
+    return os.path.exists(archive_path)
+
+def locator_identity(file_path):
+    """[size, mtime_ns] of the file or archive behind a stored path, None if it is missing.
+
+    Stored with each instance at ingest, so cached offsets can be checked
+    against a file that was rewritten in place.
+    """
+    try:
+        stat = os.stat(split_locator(file_path)[0])
+    except (OSError, TypeError, ValueError):
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def open_locator(file_path):
+    """Open a stored file path for binary reading.
+
+    Zip members are read through the central directory, plain tar members
+    from their cached offset and compressed tar members from the size
+    bounded spool, which is filled on first read.
+    """
+    archive_path, member = split_locator(file_path)
+    if member is None:
+        return open(file_path, 'rb')
+    if archive_path.lower().endswith(ZIP_EXTENSIONS):
+        with zipfile.ZipFile(archive_path) as archive:
+            return io.BytesIO(archive.read(member))
+    if is_compressed_tar(archive_path):
+        return io.BytesIO(_read_compressed_member(archive_path, member))
+    offset, size = _tar_offsets(archive_path)[member]
+    with open(archive_path, 'rb') as f:
+        f.seek(offset)
+        return io.BytesIO(f.read(size))
+
+def read_locator(file_path):
+    """Read the full bytes behind a stored file path"""
+    with open_locator(file_path) as f:
+        return f.read()
+
+def locator_size(file_path):
+    """Size in bytes of a plain file or of an archive member (uncompressed)"""
+    archive_path, member = split_locator(file_path)
+    if member is None:
+        return os.path.getsize(file_path)
+    if archive_path.lower().endswith(ZIP_EXTENSIONS):
+        with zipfile.ZipFile(archive_path) as archive:
+            return archive.getinfo(member).file_size
+    if is_compressed_tar(archive_path):
+        return len(_read_compressed_member(archive_path, member))
+    return _tar_offsets(archive_path)[member][1]
@@ -24,6 +24,7 @@ class DicomConfig:
             'date': DicomTagConfig('StudyDate', '0008,0020', 'Study Date'),
             'time': DicomTagConfig('StudyTime', '0008,0030', 'Study Time'),
             'description': DicomTagConfig('StudyDescription', '0008,1030', 'Study Description'),
+            'accession_number': DicomTagConfig('AccessionNumber', '0008,0050', 'Accession Number'),
         },
         'series': {
             'uid': DicomTagConfig('SeriesInstanceUID', '0020,000E', 'Series Instance UID', True),
@@ -35,6 +36,7 @@ class DicomConfig:
         },
         'instance': {
             'uid': DicomTagConfig('SOPInstanceUID', '0008,0018', 'SOP Instance UID', True),
+            'class_uid': DicomTagConfig('SOPClassUID', '0008,0016', 'SOP Class UID'),
             'number': DicomTagConfig('InstanceNumber', '0020,0013', 'Instance Number', True),
             'position': DicomTagConfig('SliceLocation', '0020,1041', 'Slice Location'),
             'thickness': DicomTagConfig('SliceThickness', '0018,0050', 'Slice Thickness'),
@@ -58,4 +60,8 @@ class DicomConfig:
         return self.config[level].get(tag_name)
 
     def get_required_tags(self, level: str) -> List[DicomTagConfig]:
-        return [tag for tag in self.config[level].values() if tag.required] 
\ No newline at end of file
+        return [tag for tag in self.config[level].values() if tag.required]
+
+    def get_keywords(self) -> List[str]:
+        """All configured tag keywords, used to limit what is read from disk"""
+        return [tag.name for tags in self.config.values() for tag in tags.values()] 
\ No newline at end of file
@@ -0,0 +1,49 @@
+import os
+import struct
+
+# Extensions that are never DICOM, rejected without opening the file
+NON_DICOM_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp',
+    '.pdf', '.txt', '.log', '.csv', '.xml', '.json', '.html', '.htm',
+    '.ini', '.cfg', '.md', '.doc', '.docx', '.xls', '.xlsx',
+    '.exe', '.dll', '.bat', '.sh', '.py', '.js', '.db', '.ds_store'
+}
+PREAMBLE_LENGTH = 128
+MAGIC = b'DICM'
+# Smallest plausible preamble-less dataset: one element header
+MIN_DATASET_LENGTH = 8
+# Groups a preamble-less (raw) dataset normally starts with
+RAW_DATASET_GROUPS = {0x0002, 0x0008}
+
+def sniff_dicom(file_path, fileobj=None):
+    """Classify a file from its name and at most 132 bytes.
+
+    Returns None when the file looks like DICOM, otherwise the reason it
+    should be skipped. Files without the 128 byte preamble are accepted if
+    they start with a group 0002/0008 element in little endian order.
+    An open file object (e.g. an archive member) is rewound after reading.
+    """
+    name = os.path.basename(file_path)
+    if name.upper() == 'DICOMDIR':
+        return 'dicomdir'
+    if os.path.splitext(name)[1].lower() in NON_DICOM_EXTENSIONS or name.lower() == '.ds_store':
+        return 'extension'
+
+    try:
+        if fileobj is not None:
+            header = fileobj.read(PREAMBLE_LENGTH + len(MAGIC))
+            fileobj.seek(0)
+        else:
+            with open(file_path, 'rb') as f:
+                header = f.read(PREAMBLE_LENGTH + len(MAGIC))
+    except OSError:
+        return 'unreadable'
+
+    if header[PREAMBLE_LENGTH:] == MAGIC:
+        return None
+    if len(header) < MIN_DATASET_LENGTH:
+        return 'too_small'
+    group, _ = struct.unpack('<HH', header[:4])
+    if group in RAW_DATASET_GROUPS:
+        return None
+    return 'no_magic'
@@ -0,0 +1,201 @@
+import re
+import uuid
+import logging
+from pydicom.datadict import tag_for_keyword, dictionary_VR, keyword_for_tag
+from utils.archives import open_locator
+from utils.viewer_metadata import VIEWER_TAGS
+
+logger = logging.getLogger(__name__)
+
+DICOM_JSON = 'application/dicom+json'
+# Files are streamed into multipart bodies in chunks of this size
+MULTIPART_CHUNK_SIZE = 256 * 1024
+QIDO_DEFAULT_LIMIT = 1000
+INTEGER_VRS = {'IS', 'SL', 'SS', 'UL', 'US', 'SV', 'UV'}
+DECIMAL_VRS = {'DS', 'FL', 'FD'}
+
+def dicom_json(attributes):
+    """DICOM JSON model of {keyword: value}, leaving out empty values"""
+    result = {}
+    for keyword, value in attributes.items():
+        if value is None or value == '' or value == []:
+            continue
+        tag = tag_for_keyword(keyword)
+        vr = dictionary_VR(tag)
+        values = value if isinstance(value, (list, tuple)) else [value]
+        if vr == 'PN':
+            values = [{'Alphabetic': str(v)} for v in values]
+        elif vr == 'DA':
+            values = [str(v).replace('-', '') for v in values]
+        elif vr == 'TM':
+            values = [str(v).replace(':', '') for v in values]
+        elif vr in INTEGER_VRS:
+            values = [int(v) for v in values]
+        elif vr in DECIMAL_VRS:
+            values = [float(v) for v in values]
+        result[f'{tag:08X}'] = {'vr': vr, 'Value': values}
+    return result
+
+def query_keyword(name):
+    """Keyword for a QIDO parameter given as keyword or as tag (e.g. 0020000D)"""
+    if re.fullmatch(r'[0-9A-Fa-f]{8}', name):
+        return keyword_for_tag(int(name, 16)) or name
+    return name
+
+class InvalidQuery(ValueError):
+    """A QIDO parameter that cannot be parsed, answered with 400"""
+
+def query_int(name, value, minimum=0):
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise InvalidQuery(f"{name} must be an integer, got {value!r}")
+    if number < minimum:
+        raise InvalidQuery(f"{name} must be at least {minimum}")
+    return number
+
+def _list_values(value, uid):
+    """Values of a list match, None for a single value.
+
+    Backslash separates multiple values for any attribute; commas only
+    for UIDs, since descriptions and names may contain them.
+    """
+    separators = r'[\\,]' if uid else r'\\'
+    if re.search(separators, value):
+        return [v for v in re.split(separators, value) if v]
+    return None
+
+def _check_uid_value(value, uid):
+    """UIDs allow only single value or list matching (PS3.4 C.2.2.2), wildcards are rejected"""
+    if uid and ('*' in value or '?' in value):
+        raise InvalidQuery(f"wildcards are not supported for UID attributes, got {value!r}")
+
+def match_value(value, uid=False):
+    """Mongo condition for a QIDO value: lists, * and ? wildcards, or an exact match"""
+    _check_uid_value(value, uid)
+    values = _list_values(value, uid)
+    if values is not None:
+        return {'$in': values}
+    if '*' in value or '?' in value:
+        pattern = ''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in value)
+        return {'$regex': f'^{pattern}$', '$options': 'i'}
+    return value
+
+def value_matches(pattern, value, uid=False):
+    """Python counterpart of match_value, for attributes filtered after loading"""
+    _check_uid_value(pattern, uid)
+    if value is None:
+        return False
+    value = str(value)
+    values = _list_values(pattern, uid)
+    if values is not None:
+        return value in values
+    if '*' in pattern or '?' in pattern:
+        regex = ''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in pattern)
+        return re.fullmatch(regex, value, re.IGNORECASE) is not None
+    return value == pattern
+
+def match_numbers(name, value):
+    """Integers of a QIDO value for an IS attribute, a single value or a backslash list"""
+    if '*' in value or '?' in value:
+        raise InvalidQuery(f"{name} does not support wildcards")
+    return [query_int(name, v) for v in (_list_values(value, False) or [value])]
+
+def match_date(field, value):
+    """Mongo condition for a DA value or range, for dates stored as YYYYMMDD or YYYY-MM-DD"""
+    start, _, end = value.partition('-') if '-' in value else (value, None, value)
+    conditions = []
+    for iso in (False, True):
+        def stored(date):
+            return f"{date[:4]}-{date[4:6]}-{date[6:8]}" if iso else date
+        condition = {}
+        if start:
+            condition['$gte'] = stored(start)
+        if end:
+            condition['$lte'] = stored(end)
+        conditions.append({field: condition})
+    return {'$or': conditions}
+
+def study_attributes(study, patient=None, retrieve_url=None):
+    patient = patient or {}
+    return dicom_json({
+        'StudyInstanceUID': study.get('study_instance_uid'),
+        'StudyDate': study.get('study_date'),
+        'StudyTime': study.get('study_time'),
+        'StudyDescription': study.get('description') or study.get('study_description'),
+        'AccessionNumber': study.get('accession_number'),
+        'ModalitiesInStudy': study.get('modalities'),
+        'PatientID': study.get('patient_id'),
+        'PatientName': patient.get('name') or patient.get('patient_name'),
+        'PatientBirthDate': patient.get('dob') or patient.get('birth_date'),
+        'NumberOfStudyRelatedSeries': study.get('num_series'),
+        'NumberOfStudyRelatedInstances': study.get('num_instances'),
+        'RetrieveURL': retrieve_url
+    })
+
+def series_attributes(study_instance_uid, series, retrieve_url=None):
+    return dicom_json({
+        'StudyInstanceUID': study_instance_uid,
+        'SeriesInstanceUID': series.get('series_uid'),
+        'SeriesNumber': series.get('series_number'),
+        'SeriesDescription': series.get('description') or series.get('series_description'),
+        'Modality': series.get('modality'),
+        'NumberOfSeriesRelatedInstances': series.get('num_instances'),
+        'RetrieveURL': retrieve_url
+    })
+
+def instance_attributes(instance, retrieve_url=None):
+    """Instance attributes from the index, including the viewer metadata stored at ingest"""
+    attributes = {
+        'StudyInstanceUID': instance.get('study_instance_uid'),
+        'SeriesInstanceUID': instance.get('series_uid'),
+        'SOPInstanceUID': instance.get('sop_instance_uid'),
+        'SOPClassUID': instance.get('sop_class_uid'),
+        'InstanceNumber': instance.get('instance_number'),
+        'RetrieveURL': retrieve_url
+    }
+    frame_index = instance.get('frame_index')
+    if frame_index:
+        attributes['AvailableTransferSyntaxUID'] = frame_index['transfer_syntax_uid']
+    viewer = instance.get('viewer_metadata') or {}
+    for key, (keyword, _) in VIEWER_TAGS.items():
+        if key in viewer:
+            attributes[keyword] = viewer[key]
+    return dicom_json(attributes)
+
+def multipart_boundary():
+    return uuid.uuid4().hex
+
+def multipart_related(parts, boundary):
+    """Body of a multipart/related response from (content type, byte chunks) pairs, streamed"""
+    for content_type, chunks in parts:
+        yield f'--{boundary}\r\nContent-Type: {content_type}\r\n\r\n'.encode()
+        yield from chunks
+        yield b'\r\n'
+    yield f'--{boundary}--\r\n'.encode()
+
+def iter_file(file_path):
+    """Chunks of a stored file, opened only when the part is reached"""
+    with open_locator(file_path) as f:
+        while True:
+            chunk = f.read(MULTIPART_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+def instance_parts(instances):
+    """Multipart parts for whole instances, missing files are logged and skipped"""
+    for instance in instances:
+        file_path = instance.get('file_path')
+        try:
+            chunks = iter_file(file_path)
+            # The first read fails here for a missing file, before the part header is written
+            first = next(chunks, b'')
+        except (OSError, KeyError, TypeError) as e:
+            logger.warning(f"Skipping instance {instance.get('sop_instance_uid')}: {e}")
+            continue
+        yield 'application/dicom', _prepend(first, chunks)
+
+def _prepend(first, chunks):
+    yield first
+    yield from chunks
@@ -0,0 +1,116 @@
+import os
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Directory listings run concurrently, on NFS each scandir is latency bound
+DEFAULT_DISCOVERY_WORKERS = int(os.environ.get('DICOM_DISCOVERY_WORKERS', '8'))
+# Files buffered between discovery and parsing
+DISCOVERY_QUEUE_SIZE = 10000
+
+_DONE = object()
+
+class DirectoryScanner:
+    """
+    Single-pass recursive file discovery.
+
+    Subdirectories are listed with os.scandir on a thread pool and every
+    file found is pushed onto a bounded queue as soon as it is seen, so
+    parsing starts while the tree is still being walked. `discovered` is a
+    running total usable as a progress estimate; `done` turns True once the
+    whole tree has been listed. Directories and files that could not be
+    listed or stat'ed (e.g. a transient EACCES or ESTALE on NFS) are kept
+    in `unreadable`, so callers do not mistake them for deleted files.
+    """
+
+    def __init__(self, root, workers=None):
+        self.root = root
+        self.workers = workers or DEFAULT_DISCOVERY_WORKERS
+        self.discovered = 0
+        self.done = False
+        self.unreadable = []
+        self._queue = queue.Queue(maxsize=DISCOVERY_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._pending_dirs = 0
+        self._stopped = threading.Event()
+        self._executor = None
+
+    def __iter__(self):
+        """Yield (file_path, stat_result) for every file under root"""
+        if os.path.isfile(self.root):
+            # A single file (e.g. an archive) was given instead of a folder
+            self.discovered = 1
+            yield self.root, os.stat(self.root)
+            self.done = True
+            return
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix='dicom-discovery'
+        )
+        self._submit(self.root)
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _DONE:
+                    self.done = True
+                    return
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop listing, used when the consumer gives up early"""
+        self._stopped.set()
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, directory):
+        with self._lock:
+            self._pending_dirs += 1
+        self._executor.submit(self._scan, directory)
+
+    def _put(self, item):
+        # Time out periodically so blocked workers notice close()
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _scan(self, directory):
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if self._stopped.is_set():
+                        return
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            self._submit(entry.path)
+                            continue
+                        if entry.is_dir():
+                            # Symlinked directory, not followed (same as os.walk)
+                            continue
+                        stat = entry.stat()
+                    except OSError as e:
+                        logger.debug(f"Skipping {entry.path}: {e}")
+                        with self._lock:
+                            self.unreadable.append(entry.path)
+                        continue
+                    with self._lock:
+                        self.discovered += 1
+                    self._put((entry.path, stat))
+        except OSError as e:
+            logger.warning(f"Could not list directory {directory}: {e}")
+            with self._lock:
+                self.unreadable.append(directory)
+        finally:
+            with self._lock:
+                self._pending_dirs -= 1
+                finished = self._pending_dirs == 0
+            if finished:
+                self._put(_DONE)
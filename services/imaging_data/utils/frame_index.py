@@ -0,0 +1,215 @@
+import os
+import mmap
+import struct
+import logging
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+import pydicom
+from pydicom.tag import Tag
+from pydicom.encaps import generate_pixel_data_frame
+from utils.archives import split_locator, open_locator
+
+logger = logging.getLogger(__name__)
+
+PIXEL_DATA_TAG = (0x7FE0, 0x0010)
+ITEM_TAG = (0xFFFE, 0xE000)
+SEQUENCE_DELIMITER_TAG = (0xFFFE, 0xE0DD)
+UNDEFINED_LENGTH = 0xFFFFFFFF
+# Explicit VRs with a 4 byte length field after two reserved bytes
+LONG_LENGTH_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'UC', b'UN', b'UR', b'UT'}
+# Attributes needed to lay out frames, read when building an index on its own
+FRAME_KEYWORDS = [
+    'Rows', 'Columns', 'SamplesPerPixel', 'BitsAllocated', 'NumberOfFrames', 'PhotometricInterpretation'
+]
+
+# Media type of a single frame per transfer syntax, uncompressed frames are octet streams
+FRAME_MEDIA_TYPES = {
+    '1.2.840.10008.1.2.4.50': 'image/jpeg',
+    '1.2.840.10008.1.2.4.51': 'image/jpeg',
+    '1.2.840.10008.1.2.4.57': 'image/jpeg',
+    '1.2.840.10008.1.2.4.70': 'image/jpeg',
+    '1.2.840.10008.1.2.4.80': 'image/jls',
+    '1.2.840.10008.1.2.4.81': 'image/jls',
+    '1.2.840.10008.1.2.4.90': 'image/jp2',
+    '1.2.840.10008.1.2.4.91': 'image/jp2',
+    '1.2.840.10008.1.2.5': 'image/x-dicom-rle',
+}
+# Open memory maps kept per process
+DEFAULT_FRAME_READER_SIZE = int(os.environ.get('FRAME_READER_SIZE', '256'))
+
+def frame_media_type(frame_index):
+    return FRAME_MEDIA_TYPES.get(frame_index.get('transfer_syntax_uid'), 'application/octet-stream')
+
+def native_frame_length(dataset):
+    """Bytes per uncompressed frame, None for bit-packed data that is not byte aligned"""
+    bits_allocated = int(dataset.get('BitsAllocated') or 0)
+    if bits_allocated % 8:
+        return None
+    length = int(dataset.Rows) * int(dataset.Columns) * int(dataset.get('SamplesPerPixel') or 1) * bits_allocated // 8
+    if str(dataset.get('PhotometricInterpretation', '')).strip() == 'YBR_FULL_422':
+        # Two chroma samples are shared by each pair of pixels
+        length = length * 2 // 3
+    return length
+
+def read_frame_index(fp, dataset):
+    """Frame byte ranges of the PixelData element that starts at fp's position.
+
+    fp must be positioned where dcmread(stop_before_pixels=True) left it.
+    Returns {'transfer_syntax_uid', 'number_of_frames', 'encapsulated',
+    'frames'} where frames holds one list of [offset, length] fragments per
+    frame, or None when the layout cannot be determined (no PixelData, big
+    endian, bit-packed, or a multi-fragment stream without offset table).
+    """
+    try:
+        if not dataset.is_little_endian:
+            return None
+        transfer_syntax_uid = str(dataset.file_meta.TransferSyntaxUID)
+        number_of_frames = int(dataset.get('NumberOfFrames') or 1)
+
+        start = fp.tell()
+        header = fp.read(8)
+        if len(header) < 8 or struct.unpack('<HH', header[:4]) != PIXEL_DATA_TAG:
+            return None
+        if dataset.is_implicit_VR:
+            length = struct.unpack('<I', header[4:8])[0]
+            value_start = start + 8
+        elif header[4:6] in LONG_LENGTH_VRS:
+            length = struct.unpack('<I', fp.read(4))[0]
+            value_start = start + 12
+        else:
+            length = struct.unpack('<H', header[6:8])[0]
+            value_start = start + 8
+
+        if length != UNDEFINED_LENGTH:
+            frame_length = native_frame_length(dataset)
+            if not frame_length or frame_length * number_of_frames > length:
+                return None
+            frames = [[[value_start + i * frame_length, frame_length]] for i in range(number_of_frames)]
+            encapsulated = False
+        else:
+            frames = _encapsulated_frames(fp, value_start, number_of_frames)
+            if frames is None:
+                return None
+            encapsulated = True
+
+        return {
+            'transfer_syntax_uid': transfer_syntax_uid,
+            'number_of_frames': number_of_frames,
+            'encapsulated': encapsulated,
+            'frames': frames
+        }
+    except (AttributeError, TypeError, ValueError, struct.error) as e:
+        logger.debug(f"Could not index frames: {e}")
+        return None
+
+def _encapsulated_frames(fp, value_start, number_of_frames):
+    """Group encapsulated fragments into frames by seeking from item header to item header"""
+    fp.seek(value_start)
+    items = []
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            return None
+        group, element, length = struct.unpack('<HHI', header)
+        if (group, element) == SEQUENCE_DELIMITER_TAG:
+            break
+        if (group, element) != ITEM_TAG:
+            return None
+        items.append([fp.tell(), length])
+        fp.seek(length, os.SEEK_CUR)
+
+    if not items:
+        return None
+    (table_offset, table_length), fragments = items[0], items[1:]
+    if not fragments:
+        return None
+
+    if table_length:
+        # Basic Offset Table: frame starts relative to the first fragment's item header
+        fp.seek(table_offset)
+        offsets = list(struct.unpack(f'<{table_length // 4}I', fp.read(table_length)))
+        base = fragments[0][0] - 8
+        frames = [[] for _ in offsets]
+        for fragment in fragments:
+            frames[bisect_right(offsets, fragment[0] - 8 - base) - 1].append(fragment)
+        return frames
+    if number_of_frames == 1:
+        return [fragments]
+    if len(fragments) == number_of_frames:
+        return [[fragment] for fragment in fragments]
+    return None
+
+def build_frame_index(file_path):
+    """Frame index of a stored file, None for archive members and unindexable files"""
+    _, member = split_locator(file_path)
+    if member is not None:
+        return None
+    try:
+        with open(file_path, 'rb') as fp:
+            dataset = pydicom.dcmread(
+                fp, force=True, stop_before_pixels=True, specific_tags=[Tag(k) for k in FRAME_KEYWORDS]
+            )
+            return read_frame_index(fp, dataset)
+    except Exception as e:
+        logger.debug(f"Could not index frames of {file_path}: {e}")
+        return None
+
+def parse_frame(file_path, frame_number):
+    """Bytes and media type of one frame (1-based) read through pydicom.
+
+    Fallback for instances without a frame index, e.g. archive members.
+    Raises IndexError for frame numbers outside the instance.
+    """
+    with open_locator(file_path) as f:
+        dataset = pydicom.dcmread(f, force=True)
+    transfer_syntax_uid = str(dataset.file_meta.TransferSyntaxUID)
+    number_of_frames = int(dataset.get('NumberOfFrames') or 1)
+    if not 1 <= frame_number <= number_of_frames:
+        raise IndexError(f"frame {frame_number} outside 1-{number_of_frames}")
+    if dataset.file_meta.TransferSyntaxUID.is_compressed:
+        for number, frame in enumerate(generate_pixel_data_frame(dataset.PixelData, number_of_frames), 1):
+            if number == frame_number:
+                break
+    else:
+        frame_length = len(dataset.PixelData) // number_of_frames
+        frame = dataset.PixelData[(frame_number - 1) * frame_length:frame_number * frame_length]
+    return frame, FRAME_MEDIA_TYPES.get(transfer_syntax_uid, 'application/octet-stream')
+
+class FrameReader:
+    """
+    Reads indexed frames straight from memory-mapped files.
+
+    Maps are kept open in a small LRU, so serving a frame is a slice of
+    the page cache without parsing the file. A map is reopened when the
+    file at the path was replaced or modified since it was mapped.
+    """
+
+    def __init__(self, max_open=None):
+        self.max_open = max_open or DEFAULT_FRAME_READER_SIZE
+        self.maps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, file_path, fragments):
+        """Bytes of one frame, its fragments concatenated"""
+        mapped = self._map(file_path)
+        return b''.join(mapped[offset:offset + length] for offset, length in fragments)
+
+    def _map(self, file_path):
+        stat = os.stat(file_path)
+        identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            entry = self.maps.get(file_path)
+            if entry is not None and entry[0] == identity:
+                self.maps.move_to_end(file_path)
+                return entry[1]
+
+        with open(file_path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with self._lock:
+            # Replaced maps are only dropped from the LRU; readers holding them keep a valid view
+            self.maps[file_path] = (identity, mapped)
+            self.maps.move_to_end(file_path)
+            while len(self.maps) > self.max_open:
+                self.maps.popitem(last=False)
+        return mapped
@@ -0,0 +1,269 @@
+import os
+import time
+import uuid
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Imports running concurrently, each one may start its own process pool
+DEFAULT_JOB_WORKERS = int(os.environ.get('INGEST_JOB_WORKERS', '1'))
+# Minimum seconds between progress writes to the jobs collection
+JOB_UPDATE_INTERVAL = 1.0
+
+# Seconds a process owns a job without renewing, after that another process may take it over
+JOB_LEASE_SECONDS = int(os.environ.get('INGEST_JOB_LEASE_SECONDS', '60'))
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+class IngestionJobManager:
+    """
+    Runs folder imports in background threads, detached from any HTTP request.
+
+    Job state lives in the ingestion_jobs collection so progress can be
+    polled by job ID and interrupted jobs can be picked up again after a
+    restart. Resume relies on the file manifest: every flushed chunk is a
+    checkpoint, and a resumed job runs incrementally so files committed
+    before the interruption are skipped.
+
+    Every process that imports the app has its own manager, so a job is
+    owned through a lease: the owner renews lease_until while the job is
+    queued or running, and other processes only take over a job whose
+    lease has expired. A cancel request may reach any process; the owner
+    picks up cancel_requested when it renews its leases or writes progress.
+    """
+
+    def __init__(self, db, parser_factory, max_workers=None):
+        self.collection = db.ingestion_jobs
+        self.parser_factory = parser_factory
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or DEFAULT_JOB_WORKERS,
+            thread_name_prefix='ingestion-job'
+        )
+        self.cancel_events = {}
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lease_thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, folder_path, options=None):
+        """Queue an import and return its job ID"""
+        job_id = uuid.uuid4().hex
+        self.collection.insert_one({
+            'job_id': job_id,
+            'folder_path': folder_path,
+            'options': options or {},
+            'status': 'queued',
+            'progress': {'current': 0, 'total': 0, 'percentage': 0},
+            'resume_count': 0,
+            'owner': self.owner,
+            'lease_until': self._lease_until(),
+            'created_at': datetime.utcnow()
+        })
+        self._start(job_id)
+        return job_id
+
+    def get(self, job_id):
+        return self.collection.find_one({'job_id': job_id}, {'_id': 0})
+
+    def list_jobs(self, limit=50):
+        return list(self.collection.find({}, {'_id': 0}).sort('created_at', -1).limit(limit))
+
+    def cancel(self, job_id):
+        """Request cancellation, returns False if the job is not active"""
+        result = self.collection.update_one(
+            {'job_id': job_id, 'status': {'$in': list(ACTIVE_STATUSES)}},
+            {'$set': {'cancel_requested': True}}
+        )
+        event = self.cancel_events.get(job_id)
+        if event:
+            event.set()
+        return result.matched_count > 0
+
+    def resume_interrupted(self):
+        """Claim and restart jobs left queued or running by a process that stopped.
+
+        A job is only claimed when it has no owner or its lease has expired,
+        so replicas and gunicorn workers never run the same job twice. The
+        lease thread calls this again periodically, which picks up jobs of
+        processes that died after startup.
+        """
+        self._ensure_lease_thread()
+        resumed = []
+        for job in self.collection.find({'status': {'$in': list(ACTIVE_STATUSES)}}, {'job_id': 1}):
+            if job['job_id'] in self.cancel_events:
+                # Already queued or running in this process
+                continue
+            job = self._claim(job['job_id'])
+            if job is None:
+                continue
+            if job.get('cancel_requested'):
+                self._finish(job['job_id'], 'cancelled')
+                continue
+            self._start(job['job_id'])
+            resumed.append(job['job_id'])
+        if resumed:
+            logger.info(f"Resuming {len(resumed)} interrupted ingestion jobs")
+        return resumed
+
+    def _claim(self, job_id):
+        """Take over an active job whose lease is free or expired, None if another process owns it"""
+        now = datetime.utcnow()
+        return self.collection.find_one_and_update(
+            {
+                'job_id': job_id,
+                'status': {'$in': list(ACTIVE_STATUSES)},
+                '$or': [{'owner': None}, {'lease_until': {'$lt': now}}]
+            },
+            {
+                '$set': {'status': 'queued', 'owner': self.owner, 'lease_until': self._lease_until()},
+                '$inc': {'resume_count': 1}
+            },
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _lease_until(self):
+        return datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)
+
+    def _ensure_lease_thread(self):
+        with self._lock:
+            if self._lease_thread is None:
+                self._lease_thread = threading.Thread(
+                    target=self._maintain_leases, name='ingestion-job-lease', daemon=True
+                )
+                self._lease_thread.start()
+
+    def _maintain_leases(self):
+        """Renew the leases of this process's jobs and take over jobs whose owner died"""
+        while True:
+            time.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                self.collection.update_many(
+                    {'owner': self.owner, 'status': {'$in': list(ACTIVE_STATUSES)}},
+                    {'$set': {'lease_until': self._lease_until()}}
+                )
+                self._sync_cancel_requests()
+                self.resume_interrupted()
+            except Exception as e:
+                logger.error(f"Renewing ingestion job leases failed: {e}")
+
+    def _sync_cancel_requests(self):
+        """Set the local cancel event of owned jobs cancelled through another process"""
+        cancelled = self.collection.find(
+            {'owner': self.owner, 'status': {'$in': list(ACTIVE_STATUSES)}, 'cancel_requested': True},
+            {'job_id': 1}
+        )
+        for job in cancelled:
+            event = self.cancel_events.get(job['job_id'])
+            if event:
+                event.set()
+
+    def _start(self, job_id):
+        self._ensure_lease_thread()
+        self.cancel_events[job_id] = threading.Event()
+        self.executor.submit(self._run, job_id)
+
+    def _run(self, job_id):
+        cancel_event = self.cancel_events[job_id]
+        job = self.get(job_id)
+        try:
+            if cancel_event.is_set() or job.get('cancel_requested'):
+                self._finish(job_id, 'cancelled')
+                return
+
+            # Resumed jobs always run incrementally so checkpointed files are skipped
+            options = dict(job['options'])
+            if job['resume_count']:
+                options['incremental'] = True
+            parser = self.parser_factory(**options)
+            # Checked by the parser per file, also while unchanged files are skipped
+            parser.set_cancel_event(cancel_event)
+
+            started = time.monotonic()
+            claimed = self.collection.update_one(
+                {'job_id': job_id, 'owner': self.owner},
+                {'$set': {'status': 'running', 'started_at': datetime.utcnow()}}
+            )
+            if not claimed.matched_count:
+                logger.warning(f"Ingestion job {job_id} was taken over by another process")
+                return
+
+            last_update = started
+            progress_events = parser.parse(job['folder_path'])
+            for progress in progress_events:
+                if cancel_event.is_set() or progress.get('cancelled'):
+                    progress_events.close()
+                    self._finish(job_id, 'cancelled')
+                    return
+                if 'error' in progress:
+                    self._finish(job_id, 'failed', error=progress['error'])
+                    return
+                if progress.get('complete'):
+                    elapsed = time.monotonic() - started
+                    self._finish(job_id, 'completed', result={
+                        'elapsed_seconds': round(elapsed, 1),
+                        'files_per_sec': round(progress['total_processed'] / elapsed, 1) if elapsed > 0 else None,
+                        'total_processed': progress['total_processed'],
+                        'total_succeeded': progress['total_succeeded'],
+                        'skipped': progress.get('skipped'),
+                        'manifest': progress.get('manifest'),
+                        'studies': len(progress.get('studies', []))
+                    })
+                    return
+
+                now = time.monotonic()
+                if now - last_update >= JOB_UPDATE_INTERVAL:
+                    last_update = now
+                    if not self._update_progress(job_id, progress, now - started):
+                        # The lease expired and another process owns the job now
+                        logger.warning(f"Lost the lease on ingestion job {job_id}, stopping")
+                        progress_events.close()
+                        return
+        except Exception as e:
+            logger.error(f"Ingestion job {job_id} failed: {e}", exc_info=True)
+            self._finish(job_id, 'failed', error=str(e))
+        finally:
+            self.cancel_events.pop(job_id, None)
+
+    def _update_progress(self, job_id, progress, elapsed):
+        """Write progress, returns False when this process no longer owns the job.
+
+        A cancel requested through another process sets the local cancel event.
+        """
+        current = progress.get('current', 0)
+        total = progress.get('total', 0)
+        files_per_sec = current / elapsed if elapsed > 0 else 0
+        eta_seconds = (total - current) / files_per_sec if files_per_sec and total > current else None
+        job = self.collection.find_one_and_update(
+            {'job_id': job_id, 'owner': self.owner},
+            {'$set': {
+                'progress': {
+                    'current': current,
+                    'total': total,
+                    'percentage': progress.get('percentage', 0),
+                    'estimated': progress.get('estimated', False)
+                },
+                'files_per_sec': round(files_per_sec, 1),
+                'eta_seconds': round(eta_seconds) if eta_seconds is not None else None,
+                'updated_at': datetime.utcnow()
+            }},
+            projection={'cancel_requested': 1}
+        )
+        if job is None:
+            return False
+        if job.get('cancel_requested') and job_id in self.cancel_events:
+            self.cancel_events[job_id].set()
+        return True
+
+    def _finish(self, job_id, status, result=None, error=None):
+        update = {'status': status, 'finished_at': datetime.utcnow(), 'eta_seconds': None}
+        if result is not None:
+            update['result'] = result
+            update['progress.percentage'] = 100
+        if error is not None:
+            update['error'] = error
+        self.collection.update_one({'job_id': job_id, 'owner': self.owner}, {'$set': update})
+        logger.info(f"Ingestion job {job_id} {status}")
@@ -0,0 +1,168 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from utils.archives import locator_identity
+from utils.mongo_utils import BulkWriter
+from utils.legacy_instances import normalize_studies
+
+logger = logging.getLogger(__name__)
+
+# Resolved SOP UIDs kept in memory per process
+DEFAULT_INSTANCE_CACHE_SIZE = int(os.environ.get('INSTANCE_CACHE_SIZE', '10000'))
+
+LOCATION_FIELDS = (
+    'sop_instance_uid', 'series_uid', 'study_instance_uid', 'instance_number', 'file_path',
+    'viewer_metadata', 'frame_index', 'file_identity'
+)
+# Fields returned when listing the instances of a series
+INSTANCE_PROJECTION = {'_id': 0, 'sop_instance_uid': 1, 'instance_number': 1, 'file_path': 1}
+
+class InstanceIndex:
+    """
+    Resolves a SOP Instance UID to its stored file location.
+
+    Lookups go to the instances collection through its unique
+    sop_instance_uid index and are kept in an LRU cache, so the viewer's
+    per-image requests cost one dict lookup after the first hit. Studies
+    saved before instances were indexed separately are found through the
+    multikey index on series.instances.sop_instance_uid and backfilled;
+    series and study listings that come back empty normalize the study
+    the same way the migration does and read again.
+    """
+
+    def __init__(self, db, cache_size=None):
+        self.db = db
+        self.cache_size = cache_size or DEFAULT_INSTANCE_CACHE_SIZE
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def locate(self, sop_instance_uid):
+        """Return the location document for a SOP UID, or None if it is unknown.
+
+        A cached entry is only used while the file still has the size and
+        mtime it had when cached, so a file rewritten in place (e.g. a
+        re-sent C-STORE) never serves old frame offsets. A location whose
+        recorded identity no longer matches the file is returned but not
+        cached until the file has been indexed again.
+        """
+        with self._lock:
+            entry = self.cache.get(sop_instance_uid)
+        if entry is not None:
+            identity, location = entry
+            if identity == locator_identity(location.get('file_path')):
+                with self._lock:
+                    if sop_instance_uid in self.cache:
+                        self.cache.move_to_end(sop_instance_uid)
+                    self.hits += 1
+                return location
+            self.invalidate(sop_instance_uid)
+        with self._lock:
+            self.misses += 1
+
+        location = self._find(sop_instance_uid)
+        if location is not None:
+            identity = locator_identity(location.get('file_path'))
+            # Instances indexed before identities were stored are trusted as they are
+            if location.get('file_identity') in (None, identity):
+                with self._lock:
+                    self.cache[sop_instance_uid] = (identity, location)
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+        return location
+
+    def invalidate(self, sop_instance_uid=None):
+        """Drop one cached location (e.g. a file that moved), or all of them"""
+        with self._lock:
+            if sop_instance_uid is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(sop_instance_uid, None)
+
+    def series_instances(self, series_uid):
+        """Instances of one series in instance order, served by the (series_uid, instance_number) index"""
+        def find():
+            return list(self.db.instances.find({'series_uid': series_uid}, INSTANCE_PROJECTION).sort('instance_number', 1))
+        instances = find()
+        if not instances and self.normalize_embedded({'series.series_uid': series_uid}):
+            instances = find()
+        return instances
+
+    def series_metadata(self, series_uid):
+        """Location and viewer metadata of every instance in a series, in instance order"""
+        projection = {'_id': 0, **{field: 1 for field in LOCATION_FIELDS}}
+        def find():
+            return list(self.db.instances.find({'series_uid': series_uid}, projection).sort('instance_number', 1))
+        instances = find()
+        if not instances and self.normalize_embedded({'series.series_uid': series_uid}):
+            instances = find()
+        return instances
+
+    def study_instances(self, study_instance_uid):
+        """Instances of a study grouped by series UID, each list in instance order"""
+        def find():
+            by_series = {}
+            cursor = self.db.instances.find(
+                {'study_instance_uid': study_instance_uid},
+                {**INSTANCE_PROJECTION, 'series_uid': 1}
+            ).sort('instance_number', 1)
+            for instance in cursor:
+                by_series.setdefault(instance.pop('series_uid'), []).append(instance)
+            return by_series
+        by_series = find()
+        if not by_series and self.normalize_embedded({'study_instance_uid': study_instance_uid}):
+            by_series = find()
+        return by_series
+
+    def normalize_embedded(self, query):
+        """Move instances still embedded in the matching studies to the instances collection.
+
+        Returns True when any instance was moved. Only called when the
+        instances collection has nothing for the query, so normalized
+        studies cost one indexed find.
+        """
+        studies = list(self.db.studies.find({**query, 'series.instances.0': {'$exists': True}}))
+        if not studies:
+            return False
+        stats = normalize_studies(self.db, BulkWriter(), studies)
+        logger.info(f"Normalized {stats['studies']} studies with {stats['instances']} embedded instances on read")
+        return stats['instances'] > 0
+
+    def stats(self):
+        return {'cached': len(self.cache), 'hits': self.hits, 'misses': self.misses}
+
+    def _find(self, sop_instance_uid):
+        projection = {'_id': 0, **{field: 1 for field in LOCATION_FIELDS}}
+        location = self.db.instances.find_one({'sop_instance_uid': sop_instance_uid}, projection)
+        if location is not None:
+            return location
+        return self._find_embedded(sop_instance_uid)
+
+    def _find_embedded(self, sop_instance_uid):
+        """Look the instance up inside its study document and backfill the instances collection"""
+        study = self.db.studies.find_one(
+            {'series.instances.sop_instance_uid': sop_instance_uid},
+            {'_id': 0, 'study_instance_uid': 1, 'series': {'$elemMatch': {'instances.sop_instance_uid': sop_instance_uid}}}
+        )
+        if not study:
+            return None
+
+        series = study['series'][0]
+        for instance in series.get('instances', []):
+            if isinstance(instance, dict) and instance.get('sop_instance_uid') == sop_instance_uid:
+                location = {
+                    'sop_instance_uid': sop_instance_uid,
+                    'series_uid': series.get('series_uid'),
+                    'study_instance_uid': study['study_instance_uid'],
+                    'instance_number': instance.get('instance_number', 0),
+                    'file_path': instance.get('file_path')
+                }
+                self.db.instances.update_one(
+                    {'sop_instance_uid': sop_instance_uid},
+                    {'$set': location},
+                    upsert=True
+                )
+                return location
+        return None
@@ -0,0 +1,101 @@
+import logging
+from pymongo import UpdateOne
+from utils.mongo_utils import BulkWriteFailed
+
+logger = logging.getLogger(__name__)
+
+def parse_legacy_instance(value):
+    """Parse a PowerShell-style "@{key=value; ...}" instance string into a dict"""
+    if value.startswith('@{') and value.endswith('}'):
+        value = value[2:-1]
+    instance = {}
+    for part in value.split('; '):
+        if '=' not in part:
+            continue
+        key, field_value = part.split('=', 1)
+        instance[key.strip()] = field_value
+    return instance
+
+def normalize_instance(instance):
+    """Coerce a legacy or embedded instance to the instances collection field types"""
+    if isinstance(instance, str):
+        instance = parse_legacy_instance(instance)
+    if not instance.get('sop_instance_uid'):
+        return None
+    normalized = dict(instance)
+    try:
+        normalized['instance_number'] = int(instance.get('instance_number') or 0)
+    except ValueError:
+        normalized['instance_number'] = 0
+    if normalized.get('file_path'):
+        normalized['file_path'] = normalized['file_path'].replace('\\', '/')
+    return normalized
+
+def extract_embedded_instances(study):
+    """Remove instances embedded in a study's series and return them as instance documents.
+
+    Both dict instances and legacy strings are converted; series keep their
+    metadata only. Entries without a SOP UID are dropped with a warning.
+    """
+    study_uid = study.get('study_instance_uid') or study.get('study_uid')
+    documents = []
+    for series in study.get('series', []):
+        for instance in series.pop('instances', None) or []:
+            document = normalize_instance(instance)
+            if document is None:
+                logger.warning(f"Dropping embedded instance without SOP UID in study {study_uid}")
+                continue
+            document['series_uid'] = series.get('series_uid')
+            document['study_instance_uid'] = study_uid
+            documents.append(document)
+    return documents
+
+def normalize_studies(db, bulk, studies, dry_run=False):
+    """Move the embedded instances of a batch of study documents to the instances collection.
+
+    The instance upserts are written first, then the studies with their
+    embedded instances removed and per-series counts set. Studies with an
+    instance upsert that failed keep their embedded instances. Returns
+    {'studies', 'instances', 'failed_studies'} counters.
+    """
+    stats = {'studies': 0, 'instances': 0, 'failed_studies': 0}
+    updates = []
+    for study in studies:
+        instances = extract_embedded_instances(study)
+        counts = {}
+        for instance in instances:
+            counts[instance['series_uid']] = counts.get(instance['series_uid'], 0) + 1
+            if not dry_run:
+                # The study _id travels with the upsert, so a failed one names the study to keep embedded
+                bulk.upsert(
+                    db.instances,
+                    {'sop_instance_uid': instance['sop_instance_uid']},
+                    {'$set': instance},
+                    owner=study['_id']
+                )
+
+        for series in study['series']:
+            series['num_instances'] = counts.get(series.get('series_uid'), 0)
+        updates.append((study['_id'], UpdateOne({'_id': study['_id']}, {'$set': {
+            'series': study['series'],
+            'num_series': len(study['series']),
+            'num_instances': len(instances)
+        }})))
+        stats['studies'] += 1
+        stats['instances'] += len(instances)
+
+    if dry_run:
+        return stats
+    # Instances must be stored before they are removed from their studies
+    failed_studies = set()
+    try:
+        bulk.flush()
+    except BulkWriteFailed as e:
+        failed_studies = {owner for _, _, _, owner in e.failed}
+        logger.error(f"{len(e.failed)} instance upserts failed, keeping {len(failed_studies)} studies embedded")
+        stats['failed_studies'] = len(failed_studies)
+    for study_id, update in updates:
+        if study_id not in failed_studies:
+            bulk.add(db.studies, update)
+    bulk.flush()
+    return stats
@@ -0,0 +1,169 @@
+import os
+import re
+import hashlib
+import logging
+from datetime import datetime
+from pymongo import DeleteOne
+from utils.mongo_utils import BulkWriter
+
+logger = logging.getLogger(__name__)
+
+# Bytes hashed from the start and end of a file for the optional fast hash
+HASH_SAMPLE_SIZE = 64 * 1024
+
+def fast_hash(file_path, size):
+    """Hash file size plus the first and last 64 KiB.
+
+    Cheap enough to run on every changed file, and catches touched-but-identical
+    copies whose mtime changed without the content changing.
+    """
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(file_path, 'rb') as f:
+        digest.update(f.read(HASH_SAMPLE_SIZE))
+        if size > 2 * HASH_SAMPLE_SIZE:
+            f.seek(-HASH_SAMPLE_SIZE, os.SEEK_END)
+            digest.update(f.read(HASH_SAMPLE_SIZE))
+    return digest.hexdigest()
+
+class FileManifest:
+    """
+    Persistent record of scanned files keyed by absolute path.
+
+    Each entry stores size, mtime and (optionally) a fast hash together with
+    the UIDs the file was indexed under, so a rescan can skip unchanged files
+    and clean up instances whose files have disappeared.
+    """
+
+    def __init__(self, collection, root, use_hash=False, skip_unchanged=True, preload=True):
+        self.collection = collection
+        self.root = os.path.abspath(root)
+        self.use_hash = use_hash
+        # False forces a full rescan that still refreshes the manifest
+        self.skip_unchanged = skip_unchanged
+        # Long-lived manifests (watch mode) load entries per batch with load() instead
+        self.known = {}
+        if preload:
+            self.known = {
+                entry['path']: entry
+                for entry in collection.find(
+                    {'path': self._path_filter()},
+                    {'_id': 0}
+                )
+            }
+        self.seen = set()
+        self.pending = {}
+        # Entries of modified files that now hold a different SOP instance
+        self.replaced = []
+        self.stats = {'new': 0, 'modified': 0, 'unchanged': 0, 'deleted': 0}
+        logger.info(f"Loaded {len(self.known)} manifest entries under {self.root}")
+
+    def _path_filter(self):
+        """Entries under the root; the trailing separator keeps /data/dicom2 out of a /data/dicom scan"""
+        if os.path.isfile(self.root):
+            # A single file (e.g. an archive) was scanned
+            return self.root
+        return {'$regex': f'^{re.escape(os.path.join(self.root, ""))}'}
+
+    def load(self, file_paths):
+        """Fetch the stored entries of the given files in one query"""
+        paths = [os.path.abspath(p) for p in file_paths]
+        for entry in self.collection.find({'path': {'$in': paths}}, {'_id': 0}):
+            self.known[entry['path']] = entry
+
+    def forget(self, file_paths):
+        """Drop files from memory once their batch is committed, the stored entries stay"""
+        for path in file_paths:
+            path = os.path.abspath(path)
+            self.seen.discard(path)
+            self.known.pop(path, None)
+
+    def is_unchanged(self, file_path, stat=None):
+        """Check a file against the manifest and remember it for recording"""
+        path = os.path.abspath(file_path)
+        self.seen.add(path)
+        stat = stat or os.stat(path)
+        entry = self.known.get(path)
+        current = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+        if self.skip_unchanged and entry and entry['size'] == current['size']:
+            if entry['mtime'] == current['mtime']:
+                self.stats['unchanged'] += 1
+                return True
+            # Same size, new mtime: only a content hash can tell
+            if self.use_hash and entry.get('hash'):
+                current['hash'] = fast_hash(path, stat.st_size)
+                if current['hash'] == entry['hash']:
+                    self.stats['unchanged'] += 1
+                    self.pending[path] = {**entry, **current}
+                    return True
+
+        if self.use_hash and 'hash' not in current:
+            current['hash'] = fast_hash(path, stat.st_size)
+        self.stats['modified' if entry else 'new'] += 1
+        self.pending[path] = current
+        return False
+
+    def record(self, file_path, result):
+        """Attach the parse result UIDs to a pending entry"""
+        entry = self.pending.get(os.path.abspath(file_path))
+        if entry is None:
+            return
+        entry['dicom'] = bool(result)
+        if result:
+            entry['study_instance_uid'] = result['study']['study_instance_uid']
+            entry['series_uid'] = result['series']['series_uid']
+            entry['sop_instance_uid'] = result['instance']['sop_instance_uid']
+        previous = self.known.get(entry['path'])
+        if previous and previous.get('sop_instance_uid') and previous['sop_instance_uid'] != entry.get('sop_instance_uid'):
+            self.replaced.append(previous)
+
+    def take_replaced(self):
+        """Previous entries of rewritten files whose old instance must be removed"""
+        replaced, self.replaced = self.replaced, []
+        return replaced
+
+    def deleted_entries(self, unreadable=()):
+        """Manifest entries under the root that were not seen in this scan.
+
+        Entries at or under an unreadable path are kept: a directory that
+        failed to list says nothing about whether its files still exist.
+        """
+        prefixes = tuple(os.path.join(os.path.abspath(path), '') for path in unreadable)
+        exact = {os.path.abspath(path) for path in unreadable}
+        return [
+            entry for path, entry in self.known.items()
+            if path not in self.seen and path not in exact and not path.startswith(prefixes)
+        ]
+
+    def commit(self, deleted=(), paths=None):
+        """Write pending entries and drop deleted ones.
+
+        Called only after the corresponding studies have been saved, so a
+        crash mid-import leaves those files to be picked up by the next scan.
+        With paths, only those files are written; files still being parsed
+        stay pending.
+        """
+        if paths is None:
+            entries, self.pending = self.pending, {}
+        else:
+            entries = {}
+            for path in paths:
+                path = os.path.abspath(path)
+                if path in self.pending:
+                    entries[path] = self.pending.pop(path)
+        now = datetime.utcnow()
+        bulk = BulkWriter()
+        for path, entry in entries.items():
+            bulk.upsert(self.collection, {'path': path}, {'$set': {**entry, 'last_seen': now}})
+        for entry in deleted:
+            bulk.add(self.collection, DeleteOne({'path': entry['path']}))
+        bulk.flush()
+        self.stats['deleted'] += len(deleted)
+        self.known.update(entries)
+        for entry in deleted:
+            self.known.pop(entry['path'], None)
+
+    def discard(self, paths):
+        """Forget pending entries whose results could not be saved, so the next scan retries them"""
+        for path in paths:
+            self.pending.pop(os.path.abspath(path), None)
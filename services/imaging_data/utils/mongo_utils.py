@@ -1,4 +1,7 @@
+import os
 import logging
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -18,19 +21,93 @@ def init_mongo_indexes(db):
             ('series.series_uid', 1),
             ('study_instance_uid', 1)
         ])
+
+        # SOP UID lookups for per-image requests
+        db.studies.create_index('series.instances.sop_instance_uid')
+        db.instances.create_index('sop_instance_uid', unique=True)
+
+        # Normalized instances, listed per series in instance order
+        db.instances.create_index([('series_uid', 1), ('instance_number', 1)])
+        db.instances.create_index('study_instance_uid')
+
+        # File manifest used for incremental rescans
+        db.file_manifest.create_index('path', unique=True)
+
+        # Background ingestion jobs
+        db.ingestion_jobs.create_index('job_id', unique=True)
+        db.ingestion_jobs.create_index('status')
         
         logger.info("MongoDB indexes initialized successfully")
     except Exception as e:
         logger.error(f"Error creating indexes: {e}")
 
-def get_or_create_document(collection, query, data):
+# Operations sent per bulk_write call during ingestion
+DEFAULT_BULK_BATCH_SIZE = int(os.environ.get('MONGO_BULK_BATCH_SIZE', '1000'))
+
+class BulkWriteFailed(Exception):
+    """Raised by BulkWriter.flush() when operations were rejected.
+
+    failed holds (collection name, operation, error message, owner)
+    tuples, where owner is the value passed to add() with the operation,
+    so callers can tell which documents were not written.
+    """
+
+    def __init__(self, failed):
+        self.failed = failed
+        super().__init__(f"{len(failed)} bulk write operations failed, first: {failed[0][2]}")
+
+class BulkWriter:
     """
-    Get an existing document or create it if it doesn't exist.
-    Returns (document, created) tuple.
+    Buffers write operations per collection and sends them as unordered
+    bulk_write batches, so ingestion costs one round trip per batch
+    instead of one per entity. Rejected operations are collected and
+    raised from flush() as BulkWriteFailed. Each operation may carry an
+    owner, kept in a list parallel to the batch and reported back by the
+    index bulk_write gives for a failed operation.
     """
-    document = collection.find_one(query)
-    if document:
-        return document, False
-    
-    result = collection.insert_one(data)
-    return collection.find_one({'_id': result.inserted_id}), True 
\ No newline at end of file
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or DEFAULT_BULK_BATCH_SIZE
+        self.pending = {}
+        self.failed = []
+
+    def add(self, collection, operation, owner=None):
+        """Queue an operation, writing the batch once it is full. Returns the operation."""
+        _, operations, owners = self.pending.setdefault(collection.full_name, (collection, [], []))
+        operations.append(operation)
+        owners.append(owner)
+        if len(operations) >= self.batch_size:
+            self._write(collection.full_name)
+        return operation
+
+    def upsert(self, collection, query, update, owner=None):
+        return self.add(collection, UpdateOne(query, update, upsert=True), owner)
+
+    def flush(self):
+        """Write everything that is still buffered, raising BulkWriteFailed if anything was rejected"""
+        for name in list(self.pending):
+            self._write(name)
+        if self.failed:
+            failed, self.failed = self.failed, []
+            raise BulkWriteFailed(failed)
+
+    def _write(self, name):
+        collection, operations, owners = self.pending.pop(name)
+        if not operations:
+            return
+        try:
+            collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Unordered writes carry on past failures, keep the rejected ones for flush()
+            errors = e.details.get('writeErrors', [])
+            logger.error(f"Bulk write to {name} failed for {len(errors)} of {len(operations)} operations")
+            for error in errors[:5]:
+                logger.error(f"  {error.get('errmsg')}")
+            if errors:
+                self.failed.extend(
+                    (name, operations[error['index']], error.get('errmsg'), owners[error['index']])
+                    for error in errors
+                )
+            else:
+                # Write concern errors do not say which operations were affected
+                self.failed.extend((name, operation, str(e), owner) for operation, owner in zip(operations, owners))
@@ -0,0 +1,181 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from pydicom.encaps import encapsulate
+from pydicom.pixel_data_handlers.util import convert_color_space
+from utils.volume import read_slice, read_header
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+RENDER_MIMETYPES = {'png': 'image/png', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+RENDER_FORMATS = tuple(RENDER_MIMETYPES) if Image is not None else ()
+DEFAULT_RENDER_QUALITY = 90
+# Longest side of a rendered image, larger requests are clamped
+MAX_RENDER_SIZE = 4096
+# Size budget of rendered images kept in memory per process
+DEFAULT_RENDER_CACHE_MB = int(os.environ.get('RENDER_CACHE_MB', '256'))
+
+# Common CT windows as (center, width) in Hounsfield units
+WINDOW_PRESETS = {
+    'brain': (40, 80),
+    'subdural': (75, 215),
+    'stroke': (40, 40),
+    'temporal_bone': (600, 2800),
+    'bone': (400, 1800),
+    'soft_tissue': (50, 350),
+}
+
+def native_frame_pixels(data, metadata):
+    """Grayscale frame from raw native bytes and the viewer metadata, None if not applicable"""
+    if metadata.get('samplesPerPixel', 1) != 1 or metadata.get('bitsAllocated') not in (8, 16, 32):
+        return None
+    rows, columns = metadata.get('rows'), metadata.get('columns')
+    if not rows or not columns or len(data) != rows * columns * metadata['bitsAllocated'] // 8:
+        # Incomplete or stale metadata, left to pydicom
+        return None
+    signed = metadata.get('pixelRepresentation') == 1
+    bits_stored = metadata.get('bitsStored') or metadata['bitsAllocated']
+    if signed and bits_stored < metadata['bitsAllocated']:
+        # Needs sign extension, left to pydicom
+        return None
+    dtype = np.dtype(f"{'i' if signed else 'u'}{metadata['bitsAllocated'] // 8}").newbyteorder('<')
+    pixels = np.frombuffer(data, dtype=dtype).reshape(rows, columns)
+    if bits_stored < metadata['bitsAllocated']:
+        # Bits above BitsStored may hold overlays
+        pixels = pixels & ((1 << bits_stored) - 1)
+    return pixels
+
+def decode_frame(file_path, frame_number, frame_data=None, encapsulated=False):
+    """(pixels, photometric interpretation) of one frame decoded through pydicom.
+
+    With frame_data, the frame's bytes read through the frame index, only
+    that frame is decoded: the header is read without pixel data and given
+    a single-frame PixelData. Otherwise the whole pixel data is decoded.
+    """
+    if frame_data is not None:
+        dataset = read_header(file_path)
+        if encapsulated:
+            dataset.add_new(0x7FE00010, 'OB', encapsulate([frame_data]))
+            dataset['PixelData'].is_undefined_length = True
+        else:
+            dataset.add_new(0x7FE00010, 'OB' if int(dataset.BitsAllocated) <= 8 else 'OW', frame_data)
+        dataset.NumberOfFrames = 1
+        pixels = dataset.pixel_array
+    else:
+        dataset = read_slice(file_path)
+        pixels = dataset.pixel_array
+        number_of_frames = int(dataset.get('NumberOfFrames') or 1)
+        if not 1 <= frame_number <= number_of_frames:
+            raise IndexError(f"frame {frame_number} outside 1-{number_of_frames}")
+        if number_of_frames > 1:
+            pixels = pixels[frame_number - 1]
+    photometric = str(dataset.get('PhotometricInterpretation', 'MONOCHROME2')).strip()
+    if photometric.startswith('YBR') and pixels.ndim == 3:
+        pixels = convert_color_space(pixels, photometric, 'RGB')
+        photometric = 'RGB'
+    return pixels, photometric
+
+def apply_window(pixels, center=None, width=None, slope=1.0, intercept=0.0, photometric='MONOCHROME2'):
+    """Modality LUT and linear VOI window as in DICOM PS3.3 C.11.2.1.2, to uint8.
+
+    Without a window the frame's own value range is used. MONOCHROME1 is
+    inverted so higher values are darker.
+    """
+    values = pixels.astype(np.float32)
+    if slope != 1.0 or intercept != 0.0:
+        values = values * np.float32(slope) + np.float32(intercept)
+    if center is None or width is None:
+        low, high = float(values.min()), float(values.max())
+        center, width = (low + high) / 2, max(high - low, 1.0)
+    width = max(float(width), 1.0)
+    values -= np.float32(center - 0.5)
+    values /= np.float32(max(width - 1, 1.0))
+    values += np.float32(0.5)
+    np.clip(values, 0.0, 1.0, out=values)
+    if photometric == 'MONOCHROME1':
+        values = 1.0 - values
+    return (values * 255.0 + 0.5).astype(np.uint8)
+
+def render_pixels(pixels, photometric, metadata, center=None, width=None):
+    """uint8 image of a decoded frame; grayscale frames are windowed, color frames scaled"""
+    if pixels.ndim == 3:
+        if pixels.dtype == np.uint8:
+            return pixels
+        return (pixels.astype(np.float32) * (255.0 / max(float(pixels.max()), 1.0))).astype(np.uint8)
+    # Each value falls back to the stored window on its own, so wc alone keeps the stored width
+    center = center if center is not None else metadata.get('windowCenter')
+    width = width if width is not None else metadata.get('windowWidth')
+    return apply_window(
+        pixels, center, width,
+        slope=metadata.get('rescaleSlope', 1.0),
+        intercept=metadata.get('rescaleIntercept', 0.0),
+        photometric=photometric
+    )
+
+def encode_image(image, fmt='png', size=None, quality=DEFAULT_RENDER_QUALITY):
+    """Encode a uint8 grayscale or RGB array, scaled down so the longest side is at most size"""
+    if Image is None:
+        raise ValueError('rendering requires the Pillow package')
+    picture = Image.fromarray(image)
+    if size and max(picture.size) > size:
+        scale = size / max(picture.size)
+        picture = picture.resize(
+            (max(1, round(picture.width * scale)), max(1, round(picture.height * scale))),
+            Image.BILINEAR
+        )
+    buffer = io.BytesIO()
+    if fmt == 'png':
+        # Fast compression; the cache keeps the result
+        picture.save(buffer, format='PNG', compress_level=1)
+    elif fmt == 'jpeg':
+        picture.save(buffer, format='JPEG', quality=quality)
+    else:
+        picture.save(buffer, format='WEBP', quality=quality)
+    return buffer.getvalue()
+
+class RenderCache:
+    """
+    LRU cache of encoded rendered frames, bounded by total bytes.
+
+    Keys include the file identity, so a re-ingested file never serves an
+    old image.
+    """
+
+    def __init__(self, max_mb=None):
+        self.max_bytes = (DEFAULT_RENDER_CACHE_MB if max_mb is None else max_mb) * 1024 ** 2
+        self.entries = OrderedDict()
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self.entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.total -= len(previous)
+            self.entries[key] = body
+            self.total += len(body)
+            while self.total > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total -= len(evicted)
+
+    def stats(self):
+        return {'cached': len(self.entries), 'bytes': self.total, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,196 @@
+import os
+import re
+import time
+import queue
+import logging
+import threading
+from pydicom.dataset import Dataset
+from pydicom.filewriter import write_file_meta_info
+from parsers.base_parser import BaseParser
+
+try:
+    from pynetdicom import AE, evt, AllStoragePresentationContexts
+    from pynetdicom.sop_class import Verification
+except ImportError:
+    AE = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AE_TITLE = os.environ.get('DICOM_SCP_AE_TITLE', 'NEURO_PLATFORM')
+# Received instances are written as <store_dir>/<study>/<series>/<sop>.dcm
+DEFAULT_STORE_DIR = os.environ.get('DICOM_STORE_DIR', '/data/dicom_store')
+# Concurrent associations, each one is served by its own thread
+DEFAULT_MAX_ASSOCIATIONS = int(os.environ.get('DICOM_SCP_MAX_ASSOCIATIONS', '10'))
+# Instances indexed per bulk write, and seconds before a partial batch is written anyway
+DEFAULT_INDEX_BATCH_SIZE = int(os.environ.get('DICOM_SCP_BATCH_SIZE', '500'))
+INDEX_FLUSH_INTERVAL = float(os.environ.get('DICOM_SCP_FLUSH_INTERVAL', '1.0'))
+# Received-but-unindexed instances; a full queue holds back the senders
+INDEX_QUEUE_SIZE = 10000
+# Seconds a handler waits for room in the queue before refusing the instance
+INDEX_QUEUE_TIMEOUT = float(os.environ.get('DICOM_SCP_QUEUE_TIMEOUT', '30'))
+
+# UIDs become path components, so only the DICOM UID syntax (PS3.5 9.1) is accepted
+UID_PATTERN = re.compile(r'[0-9]+(\.[0-9]+)*')
+MAX_UID_LENGTH = 64
+
+STATUS_SUCCESS = 0x0000
+STATUS_OUT_OF_RESOURCES = 0xA700
+STATUS_CANNOT_UNDERSTAND = 0xC000
+
+class StoreSCP:
+    """
+    DICOM C-STORE receiver that feeds the same persistence path as BaseParser.
+
+    Each association runs in its own pynetdicom thread. The handler writes
+    the encoded dataset to disk as received, without decoding the pixel
+    data, and queues the configured header tags. A single indexer thread
+    drains the queue through BaseParser.index_dataset so database writes
+    go out in unordered batches instead of one round trip per instance.
+    """
+
+    def __init__(self, db, port, store_dir=None, ae_title=None, max_associations=None, batch_size=None):
+        self.parser = BaseParser(db)
+        self.port = int(port)
+        self.store_dir = os.path.abspath(store_dir or DEFAULT_STORE_DIR)
+        self.ae_title = ae_title or DEFAULT_AE_TITLE
+        self.max_associations = max_associations or DEFAULT_MAX_ASSOCIATIONS
+        self.batch_size = batch_size or DEFAULT_INDEX_BATCH_SIZE
+        self.queue = queue.Queue(maxsize=INDEX_QUEUE_SIZE)
+        self.received = 0
+        self.indexed = 0
+        self.failed = 0
+        self.last_received = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._server = None
+        self._indexer = None
+
+    def start(self):
+        if AE is None:
+            raise RuntimeError('pynetdicom is required for the C-STORE receiver')
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        ae = AE(ae_title=self.ae_title)
+        ae.maximum_associations = self.max_associations
+        ae.supported_contexts = AllStoragePresentationContexts
+        ae.add_supported_context(Verification)
+
+        self._indexer = threading.Thread(target=self._run_indexer, name='dicom-scp-index', daemon=True)
+        self._indexer.start()
+        self._server = ae.start_server(
+            ('0.0.0.0', self.port),
+            block=False,
+            evt_handlers=[(evt.EVT_C_STORE, self._handle_store)]
+        )
+        logger.info(f"C-STORE SCP {self.ae_title} listening on port {self.port}, storing to {self.store_dir}")
+
+    def stop(self):
+        """Stop accepting associations, then index whatever is still queued"""
+        if self._server:
+            self._server.shutdown()
+        self._stopped.set()
+        if self._indexer:
+            self._indexer.join()
+
+    def status(self):
+        return {
+            'ae_title': self.ae_title,
+            'port': self.port,
+            'store_dir': self.store_dir,
+            'active_associations': len(self._server.active_associations) if self._server else 0,
+            'received': self.received,
+            'indexed': self.indexed,
+            'failed': self.failed,
+            'queued': self.queue.qsize(),
+            'last_received': self.last_received
+        }
+
+    def _instance_path(self, dataset):
+        """Storage path from the dataset's UIDs, ValueError for anything that is not a valid UID"""
+        uids = [str(dataset.StudyInstanceUID), str(dataset.SeriesInstanceUID), str(dataset.SOPInstanceUID)]
+        for uid in uids:
+            if len(uid) > MAX_UID_LENGTH or not UID_PATTERN.fullmatch(uid):
+                raise ValueError(f"invalid UID {uid[:80]!r}")
+        file_path = os.path.join(self.store_dir, uids[0], uids[1], f"{uids[2]}.dcm")
+        if not os.path.realpath(file_path).startswith(os.path.join(os.path.realpath(self.store_dir), '')):
+            raise ValueError(f"{file_path} is outside {self.store_dir}")
+        return file_path
+
+    def _header(self, dataset):
+        """Copy only the configured tags, so queued items do not hold pixel data"""
+        header = Dataset()
+        for tag in self.parser.header_tags:
+            if tag in dataset:
+                header[tag] = dataset[tag]
+        return header
+
+    def _handle_store(self, event):
+        """EVT_C_STORE handler, runs in the association's thread"""
+        try:
+            dataset = event.dataset
+            file_path = self._instance_path(dataset)
+            header = self._header(dataset)
+        except Exception as e:
+            logger.error(f"Rejecting C-STORE from {event.assoc.requestor.ae_title}: {e}")
+            return STATUS_CANNOT_UNDERSTAND
+
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            # Unique per thread, the same SOP may arrive on two associations at once
+            temp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.part"
+            # Write the dataset as encoded on the wire, prefixed with preamble and file meta
+            with open(temp_path, 'wb') as f:
+                f.write(b'\x00' * 128)
+                f.write(b'DICM')
+                write_file_meta_info(f, event.file_meta)
+                f.write(event.request.DataSet.getvalue())
+            os.replace(temp_path, file_path)
+        except OSError as e:
+            logger.error(f"Could not store {dataset.SOPInstanceUID}: {e}")
+            return STATUS_OUT_OF_RESOURCES
+
+        try:
+            self.queue.put((header, file_path), timeout=INDEX_QUEUE_TIMEOUT)
+        except queue.Full:
+            # Stored on disk, a later folder scan or a resend indexes it
+            logger.error(f"Index queue full, refusing {dataset.SOPInstanceUID}")
+            return STATUS_OUT_OF_RESOURCES
+        with self._lock:
+            self.received += 1
+            self.last_received = time.time()
+        return STATUS_SUCCESS
+
+    def _run_indexer(self):
+        pending = 0
+        last_flush = time.monotonic()
+        while not (self._stopped.is_set() and self.queue.empty()):
+            try:
+                header, file_path = self.queue.get(timeout=INDEX_FLUSH_INTERVAL)
+                try:
+                    self.parser.index_dataset(header, file_path)
+                    pending += 1
+                except ValueError as e:
+                    # Stored on disk, but missing required tags for the index
+                    logger.warning(f"Not indexing {file_path}: {e}")
+                    self.failed += 1
+                except Exception as e:
+                    # E.g. a lost database connection; the thread must keep draining the queue
+                    logger.error(f"Indexing {file_path} failed: {e}", exc_info=True)
+                    self.failed += 1
+            except queue.Empty:
+                pass
+
+            if pending and (pending >= self.batch_size or time.monotonic() - last_flush >= INDEX_FLUSH_INTERVAL):
+                self._flush(pending)
+                pending = 0
+                last_flush = time.monotonic()
+        if pending:
+            self._flush(pending)
+
+    def _flush(self, pending):
+        try:
+            self.parser.flush()
+            self.indexed += pending
+        except Exception as e:
+            logger.error(f"Indexing {pending} received instances failed: {e}", exc_info=True)
+            self.failed += pending
@@ -0,0 +1,67 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Response key -> (DICOM keyword, converter) for the image attributes the viewer needs
+VIEWER_TAGS = {
+    'rows': ('Rows', int),
+    'columns': ('Columns', int),
+    'pixelSpacing': ('PixelSpacing', lambda v: [float(x) for x in v]),
+    'sliceThickness': ('SliceThickness', float),
+    'sliceLocation': ('SliceLocation', float),
+    'instanceNumber': ('InstanceNumber', int),
+    'imagePositionPatient': ('ImagePositionPatient', lambda v: [float(x) for x in v]),
+    'imageOrientationPatient': ('ImageOrientationPatient', lambda v: [float(x) for x in v]),
+    'numberOfFrames': ('NumberOfFrames', int),
+    'windowCenter': ('WindowCenter', lambda v: float(_first(v))),
+    'windowWidth': ('WindowWidth', lambda v: float(_first(v))),
+    'rescaleSlope': ('RescaleSlope', float),
+    'rescaleIntercept': ('RescaleIntercept', float),
+    'samplesPerPixel': ('SamplesPerPixel', int),
+    'photometricInterpretation': ('PhotometricInterpretation', lambda v: str(v).strip()),
+    'bitsAllocated': ('BitsAllocated', int),
+    'bitsStored': ('BitsStored', int),
+    'highBit': ('HighBit', int),
+    'pixelRepresentation': ('PixelRepresentation', int),
+}
+
+def _first(value):
+    """First value of a multi-valued element such as WindowCenter"""
+    if hasattr(value, '__iter__') and not isinstance(value, str):
+        return value[0]
+    return value
+
+def extract_viewer_metadata(dataset):
+    """Viewer metadata for one instance, computed once at ingest.
+
+    Values that are missing or cannot be converted are left out, except
+    samplesPerPixel which defaults to 1 (grayscale) like the viewer
+    expects.
+    """
+    metadata = {}
+    for key, (keyword, convert) in VIEWER_TAGS.items():
+        value = dataset.get(keyword)
+        if value is None or value == '':
+            continue
+        try:
+            metadata[key] = convert(value)
+        except (TypeError, ValueError, IndexError) as e:
+            logger.debug(f"Could not convert {keyword}: {e}")
+    metadata.setdefault('samplesPerPixel', 1)
+    return metadata
+
+def viewer_keywords():
+    """DICOM keywords read from disk so the metadata can be extracted from headers"""
+    return [keyword for keyword, _ in VIEWER_TAGS.values()]
+
+def viewer_response(instance, metadata=None):
+    """Metadata response for an instance document, with its UIDs in the viewer's naming"""
+    metadata = metadata if metadata is not None else instance.get('viewer_metadata', {})
+    response = {
+        'studyInstanceUid': instance.get('study_instance_uid', ''),
+        'seriesInstanceUid': instance.get('series_uid', ''),
+        'sopInstanceUid': instance['sop_instance_uid'],
+        **metadata
+    }
+    response.setdefault('instanceNumber', int(instance.get('instance_number', 0)))
+    return response
@@ -0,0 +1,268 @@
+import io
+import os
+import gzip
+import json
+import struct
+import logging
+import threading
+from collections import deque
+from functools import partial
+from itertools import repeat
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import pydicom
+from utils.archives import open_locator
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# 'stream' sends slices as they are decoded, see stream_volume
+VOLUME_FORMATS = ('json', 'raw', 'npy', 'stream')
+VOLUME_COMPRESSIONS = ('gzip', 'zstd') if zstandard is not None else ('gzip',)
+# Voxel layout for binary responses, exposed to browsers through CORS
+VOLUME_HEADERS = ['X-Volume-Dtype', 'X-Volume-Dimensions', 'X-Volume-Spacing', 'X-Volume-Level']
+# Downsampling factors of the volume pyramid, coarsest first so viewers can refine
+PYRAMID_LEVELS = (4, 2, 1)
+VOLUME_DTYPE = np.float32
+# Slice decoders per volume; threads share the output buffer, processes use shared memory
+DEFAULT_DECODE_WORKERS = int(os.environ.get('VOLUME_DECODE_WORKERS', str(min(8, os.cpu_count() or 1))))
+DEFAULT_DECODE_MODE = os.environ.get('VOLUME_DECODE_MODE', 'thread')
+# Fast levels: the payload is large and decompression speed matters more than ratio
+GZIP_LEVEL = 1
+ZSTD_LEVEL = 3
+
+def read_slice(file_path):
+    """Read one instance including its pixel data"""
+    with open_locator(file_path) as f:
+        return pydicom.dcmread(f)
+
+def read_header(file_path):
+    """Read one instance without its pixel data"""
+    with open_locator(file_path) as f:
+        return pydicom.dcmread(f, stop_before_pixels=True)
+
+def volume_spacing(dataset):
+    """[x, y, z] spacing in mm from PixelSpacing and SliceThickness, 1 where missing"""
+    try:
+        row_spacing, column_spacing = (float(v) for v in dataset.PixelSpacing)
+    except (AttributeError, TypeError, ValueError):
+        row_spacing = column_spacing = 1.0
+    try:
+        slice_thickness = float(dataset.SliceThickness)
+    except (AttributeError, TypeError, ValueError):
+        slice_thickness = 1.0
+    return [column_spacing, row_spacing, slice_thickness]
+
+def _write_slice(volume, index, pixels):
+    """Copy decoded pixels into volume[index] and scale them to 0-255 in place"""
+    if pixels.shape != volume.shape[1:]:
+        raise ValueError(f"slice is {pixels.shape}, expected {volume.shape[1:]}")
+    target = volume[index]
+    target[...] = pixels
+    maximum = target.max()
+    if maximum > 0:
+        target *= 255.0 / maximum
+
+def _decode_slice(volume, index, file_path):
+    """Decode one slice into the volume, returning an error message instead of raising"""
+    try:
+        _write_slice(volume, index, read_slice(file_path).pixel_array)
+        return None
+    except Exception as e:
+        return str(e)
+
+def _decode_shared_slice(shm_name, shape, index, file_path):
+    """Process pool worker: decode into a volume held in shared memory"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        return _decode_slice(np.ndarray(shape, dtype=VOLUME_DTYPE, buffer=shm.buf), index, file_path)
+    finally:
+        shm.close()
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def _get_process_pool(workers):
+    """Process pool shared by all requests, started on first use"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=workers)
+        return _process_pool
+
+def assemble_volume(instances, workers=None, mode=None):
+    """Decode a series into a (depth, rows, columns) float32 array.
+
+    Instances must be sorted by instance number. Each slice is scaled to
+    0-255 by its own maximum, as the viewer expects. Slices that cannot be
+    read or do not match the first slice's size are left as zeros so the
+    depth always matches the instance count.
+
+    Slices are decoded straight into one preallocated buffer. Threads
+    share it directly; processes write into a shared memory block that is
+    copied out once at the end, which pays off for compressed transfer
+    syntaxes whose decoders hold the GIL.
+    """
+    workers = workers or DEFAULT_DECODE_WORKERS
+    mode = mode or DEFAULT_DECODE_MODE
+    # Geometry only; the first slice's pixels are decoded like the others so a bad slice stays zeros
+    first = read_header(instances[0]['file_path'])
+    shape = (len(instances), int(first.Rows), int(first.Columns))
+    file_paths = [instance['file_path'] for instance in instances]
+    indexes = range(len(instances))
+
+    if mode == 'process' and workers > 1 and len(file_paths) > 1:
+        shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(VOLUME_DTYPE).itemsize)
+        try:
+            shared = np.ndarray(shape, dtype=VOLUME_DTYPE, buffer=shm.buf)
+            shared.fill(0)
+            errors = list(_get_process_pool(workers).map(
+                _decode_shared_slice, repeat(shm.name), repeat(shape), indexes, file_paths,
+                chunksize=max(1, len(file_paths) // (workers * 4))
+            ))
+            volume = shared.copy()
+        finally:
+            # The view must be released before the block can be closed
+            shared = None
+            shm.close()
+            shm.unlink()
+    else:
+        volume = np.zeros(shape, dtype=VOLUME_DTYPE)
+        if workers > 1 and len(file_paths) > 1:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='slice-decode') as executor:
+                errors = list(executor.map(partial(_decode_slice, volume), indexes, file_paths))
+        else:
+            errors = [_decode_slice(volume, index, file_path) for index, file_path in zip(indexes, file_paths)]
+
+    for instance, error in zip(instances, errors):
+        if error:
+            logger.error(f"Error reading instance {instance.get('instance_number')}: {error}")
+
+    return volume, volume_spacing(first)
+
+def level_instances(instances, level):
+    """Every level:th instance, the slices a pyramid level is built from"""
+    return instances[::level]
+
+def level_spacing(spacing, level):
+    """Spacing of a pyramid level, each axis is downsampled by the same factor"""
+    return [s * level for s in spacing]
+
+def downsample_volume(volume, level, slices_selected=False):
+    """Pyramid level of a volume: every level:th slice, averaged over level x level pixel blocks.
+
+    Rows and columns that do not fill a whole block are dropped. Pass
+    slices_selected=True when the volume was assembled from
+    level_instances() and only the in-plane reduction remains.
+    """
+    if level == 1:
+        return volume
+    if not slices_selected:
+        volume = volume[::level]
+    depth, rows, columns = volume.shape
+    rows, columns = rows // level, columns // level
+    blocks = volume[:, :rows * level, :columns * level].reshape(depth, rows, level, columns, level)
+    return blocks.mean(axis=(2, 4), dtype=VOLUME_DTYPE)
+
+def volume_headers(shape, dtype, spacing):
+    """Layout headers for a binary volume, dimensions as width,height,depth like the JSON response"""
+    depth, height, width = shape
+    return {
+        'X-Volume-Dtype': np.dtype(dtype).name,
+        'X-Volume-Dimensions': f"{width},{height},{depth}",
+        'X-Volume-Spacing': ','.join(str(s) for s in spacing)
+    }
+
+def encode_volume(volume, spacing, fmt='raw', compression=None):
+    """Serialize a volume for a binary response.
+
+    Returns (body, mimetype, headers). 'raw' is the C-ordered voxel buffer,
+    'npy' adds the NumPy header so np.load can read it directly.
+    """
+    if fmt == 'npy':
+        buffer = io.BytesIO()
+        np.save(buffer, volume, allow_pickle=False)
+        body = buffer.getvalue()
+        mimetype = 'application/x-npy'
+    else:
+        body = volume.tobytes()
+        mimetype = 'application/octet-stream'
+
+    headers = volume_headers(volume.shape, volume.dtype, spacing)
+
+    if compression == 'gzip':
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        headers['Content-Encoding'] = 'gzip'
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression requires the zstandard package')
+        body = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+        headers['Content-Encoding'] = 'zstd'
+
+    return body, mimetype, headers
+
+def _decode_stream_slice(shape, level, file_path):
+    """Decode and downsample one slice on its own, returns (pixels, error message)"""
+    plane = np.zeros((1,) + shape, dtype=VOLUME_DTYPE)
+    error = _decode_slice(plane, 0, file_path)
+    return downsample_volume(plane, level, slices_selected=True)[0], error
+
+def iter_volume_slices(instances, shape, level=1, workers=None):
+    """Yield decoded slices in instance order while later ones are still decoding.
+
+    instances are the slices to stream, already reduced with
+    level_instances(); shape is the full resolution (rows, columns). At
+    most two slices per worker are decoded ahead of the consumer, so
+    memory stays bounded however large the series is. Unreadable slices
+    are yielded as zeros, like in assemble_volume.
+    """
+    workers = workers or DEFAULT_DECODE_WORKERS
+    if workers <= 1:
+        for instance in instances:
+            yield _stream_result(instance, _decode_stream_slice(shape, level, instance['file_path']))
+        return
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='slice-stream')
+    pending = deque()
+    try:
+        for instance in instances:
+            pending.append((instance, executor.submit(_decode_stream_slice, shape, level, instance['file_path'])))
+            if len(pending) > workers * 2:
+                instance, future = pending.popleft()
+                yield _stream_result(instance, future.result())
+        while pending:
+            instance, future = pending.popleft()
+            yield _stream_result(instance, future.result())
+    finally:
+        # A client that disconnects closes the generator; queued decodes are dropped
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def _stream_result(instance, result):
+    pixels, error = result
+    if error:
+        logger.error(f"Error reading instance {instance.get('instance_number')}: {error}")
+    return pixels
+
+def stream_volume(slices, shape, spacing, level=1):
+    """Chunks of a streamed volume: a geometry header, then one float32 slice per chunk.
+
+    The header is a little-endian uint32 length followed by that many bytes
+    of JSON with dtype, dimensions (width, height, depth), spacing and
+    level. Each following chunk is one C-ordered slice of height x width
+    voxels, in instance order.
+    """
+    depth, height, width = shape
+    geometry = json.dumps({
+        'dtype': np.dtype(VOLUME_DTYPE).name,
+        'dimensions': [width, height, depth],
+        'spacing': spacing,
+        'level': level
+    }).encode()
+    yield struct.pack('<I', len(geometry)) + geometry
+    for pixels in slices:
+        yield np.ascontiguousarray(pixels, dtype=VOLUME_DTYPE).tobytes()
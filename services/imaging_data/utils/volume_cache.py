@@ -0,0 +1,136 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import numpy as np
+from utils.volume import PYRAMID_LEVELS
+
+logger = logging.getLogger(__name__)
+
+# Decoded volumes are stored here as .npy files and memory-mapped on reads
+DEFAULT_VOLUME_CACHE_DIR = os.environ.get('VOLUME_CACHE_DIR', '/data/volume_cache')
+# Size budget in GB, least recently used volumes are evicted beyond it; 0 disables the cache
+DEFAULT_VOLUME_CACHE_MAX_GB = float(os.environ.get('VOLUME_CACHE_MAX_GB', '10'))
+
+def series_fingerprint(instances):
+    """Hash of the SOP UIDs and file paths a volume was built from"""
+    digest = hashlib.blake2b(digest_size=16)
+    for instance in instances:
+        digest.update(f"{instance['sop_instance_uid']}|{instance.get('file_path')}\n".encode())
+    return digest.hexdigest()
+
+class VolumeCache:
+    """
+    On-disk cache of decoded series volumes, keyed by series UID and
+    pyramid level.
+
+    Volumes are written once as .npy files and opened with np.load in
+    mmap mode, so repeat reads come from the page cache instead of being
+    decoded again. Each entry records the fingerprint of the instances it
+    was built from; a changed instance list makes the entry stale, and
+    ingestion drops entries of series it rewrote. The metadata also
+    records the array's inode, shape and dtype, so a reader racing a
+    rewrite sees a miss instead of pairing new metadata with an old array. File mtimes track use,
+    and the least recently used entries are removed once the total size
+    exceeds the budget.
+    """
+
+    def __init__(self, cache_dir=None, max_gb=None):
+        self.cache_dir = cache_dir or DEFAULT_VOLUME_CACHE_DIR
+        self.max_bytes = int((DEFAULT_VOLUME_CACHE_MAX_GB if max_gb is None else max_gb) * 1024 ** 3)
+        self.enabled = self.max_bytes > 0
+        self._lock = threading.Lock()
+
+    def _key(self, series_uid, level=1):
+        """Cache key of a pyramid level, full resolution uses the bare series UID"""
+        return series_uid if level == 1 else f"{series_uid}.x{level}"
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return f"{base}.npy", f"{base}.json"
+
+    def get(self, series_uid, fingerprint, level=1):
+        """Return (volume memmap, spacing) or None when missing, stale or being rewritten"""
+        if not self.enabled:
+            return None
+        volume_path, meta_path = self._paths(self._key(series_uid, level))
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta['fingerprint'] != fingerprint:
+                # Stale; the caller rebuilds it and put() overwrites the entry
+                return None
+            inode = os.stat(volume_path).st_ino
+            volume = np.load(volume_path, mmap_mode='r')
+            # The metadata names the array it was written with. A put() running
+            # concurrently may have replaced one file but not yet the other.
+            if (inode != meta.get('inode') or os.stat(volume_path).st_ino != inode
+                    or list(volume.shape) != meta.get('shape') or volume.dtype.str != meta.get('dtype')):
+                return None
+            os.utime(volume_path)
+            return volume, meta['spacing']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, series_uid, fingerprint, volume, spacing, level=1):
+        """Store a volume, then evict old entries if over budget"""
+        if not self.enabled or volume.nbytes > self.max_bytes:
+            return
+        volume_path, meta_path = self._paths(self._key(series_uid, level))
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Written under temporary names so readers never map a partial file
+            temp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(volume_path + temp_suffix, 'wb') as f:
+                np.save(f, volume, allow_pickle=False)
+            meta = {
+                'fingerprint': fingerprint,
+                'spacing': spacing,
+                'shape': list(volume.shape),
+                'dtype': volume.dtype.str,
+                # os.replace keeps the inode, so readers can tell which array the metadata belongs to
+                'inode': os.stat(volume_path + temp_suffix).st_ino
+            }
+            with open(meta_path + temp_suffix, 'w') as f:
+                json.dump(meta, f)
+            # Metadata first: a reader that sees it before the new array finds the inode mismatch
+            os.replace(meta_path + temp_suffix, meta_path)
+            os.replace(volume_path + temp_suffix, volume_path)
+        except OSError as e:
+            logger.warning(f"Could not cache volume for series {series_uid}: {e}")
+            return
+        self._evict()
+
+    def invalidate(self, series_uids):
+        """Drop cached volumes at every level, e.g. after ingestion changed their series"""
+        if not self.enabled:
+            return
+        for series_uid in series_uids:
+            for level in PYRAMID_LEVELS:
+                for path in self._paths(self._key(series_uid, level)):
+                    self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.name.endswith('.npy'):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.name[:-len('.npy')]))
+            total = sum(size for _, size, _ in entries)
+            for _, size, key in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                # Open memmaps keep working, the file is only unlinked
+                for path in self._paths(key):
+                    self._remove(path)
+                total -= size
+                logger.info(f"Evicted cached volume {key}")
@@ -0,0 +1,167 @@
+import os
+import time
+import logging
+import threading
+from utils.discovery import DirectoryScanner
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+logger = logging.getLogger(__name__)
+
+# Seconds a file must stay unchanged before it is ingested
+DEFAULT_DEBOUNCE_SECONDS = float(os.environ.get('DICOM_WATCH_DEBOUNCE', '2.0'))
+# Seconds between directory scans when inotify is unavailable
+DEFAULT_POLL_INTERVAL = float(os.environ.get('DICOM_WATCH_POLL_INTERVAL', '5.0'))
+# Upper bound on files handed to the parser in one batch
+MAX_BATCH_SIZE = 2000
+TICK_SECONDS = 0.5
+
+class _SpoolEventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.watcher.touch(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.watcher.touch(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.watcher.touch(event.dest_path)
+
+class FolderWatcher:
+    """
+    Continuously ingests files dropped into a spool directory.
+
+    File events come from inotify (through watchdog) when it is installed
+    and the mount supports it, otherwise the tree is rescanned every
+    poll_interval seconds. A file is ingested once it has seen no events
+    for debounce seconds and its size has stopped changing. Settled files
+    are handed to `ingest` in batches; the parser groups them by study and
+    series when saving.
+    """
+
+    def __init__(self, root, ingest, debounce=None, poll_interval=None, use_polling=False):
+        self.root = os.path.abspath(root)
+        self.ingest = ingest
+        self.debounce = debounce if debounce is not None else DEFAULT_DEBOUNCE_SECONDS
+        self.poll_interval = poll_interval if poll_interval is not None else DEFAULT_POLL_INTERVAL
+        self.use_polling = use_polling or Observer is None
+        self.pending = {}
+        self.polled = {}
+        self.ingested_files = 0
+        self.last_ingest = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._observer = None
+
+    def start(self):
+        if not self.use_polling:
+            try:
+                self._observer = Observer()
+                self._observer.schedule(_SpoolEventHandler(self), self.root, recursive=True)
+                self._observer.start()
+            except OSError as e:
+                logger.warning(f"inotify unavailable for {self.root} ({e}), falling back to polling")
+                self._observer = None
+                self.use_polling = True
+
+        self._thread = threading.Thread(target=self._run, name='dicom-watch', daemon=True)
+        self._thread.start()
+        logger.info(f"Watching {self.root} using {'polling' if self.use_polling else 'inotify'}")
+
+    def stop(self):
+        self._stopped.set()
+        if self._observer:
+            self._observer.stop()
+        if self._thread:
+            self._thread.join()
+
+    def status(self):
+        with self._lock:
+            pending = len(self.pending)
+        return {
+            'root': self.root,
+            'mode': 'polling' if self.use_polling else 'inotify',
+            'pending_files': pending,
+            'ingested_files': self.ingested_files,
+            'last_ingest': self.last_ingest
+        }
+
+    def touch(self, path, size=None):
+        """Record activity on a file, restarting its debounce timer"""
+        if size is None:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return
+        with self._lock:
+            self.pending[path] = (time.monotonic(), size)
+
+    def _run(self):
+        # Pick up files that arrived while the service was down
+        self._poll()
+        last_poll = time.monotonic()
+
+        while not self._stopped.wait(TICK_SECONDS):
+            if self.use_polling and time.monotonic() - last_poll >= self.poll_interval:
+                self._poll()
+                last_poll = time.monotonic()
+
+            ready = self._settled_files()
+            for start in range(0, len(ready), MAX_BATCH_SIZE):
+                batch = ready[start:start + MAX_BATCH_SIZE]
+                try:
+                    summary = self.ingest(batch)
+                    self.ingested_files += summary.get('succeeded', 0)
+                    self.last_ingest = time.time()
+                    logger.info(f"Watch ingest: {len(batch)} files, {summary.get('succeeded', 0)} instances")
+                except Exception as e:
+                    logger.error(f"Watch ingest failed for {len(batch)} files: {e}", exc_info=True)
+
+    def _poll(self):
+        """Rescan the tree and touch files that are new or changed since the last scan"""
+        seen = {}
+        for path, stat in DirectoryScanner(self.root):
+            seen[path] = (stat.st_size, stat.st_mtime_ns)
+            if self.polled.get(path) != seen[path]:
+                self.touch(path, stat.st_size)
+        self.polled = seen
+
+    def _settled_files(self):
+        """Pop files that have been quiet for the debounce period with a stable size"""
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            candidates = [
+                (path, last_event, size) for path, (last_event, size) in self.pending.items()
+                if now - last_event >= self.debounce
+            ]
+        for path, last_event, size in candidates:
+            try:
+                current_size = os.path.getsize(path)
+            except OSError:
+                # Removed before it settled
+                with self._lock:
+                    self.pending.pop(path, None)
+                continue
+            if current_size != size:
+                # Still being written without events (e.g. NFS), wait another period
+                self.touch(path, current_size)
+                continue
+            with self._lock:
+                # Skip files that saw a new event while we were checking
+                if self.pending.get(path, (None,))[0] != last_event:
+                    continue
+                del self.pending[path]
+            ready.append(path)
+        return sorted(ready)
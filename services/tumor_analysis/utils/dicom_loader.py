@@ -1,7 +1,8 @@
+import io
 import pydicom
 import numpy as np
 import requests
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from pathlib import Path
 
 class DicomLoader:
@@ -33,6 +34,29 @@ class DicomLoader:
         except Exception as e:
             raise Exception(f"Error loading DICOM series: {str(e)}")
 
+    def load_volume(self, series_id: str) -> Tuple[np.ndarray, List[float]]:
+        """
+        Load a series volume as a NumPy array from the imaging service
+
+        Args:
+            series_id: Series identifier
+
+        Returns:
+            Tuple[np.ndarray, List[float]]: (depth, rows, columns) float32 volume
+            scaled to 0-255 per slice, and [x, y, z] spacing in mm
+        """
+        response = requests.get(
+            f"{self.imaging_service_url}/dicom/volume/{series_id}",
+            params={'format': 'npy', 'compression': 'gzip'}
+        )
+        if not response.ok:
+            raise Exception("Failed to get volume from imaging service")
+
+        # requests packar upp gzip automatiskt
+        volume = np.load(io.BytesIO(response.content), allow_pickle=False)
+        spacing = [float(s) for s in response.headers['X-Volume-Spacing'].split(',')]
+        return volume, spacing
+
     def get_series_metadata(self, series_id: str) -> Dict:
         """
         Get metadata for a series from the imaging service